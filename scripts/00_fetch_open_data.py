@@ -11,7 +11,7 @@
 输出：
 - data/raw/worldcover_*.tif
 - data/raw/osm_roads_*.gpkg
-- data/raw/gbif_occ_*.parquet
+- data/raw/gbif_occ_*.parquet（分块分页拉取、去重后流式写入）
 - data/processed/aoi.gpkg 研究区范围
 
 用法示例：
@@ -23,30 +23,20 @@
 - 该脚本仅为起跑包（小范围）；大范围/全球请转用官方批量下载方案（详见 README_zh）。
 """
 from __future__ import annotations
-import argparse, os, math, io
+import argparse
 from pathlib import Path
 import geopandas as gpd
-import pandas as pd
-import numpy as np
-import shapely.geometry as sgeom
 
 import osmnx as ox
-from pygbif import occurrences as gbif_occ
 from pystac_client import Client as StacClient
-import boto3
-import botocore
-import rasterio
-from rasterio import windows
-from rasterio.session import AWSSession
-from rasterio.enums import Resampling
-import rioxarray as rxr
 
 # 本项目的路径配置
-from mobiodiv.config import DATA_DIR, RAW_DIR, PROCESSED_DIR, CRS_WGS84
+from mobiodiv.config import RAW_DIR, PROCESSED_DIR, CRS_WGS84
+from mobiodiv.data.osm import load_roads_cached
+from mobiodiv.data.landcover import fetch_worldcover_mosaic
+from mobiodiv.biodiv.gbif import fetch_gbif_to_parquet
 
 ESA_WORLDCOVER_STAC = "https://services.terrascope.be/stac"  # 官方 STAC 端点（公开）
-ESA_WORLDCOVER_BUCKET = "esa-worldcover"                     # AWS 公共桶（无需签名）
-ESA_WORLDCOVER_PREFIX = "v200/2021/map"                      # 2021 v200 地图路径
 ESA_COLLECTION_HINTS = ["worldcover", "WorldCover", "VITO"]  # 模糊匹配集合名
 
 def geocode_aoi(place: str, buffer_km: float = 0.0) -> gpd.GeoDataFrame:
@@ -78,105 +68,47 @@ def pick_worldcover_items_by_bbox(bbox):
                     break
         return items or []
     except Exception as e:
-        print("STAC 查询失败，将退回到 AWS 直接列目录：", e)
+        print("STAC 查询失败，将退回到按瓦片名直接寻址 AWS 公共桶：", e)
         return []
 
 def download_worldcover_cogs(items, out_dir: Path, bbox):
-    """下载并/或裁剪 COG。若 items 为空，则直接从 AWS 列出并尝试读入重采样裁剪。"""
+    """按 bbox 拉取 WorldCover 并镶嵌为单个 GeoTIFF（分块、压缩）
+    - 有 STAC items 时使用其 href；否则由 3x3 度瓦片命名规则直接推算 AWS 路径（无需列桶、无需逐个打开）
+    - 所有相交瓦片在线程池中并发按窗口读取（COG Range 请求），跨瓦片的研究区不会被截断
+    """
     out_dir.mkdir(parents=True, exist_ok=True)
-    # 配置匿名 AWS 会话（no-sign-request）
-    s3 = boto3.client("s3", config=botocore.config.Config(signature_version=botocore.UNSIGNED), region_name="eu-central-1")
-    session = AWSSession(botocore_session=botocore.session.get_session())
     minx, miny, maxx, maxy = bbox
-
-    saved = []
-    if items:
-        # 逐个 COG 拉取并裁剪（保存在 raw 下）
-        for it in items:
-            href = it.assets["map"].href if "map" in it.assets else list(it.assets.values())[0].href
-            # href 可能是 s3://esa-worldcover/... 或 https://...，这里统一改为 vsicurl 读取并裁剪
-            try:
-                with rasterio.Env(AWSSession(botocore_session=botocore.session.get_session())):
-                    with rasterio.open(href) as src:
-                        window = windows.from_bounds(minx, miny, maxx, maxy, transform=src.transform, height=src.height, width=src.width)
-                        out = src.read(window=window, out_dtype=src.dtypes[0], resampling=Resampling.nearest)
-                        profile = src.profile.copy()
-                        transform = windows.transform(window, src.transform)
-                        profile.update({
-                            "height": out.shape[1],
-                            "width": out.shape[2],
-                            "transform": transform
-                        })
-                        out_path = out_dir / f"worldcover_clip_{minx:.3f}_{miny:.3f}_{maxx:.3f}_{maxy:.3f}.tif"
-                        with rasterio.open(out_path, "w", **profile) as dst:
-                            dst.write(out)
-                        saved.append(out_path)
-            except Exception as e:
-                print("读取/裁剪失败：", e)
-    else:
-        # 直接列 AWS 目录（COG 组织为 3x3 度瓦片），做粗筛后逐瓦片裁剪
-        paginator = s3.get_paginator("list_objects_v2")
-        for page in paginator.paginate(Bucket=ESA_WORLDCOVER_BUCKET, Prefix=ESA_WORLDCOVER_PREFIX):
-            for obj in page.get("Contents", []):
-                key = obj["Key"]
-                if not key.lower().endswith(".tif"):
-                    continue
-                # 直接尝试打开并裁剪（性能较慢，但零账号可用）
-                href = f"/vsis3/{ESA_WORLDCOVER_BUCKET}/{key}"
-                try:
-                    with rasterio.open(href) as src:
-                        # 快速判断是否相交（通过坐标系与 bbox）
-                        left, bottom, right, top = src.bounds
-                        if (right < minx) or (left > maxx) or (top < miny) or (bottom > maxy):
-                            continue
-                        window = windows.from_bounds(minx, miny, maxx, maxy, transform=src.transform, height=src.height, width=src.width)
-                        out = src.read(window=window, out_dtype=src.dtypes[0], resampling=Resampling.nearest)
-                        if out.size == 0:
-                            continue
-                        profile = src.profile.copy()
-                        transform = windows.transform(window, src.transform)
-                        profile.update({"height": out.shape[1], "width": out.shape[2], "transform": transform})
-                        out_path = out_dir / f"worldcover_clip_{minx:.3f}_{miny:.3f}_{maxx:.3f}_{maxy:.3f}.tif"
-                        with rasterio.open(out_path, "w", **profile) as dst:
-                            dst.write(out)
-                        saved.append(out_path)
-                        # 找到一个覆盖瓦片即可
-                        return saved
-                except Exception as e:
-                    # 某些瓦片可能读失败，忽略继续
-                    continue
-    return saved
-
-def fetch_osm_roads(aoi_gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
-    """下载研究区道路（机动车网）：返回 GeoDataFrame"""
+    hrefs = []
+    for it in items or []:
+        href = it.assets["map"].href if "map" in it.assets else list(it.assets.values())[0].href
+        hrefs.append(href)
+    out_path = out_dir / f"worldcover_clip_{minx:.3f}_{miny:.3f}_{maxx:.3f}_{maxy:.3f}.tif"
+    out, used = fetch_worldcover_mosaic(bbox, out_path, hrefs=hrefs or None)
+    if out is None and hrefs:
+        # STAC 返回的地址不可读时，退回到按瓦片名直接寻址
+        out, used = fetch_worldcover_mosaic(bbox, out_path)
+    if out is not None:
+        print(f"[WorldCover] 镶嵌 {len(used)} 个瓦片")
+    return [out] if out is not None else []
+
+def fetch_osm_roads(aoi_gdf: gpd.GeoDataFrame, offline: bool = False) -> gpd.GeoDataFrame:
+    """下载研究区道路（机动车网）：返回 GeoDataFrame
+    经由 INTERIM_DIR 下的瓦片缓存：重叠的研究区不会重复下载，失败的瓦片可单独重试
+    """
     poly = aoi_gdf.geometry.unary_union
-    G = ox.graph_from_polygon(poly, network_type="drive")
-    roads = ox.graph_to_gdfs(G, nodes=False, edges=True)
-    roads = roads.to_crs(CRS_WGS84)
-    return roads
+    return load_roads_cached(poly, network_type="drive", offline=offline)
 
-def fetch_gbif_occurrences(aoi_gdf: gpd.GeoDataFrame, taxon: str = "Aves", limit: int = 2000) -> pd.DataFrame:
+def fetch_gbif_occurrences(aoi_gdf: gpd.GeoDataFrame, out_path: Path, taxon: str = "Aves", max_workers: int = 4):
     """
-    通过 GBIF 公开 API 拉取一定数量的观测记录（示例：鸟类 Aves）
-    - 使用 geometry=polygon WKT 限制空间范围
-    - 可按需增加年份、质量过滤等
+    通过 GBIF 公开 API 拉取研究区内的全部观测记录（示例：鸟类 Aves），流式写入 Parquet
+    - 使用研究区多边形 WKT（geometry 参数）限制空间范围
+    - 记录数超过 API offset 上限的区域自动四叉树切分，各块分页并发拉取
+    - 按 occurrenceID 去重；可按需增加年份、质量过滤等（透传给 fetch_gbif_to_parquet）
+    返回：(out_path, 记录数)
     """
-    poly = aoi_gdf.geometry.iloc[0]
-    # WKT
-    wkt = sgeom.mapping(poly)  # GeoJSON
-    # gbif_occ.search 支持 geometry=WKT 字符串（这里简单用 bbox 以提高兼容性）
-    minx, miny, maxx, maxy = aoi_gdf.total_bounds
-    out = gbif_occ.search(scientificName=taxon, hasCoordinate=True,
-                          decimalLatitude=str(miny) + "," + str(maxy),
-                          decimalLongitude=str(minx) + "," + str(maxx),
-                          limit=limit)
-    recs = out.get("results", [])
-    if not recs:
-        return pd.DataFrame()
-    df = pd.DataFrame(recs)
-    keep = ["scientificName","decimalLatitude","decimalLongitude","eventDate","basisOfRecord","datasetKey","occurrenceID"]
-    df = df[[c for c in keep if c in df.columns]]
-    return df
+    poly = aoi_gdf.geometry.unary_union
+    return fetch_gbif_to_parquet(poly, out_path, max_workers=max_workers,
+                                 scientificName=taxon, hasCoordinate=True)
 
 def main():
     parser = argparse.ArgumentParser()
@@ -211,15 +143,14 @@ def main():
     except Exception as e:
         print("[OSM] 拉取失败：", e)
 
-    # 4) GBIF 物种（示例：鸟类 Aves 2000 条）
+    # 4) GBIF 物种（示例：鸟类 Aves，研究区内全部记录）
     try:
-        df = fetch_gbif_occurrences(aoi, taxon="Aves", limit=2000)
         gbif_path = RAW_DIR / f"gbif_occ_{args.place.replace(' ', '_')}.parquet"
-        if len(df):
-            df.to_parquet(gbif_path, index=False)
-            print(f"[GBIF] 记录数：{len(df)}，写入 {gbif_path}")
+        _, n_rows = fetch_gbif_occurrences(aoi, gbif_path, taxon="Aves")
+        if n_rows:
+            print(f"[GBIF] 记录数：{n_rows}，写入 {gbif_path}")
         else:
-            print("[GBIF] 未获取到记录，建议增大 limit 或更换 taxon。")
+            print("[GBIF] 未获取到记录，建议扩大研究区或更换 taxon。")
     except Exception as e:
         print("[GBIF] 拉取失败：", e)
 
@@ -2,25 +2,53 @@
 """脚本2：构建“中介”数据集（栖息地/连通性 + 干扰指数）"""
 from pathlib import Path
 from mobiodiv.config import FILES, OUTPUTS
-from mobiodiv.data.landcover import load_worldcover, habitat_mask, compute_patch_metrics
+from mobiodiv.data.landcover import load_worldcover, habitat_mask
+from mobiodiv.metrics.landscape import patch_metrics
+from mobiodiv.metrics.mspa import mspa_classify, mspa_summary, check_tiling
 from mobiodiv.data.airquality import load_no2, load_pm25, standardize_layers
-from mobiodiv.metrics.disturbance import composite_disturbance
+from mobiodiv.data.osm import road_density_raster
+from mobiodiv.metrics.disturbance import write_disturbance_cog
+import argparse
 import rioxarray as rxr
 import xarray as xr
 import pandas as pd
+import geopandas as gpd
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--check-mspa", action="store_true", help="检查 MSPA 分瓦片结果与整幅计算逐像元一致（模拟掩膜）")
+    args = parser.parse_args()
+    if args.check_mspa:
+        n_diff = check_tiling()
+        print(f"MSPA 分瓦片一致性检查：不一致像元 {n_diff}")
+        if n_diff:
+            raise SystemExit(1)
+
     # ===== 示例：读取 WorldCover 并生成栖息地掩膜 =====
-    da = load_worldcover()
+    da = load_worldcover(chunks=2048)  # 惰性分块读取，避免整景载入内存
     mask = habitat_mask(da, habitat_codes=(10,20,30))  # 示例编码：森林/灌丛/草地
-    # TODO: 使用真实 transform 与 pylandstats 计算景观/连通性指标
+    # 每个 城市×分层 单元的斑块/连通性指标（分块并行标记，跨瓦片接缝合并斑块）
+    strata = gpd.read_file(OUTPUTS['strata_gpkg'])
+    habitat = patch_metrics(mask, da.rio.transform(), da.rio.crs, units=strata)
+    # MSPA 形态类别（核心/孤岛/穿孔/边缘/环/桥/支线）按单元汇总面积与占比
+    mspa = mspa_classify(mask)
+    mspa_units = mspa_summary(mspa, da.rio.transform(), da.rio.crs, units=strata)
+    habitat = pd.concat([strata[['city_idx', 'stratum']], habitat, mspa_units.add_prefix('mspa_')], axis=1)
+    OUTPUTS['mediators_parquet'].parent.mkdir(parents=True, exist_ok=True)
+    habitat.to_parquet(OUTPUTS['mediators_parquet'])
+    print(f"已输出 {len(habitat)} 个单元的栖息地斑块指标。")
 
     # ===== 示例：构建干扰指数 =====
-    no2 = load_no2()
-    pm25 = load_pm25()
-    # 这里暂时以自身标准化示意；夜光/道路密度请在对应模块计算后传入
-    no2_z, pm25_z = standardize_layers(no2, pm25)
-    # 占位合成（缺夜光/道路）
-    disturbance = composite_disturbance(no2_z*0, no2_z*0, no2_z, pm25_z)
-    disturbance.rio.to_raster(OUTPUTS['mediators_parquet'].with_suffix(".tif"))
+    # NO2 为参考格网；PM2.5 经 WarpedVRT 分块对齐到同一格网
+    no2 = load_no2(chunks=2048)
+    pm25 = load_pm25(like=no2, chunks=2048)
+    # 道路密度（km/km²）写到与 NO2 相同的格网
+    roads = gpd.read_file(FILES['osm_roads'])
+    road_dens = road_density_raster(roads, like=no2)
+    # 这里暂时以自身标准化示意；夜光请在对应模块计算后传入
+    # 统计量按块流式计算并忽略 nodata；偏态明显时可改用 method='robust'（中位数/MAD）
+    no2_z, pm25_z, roads_z = standardize_layers(no2, pm25, road_dens, like=no2)
+    # 占位合成（缺夜光）；图层顺序同 composite_disturbance：夜光、道路、NO2、PM2.5
+    # 按块融合加权并直接写出 COG，内存占用与栅格总大小无关
+    write_disturbance_cog([no2_z*0, roads_z, no2_z, pm25_z], OUTPUTS['mediators_parquet'].with_suffix(".tif"))
     print("已输出干扰指数栅格（示意）。")
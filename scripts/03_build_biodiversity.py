@@ -1,18 +1,44 @@
 # -*- coding: utf-8 -*-
 """脚本3：生物多样性数据处理（eBird/GBIF 占位）"""
-from mobiodiv.biodiv.gbif import load_gbif_occ
-from mobiodiv.biodiv.ebird import load_ebd_tsv_gz
+from mobiodiv.biodiv.gbif import gbif_store, query_gbif
+from mobiodiv.biodiv.ebird import (ingest_ebd_to_parquet, read_ebd_parquet, benchmark_occupancy,
+                                   build_detection_store, load_detection_store, detection_tensor)
+from mobiodiv.metrics.community import count_matrix_from_units
 from mobiodiv.config import OUTPUTS
+import argparse
+import geopandas as gpd
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bench-occupancy", action="store_true", help="运行群落占据模型基准（模拟数据，报告每物种耗时）")
+    args = parser.parse_args()
     try:
-        gdf = load_gbif_occ()
-        print(f"GBIF 记录数：{len(gdf)}")
+        # 首次运行时转为分区列式存储，之后直接按需查询（只返回坐标数组，不构造几何）
+        occ = query_gbif(gbif_store())
+        print(f"GBIF 记录数：{len(occ)}")
+        # 按分层单元聚合为 站点×物种 稀疏矩阵（可直接传入 compute_alpha/compute_beta）
+        units = gpd.read_file(OUTPUTS['strata_gpkg'])
+        X, site_ids, species = count_matrix_from_units(
+            occ['decimalLongitude'], occ['decimalLatitude'], occ['species'], units)
+        print(f"站点×物种矩阵：{X.shape}，非零元 {X.nnz}")
     except Exception as e:
         print("GBIF 未就绪：", e)
 
     try:
-        ebd = load_ebd_tsv_gz()
+        # 流式转为分区 Parquet（源文件与参数未变时直接复用已有数据集），后续阶段按需读取切片
+        ebd_dir, n_rows = ingest_ebd_to_parquet()
+        print(f"EBD 已写入 {ebd_dir}，记录数：{n_rows}")
+        ebd = read_ebd_parquet(ebd_dir)
         print(f"EBD 记录预览：{ebd.head(3)}")
+        # 检测历史：按清单分组、站点为分层单元，增量写入紧凑存储（重跑只处理新增片段）
+        det_dir, n_new = build_detection_store(ebd_dir, units=gpd.read_file(OUTPUTS['strata_gpkg']))
+        checklists, det, species = load_detection_store(det_dir)
+        y, effort, site_ids = detection_tensor(checklists, det)
+        print(f"检测历史：清单 {len(checklists)}，物种 {len(species)}，新处理片段 {n_new}；站点×访问×物种 {y.shape}")
     except Exception as e:
         print("EBD 未就绪：", e)
+
+    if args.bench_occupancy:
+        bench = benchmark_occupancy(n_species=(10, 50, 200), methods=('map', 'advi'))
+        print("占据模型基准（秒/物种）：")
+        print(bench.to_string(index=False))
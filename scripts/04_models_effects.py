@@ -1,8 +1,8 @@
 # -*- coding: utf-8 -*-
-"""脚本4：面板与中介估计（DiD + 线性中介占位）"""
+"""脚本4：面板与中介估计（DiD + 线性中介，自助法推断）"""
 import pandas as pd
-from mobiodiv.models.did import run_did
-from mobiodiv.models.mediation import paramed_linear
+from mobiodiv.models.did import run_did, did_batch
+from mobiodiv.models.mediation import paramed_linear, mediation_bootstrap
 
 if __name__ == "__main__":
     # 生成一份模拟数据演示 DiD（真实项目请读取处理后的面板）
@@ -20,5 +20,15 @@ if __name__ == "__main__":
     did_res = run_did(df, y='y', treat='treat', post='post', fe_unit='unit', fe_time='year')
     print(did_res.summary)
 
+    # 批量估计：多个结局一次去均值、一起求解；事件研究（前导/滞后，基期 -1）
+    df['m_y'] = df['m'] + df['y']
+    print(did_batch(df, ['y', 'm', 'm_y'], fe_unit='unit', fe_time='year', treat='treat', post='post'))
+    print(did_batch(df, ['y'], fe_unit='unit', fe_time='year', treat='treat', post='post', event_window=(-3, 2)))
+
     med = paramed_linear(y=df['y'], x=df['treat'], m=df['m'])
     print("中介分解：", {k: round(v,4) if isinstance(v, (int,float)) else '...' for k,v in med.items() if k.endswith('effect')})
+
+    # 自助法中介推断（按单位整簇重抽样，BCa 区间），写出效应表
+    effects = mediation_bootstrap(df, treatment='treat', mediators=['m'], outcomes=['y'],
+                                  cluster='unit', n_boot=2000)
+    print(effects[['mediator', 'outcome', 'effect', 'estimate', 'ci_low', 'ci_high']])
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""增量运行脚本 00–06：输入、代码与参数均未变的阶段跳过，无依赖关系的阶段并行，失败后重跑从断点继续
+
+用法示例：
+  python scripts/run_pipeline.py                      # 01–06 全部（已是最新的阶段跳过）
+  python scripts/run_pipeline.py models --dry-run     # 查看重跑 models 需要运行哪些阶段
+  python scripts/run_pipeline.py --force models       # 强制重跑 models（下游按输入变化决定）
+  python scripts/run_pipeline.py fetch --place "Singapore" --buffer_km 20
+"""
+import argparse
+from mobiodiv.pipeline import STAGES, run_pipeline
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("targets", nargs="*", help=f"目标阶段（默认全部，不含 fetch）：{', '.join(STAGES)}")
+    parser.add_argument("--force", nargs="*", default=[], help="强制重跑的阶段")
+    parser.add_argument("--jobs", type=int, default=2, help="同时运行的阶段数")
+    parser.add_argument("--dry-run", action="store_true", help="只列出需要运行的阶段")
+    parser.add_argument("--place", type=str, default=None, help="fetch 阶段的地名（传给 00_fetch_open_data.py）")
+    parser.add_argument("--buffer_km", type=float, default=20, help="fetch 阶段的缓冲距离（km）")
+    args = parser.parse_args()
+
+    stage_args = {}
+    if args.place:
+        stage_args['fetch'] = ['--place', args.place, '--buffer_km', str(args.buffer_km)]
+    status = run_pipeline(args.targets or None, args=stage_args, force=args.force,
+                          jobs=args.jobs, dry_run=args.dry_run)
+    failed = [n for n, s in status.items() if s in ('failed', 'blocked')]
+    if failed:
+        print(f"未完成的阶段：{', '.join(failed)}；修复后重新运行即可从断点继续。")
+        raise SystemExit(1)
+    print("流水线完成。")
@@ -1,23 +1,339 @@
 # -*- coding: utf-8 -*-
-"""eBird EBD 读取与最简占据模型占位（基于 PyMC 的示例）"""
+"""eBird EBD 读取与占据模型（PyMC）：单物种示意模型与多物种层级（群落）占据模型"""
+import hashlib
+import json
+import os
+import shutil
+import time
 from pathlib import Path
 import pandas as pd
 import pymc as pm
+import pytensor.tensor as pt
 import numpy as np
-from ..config import FILES
+import shapely
+import pyarrow.compute as pc
+import pyarrow.dataset as pads
+from scipy import sparse
+from ..config import FILES, INTERIM_DIR, CRS_WGS84
+from ..utils.parquet import (tile_index, write_partitioned, bbox_expr, time_expr, and_exprs, read_partitioned,
+                             partitioning)
+from ..metrics.community import grid_site_index, unit_site_index
+from ..utils.io import file_hash, write_json
+from ..utils.profiling import profiled
 
-def load_ebd_tsv_gz(path: Path = FILES['ebird_ebd'], max_rows: int = 100000):
+EBD_USECOLS = [
+    'SAMPLING.EVENT.IDENTIFIER','COMMON.NAME','SCIENTIFIC.NAME','OBSERVATION.COUNT',
+    'LATITUDE','LONGITUDE','OBSERVATION.DATE','EFFORT.DISTANCE.KM','DURATION.MINUTES',
+    'ALL.OBSERVATIONS.REPORTED'
+]
+# 紧凑类型：重复字符串 → category，坐标/努力量 → float32
+# OBSERVATION.COUNT 含 'X'（仅记录到、未计数），先按字符串读入再转 float32（'X' → NaN）
+EBD_DTYPES = {
+    'SAMPLING.EVENT.IDENTIFIER': 'category',
+    'COMMON.NAME': 'category',
+    'SCIENTIFIC.NAME': 'category',
+    'OBSERVATION.COUNT': 'str',
+    'LATITUDE': 'float32',
+    'LONGITUDE': 'float32',
+    'OBSERVATION.DATE': 'str',
+    'EFFORT.DISTANCE.KM': 'float32',
+    'DURATION.MINUTES': 'float32',
+    'ALL.OBSERVATIONS.REPORTED': 'Int8',
+}
+EBD_PARQUET_DIR = INTERIM_DIR / 'ebd_parquet'
+DETECTION_DIR = INTERIM_DIR / 'ebd_detections'
+# 检测历史所需的列（物种按学名编码）
+DETECTION_COLS = ['SAMPLING.EVENT.IDENTIFIER', 'SCIENTIFIC.NAME', 'LATITUDE', 'LONGITUDE', 'OBSERVATION.DATE',
+                  'DURATION.MINUTES', 'EFFORT.DISTANCE.KM', 'ALL.OBSERVATIONS.REPORTED']
+
+@profiled()
+def load_ebd_tsv_gz(path: Path = FILES['ebird_ebd'], max_rows: int = None):
     """读取 eBird EBD（制表符分隔、gzip 压缩），仅载入必要列
-    注意：EBD 体量很大，请先用官方过滤器导出区域/时间窗口，再读取。
-    """
-    usecols = [
-        'SAMPLING.EVENT.IDENTIFIER','COMMON.NAME','SCIENTIFIC.NAME','OBSERVATION.COUNT',
-        'LATITUDE','LONGITUDE','OBSERVATION.DATE','EFFORT.DISTANCE.KM','DURATION.MINUTES',
-        'ALL.OBSERVATIONS.REPORTED'
-    ]
-    df = pd.read_csv(path, sep='\t', compression='gzip', usecols=usecols, nrows=max_rows)
+    注意：EBD 体量很大，max_rows=None 时读取全部行；大文件请先用 ingest_ebd_to_parquet
+    转为分区 Parquet，再用 read_ebd_parquet 按需读取。
+    """
+    df = pd.read_csv(path, sep='\t', compression='gzip', usecols=EBD_USECOLS, nrows=max_rows)
     return df
 
+def _filter_ebd_chunk(chunk: pd.DataFrame, bbox=None, start=None, end=None, species=None):
+    """在流式读取过程中对单个批次做 bbox/时间窗/物种过滤"""
+    keep = np.ones(len(chunk), dtype=bool)
+    if bbox is not None:
+        minx, miny, maxx, maxy = bbox
+        lon, lat = chunk['LONGITUDE'].to_numpy(), chunk['LATITUDE'].to_numpy()
+        keep &= (lon >= minx) & (lon <= maxx) & (lat >= miny) & (lat <= maxy)
+    if species is not None:
+        keep &= (chunk['SCIENTIFIC.NAME'].isin(species) | chunk['COMMON.NAME'].isin(species)).to_numpy()
+    chunk = chunk.loc[keep]
+    dates = pd.to_datetime(chunk['OBSERVATION.DATE'], format='%Y-%m-%d', errors='coerce')
+    keep = dates.notna().to_numpy()
+    if start is not None:
+        keep = keep & (dates >= pd.Timestamp(start)).to_numpy()
+    if end is not None:
+        keep = keep & (dates <= pd.Timestamp(end)).to_numpy()
+    chunk = chunk.loc[keep].copy()
+    chunk['OBSERVATION.DATE'] = dates[keep]
+    return chunk
+
+@profiled(records=lambda r: r[1])
+def ingest_ebd_to_parquet(path: Path = FILES['ebird_ebd'], out_dir: Path = EBD_PARQUET_DIR,
+                          bbox=None, start=None, end=None, species=None,
+                          chunksize: int = 1_000_000, tile_deg: float = 1.0, overwrite: bool = True):
+    """流式读取 EBD（gzip TSV），边读边过滤，并写为 年份/空间瓦片 分区的 Parquet
+    参数:
+      bbox: (minx, miny, maxx, maxy) WGS84
+      start/end: 日期窗口（闭区间，如 '2015-01-01'）
+      species: 物种列表（学名或俗名均可）
+      chunksize: 每批读取的行数（决定峰值内存）
+      tile_deg: 空间瓦片边长（度），分区字段为 tile_x/tile_y
+      overwrite: True 时重建整个数据集；False 时追加到已有数据集
+    返回:
+      (out_dir, 写出行数)
+    说明：overwrite=True 写完后在 out_dir/_ingest.json 记录源文件（路径 + 大小 + 修改时间）与过滤参数，
+      再次调用时二者一致则直接返回、不改动已有片段（下游 build_detection_store 据片段修改时间判断增量）；
+      片段文件名以 源文件+参数 的哈希为前缀，追加不同源文件不会覆盖已有片段，重复追加同一源文件则原样覆盖自身
+    """
+    out_dir = Path(out_dir)
+    species = None if species is None else list(species)
+    st = Path(path).stat()
+    marker_path = out_dir / '_ingest.json'
+    marker = {
+        'source': str(Path(path).resolve()), 'stamp': f'{st.st_size}:{st.st_mtime_ns}',
+        'params': {'bbox': None if bbox is None else [float(v) for v in bbox],
+                   'start': None if start is None else str(start), 'end': None if end is None else str(end),
+                   'species': species, 'chunksize': chunksize, 'tile_deg': tile_deg},
+    }
+    if overwrite and marker_path.exists():
+        prev = json.loads(marker_path.read_text(encoding='utf-8'))
+        if {k: prev.get(k) for k in marker} == marker:
+            return out_dir, prev['rows']
+    run_id = hashlib.sha1(json.dumps(marker, sort_keys=True).encode()).hexdigest()[:12]
+    if overwrite and out_dir.exists():
+        shutil.rmtree(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    # 追加写入后数据集不再对应单一源文件
+    marker_path.unlink(missing_ok=True)
+
+    reader = pd.read_csv(path, sep='\t', compression='gzip', usecols=EBD_USECOLS,
+                         dtype=EBD_DTYPES, chunksize=chunksize)
+    n_rows = 0
+    for i, chunk in enumerate(reader):
+        chunk = _filter_ebd_chunk(chunk, bbox=bbox, start=start, end=end, species=species)
+        if chunk.empty:
+            continue
+        chunk['OBSERVATION.COUNT'] = pd.to_numeric(chunk['OBSERVATION.COUNT'], errors='coerce').astype('float32')
+        # 去掉本批次中未出现的类别，减小每个文件的字典
+        for col in ('SAMPLING.EVENT.IDENTIFIER', 'COMMON.NAME', 'SCIENTIFIC.NAME'):
+            chunk[col] = chunk[col].cat.remove_unused_categories()
+        chunk['year'] = chunk['OBSERVATION.DATE'].dt.year.astype('int16')
+        chunk['tile_x'], chunk['tile_y'] = tile_index(chunk['LONGITUDE'], chunk['LATITUDE'], tile_deg)
+        write_partitioned(chunk, out_dir, basename=f'{run_id}-part-{i:05d}')
+        n_rows += len(chunk)
+    if overwrite:
+        # 全部批次写完后才落标记，中断的写入下次会重建
+        write_json(marker_path, {**marker, 'rows': n_rows})
+    return out_dir, n_rows
+
+@profiled()
+def read_ebd_parquet(root: Path = EBD_PARQUET_DIR, bbox=None, start=None, end=None, species=None,
+                     columns=None, tile_deg: float = 1.0):
+    """从分区 Parquet 读取 EBD 切片（分区裁剪 + 谓词下推，无需再次解压 TSV）
+    注意：tile_deg 需与写出时一致。
+    """
+    sp_expr = None
+    if species is not None:
+        species = list(species)
+        sp_expr = pc.field('SCIENTIFIC.NAME').isin(species) | pc.field('COMMON.NAME').isin(species)
+    expr = and_exprs(
+        bbox_expr(bbox, 'LONGITUDE', 'LATITUDE', tile_deg) if bbox is not None else None,
+        time_expr('OBSERVATION.DATE', start, end),
+        sp_expr,
+    )
+    return read_partitioned(root, columns=columns, filter=expr)
+
+def _site_spec(units=None, transform=None, shape=None):
+    """站点划分的描述（写入清单；变化时整库重建）"""
+    if units is not None:
+        wkb = b''.join(shapely.to_wkb(units.to_crs(CRS_WGS84).geometry.values))
+        return {'kind': 'units', 'n': len(units), 'sha1': hashlib.sha1(wkb).hexdigest()}
+    if transform is None or shape is None:
+        raise ValueError("需要给出 units（单元多边形）或 transform + shape（格网）")
+    return {'kind': 'grid', 'transform': list(transform)[:6], 'shape': list(shape)}
+
+def _detection_part(df: pd.DataFrame, species: dict, units=None, transform=None, shape=None):
+    """单个分区片段 → (清单表, 检测对 [清单行, 物种号])；新物种追加到 species 词表"""
+    codes, ids = pd.factorize(df['SAMPLING.EVENT.IDENTIFIER'].astype(str))
+    first = np.unique(codes, return_index=True)[1]
+    head = df.iloc[first]
+    lon, lat = head['LONGITUDE'].to_numpy(), head['LATITUDE'].to_numpy()
+    site = (unit_site_index(lon, lat, units) if units is not None
+            else grid_site_index(lon, lat, transform, shape))
+    checklists = pd.DataFrame({
+        'checklist': ids.astype(str),
+        'site': site,
+        'date': pd.to_datetime(head['OBSERVATION.DATE']).to_numpy(),
+        'lon': lon.astype('float32'), 'lat': lat.astype('float32'),
+        'duration_min': head['DURATION.MINUTES'].to_numpy(dtype='float32'),
+        'distance_km': head['EFFORT.DISTANCE.KM'].to_numpy(dtype='float32'),
+        # 同一清单各行取最大值：只要有一行标记为完整清单即视为完整
+        'complete': pd.Series(df['ALL.OBSERVATIONS.REPORTED'].fillna(0).to_numpy(dtype='int8'))
+                      .groupby(codes).max().to_numpy().astype(bool),
+    })
+    names = df['SCIENTIFIC.NAME'].astype(str).to_numpy()
+    uniq, inv = np.unique(names, return_inverse=True)
+    for name in uniq:
+        species.setdefault(name, len(species))
+    sp = np.array([species[n] for n in uniq], dtype=np.int32)[inv]
+    pairs = np.unique(np.stack([codes.astype(np.int64), sp], axis=1), axis=0).astype(np.int32)
+    return checklists, pairs
+
+@profiled()
+def build_detection_store(root: Path = EBD_PARQUET_DIR, out_dir: Path = DETECTION_DIR, units=None,
+                          transform=None, shape=None):
+    """由分区 EBD Parquet 增量构建紧凑的检测历史库
+    参数:
+      root: ingest_ebd_to_parquet 写出的分区数据集
+      units: 站点为分层单元（GeoDataFrame）时给出；或给出 transform + shape 按栅格格网划分站点
+    返回:
+      (out_dir, 本次新处理的片段数)
+    说明：每个 Parquet 片段独立处理为 part-<哈希>.parquet（清单表：站点、日期、努力量、是否完整）
+      与 part-<哈希>.npz（检测对 [清单行, 物种号]，即清单×物种稀疏矩阵的 COO 坐标）；
+      物种词表 species.json 只追加不重排，旧片段的物种号始终有效。manifest.json 按
+      路径 + 大小 + 修改时间（及内容哈希）记录已处理片段，重跑时只处理新增或内容变化的片段
+      （被原样重写、仅修改时间变化的片段只更新记录），删除的片段同步移除；
+      站点划分变化时整库重建。零填充不落盘：完整清单上未出现的物种即为未检测到
+    """
+    root, out_dir = Path(root), Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    spec = _site_spec(units, transform, shape)
+    man_path = out_dir / 'manifest.json'
+    manifest = json.loads(man_path.read_text(encoding='utf-8')) if man_path.exists() else {}
+    if manifest.get('sites') != spec:
+        for f in list(out_dir.glob('part-*')) + [out_dir / 'species.json']:
+            f.unlink(missing_ok=True)
+        manifest = {'sites': spec, 'fragments': {}}
+    sp_path = out_dir / 'species.json'
+    names = json.loads(sp_path.read_text(encoding='utf-8')) if sp_path.exists() else []
+    species = {n: i for i, n in enumerate(names)}
+    if units is not None:
+        units = units.to_crs(CRS_WGS84).reset_index(drop=True)
+
+    ds = pads.dataset(str(root), format='parquet', partitioning=partitioning())
+    seen, n_new = set(), 0
+    for frag in ds.get_fragments():
+        path = Path(frag.path)
+        st = path.stat()
+        stamp = f'{st.st_size}:{st.st_mtime_ns}'
+        key = hashlib.sha1(str(path.resolve()).encode()).hexdigest()[:16]
+        seen.add(key)
+        prev = manifest['fragments'].get(key, {})
+        if prev.get('stamp') == stamp:
+            continue
+        digest = file_hash(path, 'sha1')
+        if prev.get('sha1') == digest:
+            prev['stamp'] = stamp
+            continue
+        df = frag.to_table(columns=DETECTION_COLS).to_pandas()
+        if len(df):
+            checklists, pairs = _detection_part(df, species, units, transform, shape)
+            checklists.to_parquet(out_dir / f'part-{key}.parquet', index=False)
+            np.savez(out_dir / f'part-{key}.npz', pairs=pairs)
+        else:
+            for suffix in ('.parquet', '.npz'):
+                (out_dir / f'part-{key}{suffix}').unlink(missing_ok=True)
+        manifest['fragments'][key] = {'path': str(path), 'stamp': stamp, 'sha1': digest, 'rows': len(df)}
+        n_new += 1
+        # 每个片段完成后即落盘词表与清单，中断后可续跑
+        write_json(sp_path, list(species))
+        write_json(man_path, manifest)
+    for key in set(manifest['fragments']) - seen:
+        for suffix in ('.parquet', '.npz'):
+            (out_dir / f'part-{key}{suffix}').unlink(missing_ok=True)
+        del manifest['fragments'][key]
+    write_json(sp_path, list(species))
+    write_json(man_path, manifest)
+    return out_dir, n_new
+
+@profiled(records=lambda r: len(r[0]))
+def load_detection_store(out_dir: Path = DETECTION_DIR):
+    """读取检测历史库
+    返回:
+      (checklists, det, species)
+      checklists: 清单表（每个 SAMPLING.EVENT.IDENTIFIER 一行）
+      det: scipy.sparse.csr_matrix（bool，清单×物种，True=记录到）
+      species: 物种学名（det 的列）
+    说明：同一清单被 ingest 批次切分到多个片段时在此合并
+    """
+    out_dir = Path(out_dir)
+    species = json.loads((out_dir / 'species.json').read_text(encoding='utf-8'))
+    tables, rows, cols, offset = [], [], [], 0
+    for part in sorted(out_dir.glob('part-*.parquet')):
+        t = pd.read_parquet(part)
+        pairs = np.load(part.with_suffix('.npz'))['pairs']
+        tables.append(t)
+        rows.append(pairs[:, 0].astype(np.int64) + offset)
+        cols.append(pairs[:, 1])
+        offset += len(t)
+    if not tables:
+        return pd.DataFrame(), sparse.csr_matrix((0, len(species)), dtype=bool), species
+    allc = pd.concat(tables, ignore_index=True)
+    codes, ids = pd.factorize(allc['checklist'])
+    first = np.unique(codes, return_index=True)[1]
+    checklists = allc.iloc[first].reset_index(drop=True)
+    checklists['complete'] = allc['complete'].groupby(codes).max().to_numpy()
+    rows = codes[np.concatenate(rows)]
+    cols = np.concatenate(cols)
+    det = sparse.csr_matrix((np.ones(len(rows), dtype=bool), (rows, cols)), shape=(len(checklists), len(species)))
+    return checklists, det, species
+
+@profiled(pixels=lambda r: r[0].size)
+def detection_tensor(checklists: pd.DataFrame, det, species=None, max_visits: int = 10,
+                     complete_only: bool = True, start=None, end=None):
+    """清单表 + 稀疏检测矩阵 → 占据模型的 站点×访问×物种 数组
+    参数:
+      species: 物种列号（或学名需先转换为列号）列表；默认全部
+      max_visits: 每个站点保留的最多访问次数（按日期取最早的若干次）
+      complete_only: 只用完整清单（否则未报告物种的“未检测”不可信）
+      start/end: 日期窗口（闭区间）
+    返回:
+      (y, effort, site_ids)
+      y: (站点, 访问, 物种) float 数组，1/0，缺失访问为 NaN（可直接传入 community_occupancy_model）
+      effort: (站点, 访问, 2)，[log1p(时长分钟), log1p(距离 km)] 的 z 分数；定点观测距离记 0
+      site_ids: 每个站点对应的站点号
+    """
+    keep = (checklists['site'].to_numpy() >= 0)
+    if complete_only:
+        keep &= checklists['complete'].to_numpy(dtype=bool)
+    dates = pd.to_datetime(checklists['date'])
+    if start is not None:
+        keep &= (dates >= pd.Timestamp(start)).to_numpy()
+    if end is not None:
+        keep &= (dates <= pd.Timestamp(end)).to_numpy()
+    rows = np.flatnonzero(keep)
+    sub = checklists.iloc[rows]
+    order = np.lexsort((dates.to_numpy()[rows], sub['site'].to_numpy()))
+    rows = rows[order]
+    site_codes, site_ids = pd.factorize(checklists['site'].to_numpy()[rows])
+    visit = pd.Series(np.arange(len(rows))).groupby(site_codes).cumcount().to_numpy()
+    ok = visit < max_visits
+    rows, site_codes, visit = rows[ok], site_codes[ok], visit[ok]
+    S, J = len(site_ids), int(visit.max()) + 1 if len(visit) else 0
+    cols = np.arange(det.shape[1]) if species is None else np.asarray(species)
+
+    y = np.full((S, J, len(cols)), np.nan)
+    y[site_codes, visit] = 0.0
+    sub = det[rows][:, cols].tocoo()
+    y[site_codes[sub.row], visit[sub.row], sub.col] = 1.0
+
+    dur = np.log1p(checklists['duration_min'].to_numpy(dtype='float64')[rows])
+    dist = np.log1p(np.nan_to_num(checklists['distance_km'].to_numpy(dtype='float64')[rows]))
+    dur = np.where(np.isfinite(dur), dur, np.nanmedian(dur) if len(dur) else 0.0)
+    effort = np.zeros((S, J, 2))
+    for k, v in enumerate((dur, dist)):
+        sd = v.std() or 1.0
+        effort[site_codes, visit, k] = (v - v.mean()) / sd
+    return y, effort, np.asarray(site_ids)
+
 def toy_occupancy_model(y, effort):
     """极简占据-检测模型（示意）：psi 为占据概率，p 为检测概率
     y: 二值观测（1=记录到该物种，0=未记录到）
@@ -37,3 +353,157 @@ def toy_occupancy_model(y, effort):
 
         idata = pm.sample(1000, tune=1000, target_accept=0.9, chains=2, progressbar=False)
     return idata
+
+def _as_3d(x, shape):
+    """努力量协变量 → (站点, 访问, 协变量数)"""
+    x = np.asarray(x, dtype=np.float64)
+    if x.ndim == 2:
+        x = x[..., None]
+    if x.shape[:2] != shape:
+        raise ValueError(f"协变量形状 {x.shape} 与检测数组的 站点×访问 {shape} 不一致")
+    return x
+
+def community_occupancy_model(y, effort=None, site_covs=None, mask=None):
+    """多物种层级占据模型（物种随机效应，边缘化潜在占据状态）
+    参数:
+      y: 检测数组 (站点, 访问, 物种)，1=记录到，0=未记录到；NaN 视为缺失访问
+      effort: 访问层面的努力量协变量 (站点, 访问) 或 (站点, 访问, q)，如已标准化的时长/距离
+      site_covs: 站点层面的占据协变量 (站点, r)，如已标准化的生境比例
+      mask: (站点, 访问) 布尔数组，True 为有效访问；默认由 y 的 NaN 推断
+    返回:
+      pm.Model
+    说明：logit ψ_ik = α0_k + x_i·α_k，logit p_ijk = β0_k + w_ij·β_k，截距与斜率均为物种随机效应
+      （非中心化参数化）；似然对 z 边缘化：检测到过 → ψ·Πp^y(1-p)^(1-y)，从未检测到 → ψ·Π(1-p) + (1-ψ)
+    """
+    y = np.asarray(y, dtype=np.float64)
+    if y.ndim != 3:
+        raise ValueError("y 须为 (站点, 访问, 物种) 三维数组")
+    S, J, N = y.shape
+    if mask is None:
+        mask = np.isfinite(y).all(axis=2)
+    mask = np.asarray(mask, dtype=bool)
+    y = np.where(mask[..., None] & np.isfinite(y), y, 0.0)
+    w = _as_3d(effort, (S, J)) if effort is not None else np.zeros((S, J, 0))
+    w = np.where(mask[..., None], w, 0.0)
+    x = np.asarray(site_covs, dtype=np.float64).reshape(S, -1) if site_covs is not None else np.zeros((S, 0))
+    q, r = w.shape[2], x.shape[1]
+
+    # 与参数无关的充分统计量预先算好：Σ_j y·logit p = β0·d + (Σ_j y·w)·β
+    det = y.sum(axis=1)                             # (S, N) 检测次数
+    yw = np.einsum('sjn,sjq->snq', y, w)           # (S, N, q)
+    detected = det > 0
+    coords = {'species': np.arange(N), 'psi_cov': np.arange(r), 'p_cov': np.arange(q)}
+    with pm.Model(coords=coords) as model:
+        # 群落层（超参数）
+        mu_a0 = pm.Normal('mu_a0', 0, 1.5)
+        mu_b0 = pm.Normal('mu_b0', 0, 1.5)
+        sd_a0 = pm.HalfNormal('sd_a0', 1.5)
+        sd_b0 = pm.HalfNormal('sd_b0', 1.5)
+        a0 = pm.Deterministic('a0', mu_a0 + sd_a0 * pm.Normal('a0_z', 0, 1, dims='species'), dims='species')
+        b0 = pm.Deterministic('b0', mu_b0 + sd_b0 * pm.Normal('b0_z', 0, 1, dims='species'), dims='species')
+        logit_psi = pt.zeros((S, N)) + a0[None, :]
+        logit_p = pt.zeros((S, J, N)) + b0[None, None, :]
+        sum_y_eta = det * b0[None, :]
+        if r:
+            mu_a = pm.Normal('mu_a', 0, 1, dims='psi_cov')
+            sd_a = pm.HalfNormal('sd_a', 1, dims='psi_cov')
+            a = pm.Deterministic('a', mu_a[:, None] + sd_a[:, None] * pm.Normal('a_z', 0, 1, dims=('psi_cov', 'species')),
+                                 dims=('psi_cov', 'species'))
+            logit_psi = logit_psi + pt.dot(x, a)
+        if q:
+            mu_b = pm.Normal('mu_b', 0, 1, dims='p_cov')
+            sd_b = pm.HalfNormal('sd_b', 1, dims='p_cov')
+            b = pm.Deterministic('b', mu_b[:, None] + sd_b[:, None] * pm.Normal('b_z', 0, 1, dims=('p_cov', 'species')),
+                                 dims=('p_cov', 'species'))
+            logit_p = logit_p + pt.tensordot(w, b, axes=[[2], [0]])
+            sum_y_eta = sum_y_eta + (yw * b.T[None, :, :]).sum(axis=2)
+        # log Π p^y (1-p)^(1-y) = Σ_j [y·η - softplus(η)]（仅有效访问）
+        loglik_det = sum_y_eta - (pt.softplus(logit_p) * mask[..., None]).sum(axis=1)
+        log_psi = -pt.softplus(-logit_psi)
+        log_1m_psi = -pt.softplus(logit_psi)
+        ll = pt.switch(detected, log_psi + loglik_det, pt.logaddexp(log_psi + loglik_det, log_1m_psi))
+        pm.Potential('loglik', ll.sum())
+        pm.Deterministic('psi_sp', pm.math.sigmoid(a0), dims='species')
+        pm.Deterministic('p_sp', pm.math.sigmoid(b0), dims='species')
+    return model
+
+@profiled()
+def fit_occupancy(model, method: str = 'map', draws: int = 1000, tune: int = 1000, chains: int = 4,
+                  cores: int = None, advi_iter: int = 20000, seed: int = 0):
+    """拟合群落占据模型
+    参数:
+      method: 'map'（后验众数，最快，用于初筛）、'advi'（平均场变分近似）或 'nuts'（完整 MCMC）
+      draws/tune/chains: NUTS 的抽样设置；ADVI 时 draws 为从近似后验抽取的样本数
+      cores: NUTS 并行的进程数（默认 min(chains, CPU 核数)）
+    返回:
+      method='map' 时为参数点估计字典，否则为 InferenceData
+    """
+    with model:
+        if method == 'map':
+            return pm.find_MAP(progressbar=False, seed=seed)
+        if method == 'advi':
+            approx = pm.fit(advi_iter, method='advi', random_seed=seed, progressbar=False,
+                            callbacks=[pm.callbacks.CheckParametersConvergence(tolerance=1e-3)])
+            return approx.sample(draws, random_seed=seed)
+        if method == 'nuts':
+            return pm.sample(draws, tune=tune, chains=chains, cores=cores or min(chains, os.cpu_count()),
+                             target_accept=0.9, random_seed=seed, progressbar=False)
+    raise ValueError("method 只支持 'map'、'advi' 或 'nuts'")
+
+def occupancy_summary(result, species=None):
+    """各物种的占据概率与检测概率（协变量取均值时）
+    返回:
+      DataFrame：psi、p（点估计或后验均值）；后验结果另含 2.5%/97.5% 分位数
+    """
+    if isinstance(result, dict):
+        out = pd.DataFrame({'psi': np.asarray(result['psi_sp']), 'p': np.asarray(result['p_sp'])})
+    else:
+        post = result.posterior
+        cols = {}
+        for var, name in (('psi_sp', 'psi'), ('p_sp', 'p')):
+            v = post[var].stack(sample=('chain', 'draw')).values
+            cols[name] = v.mean(axis=1)
+            cols[f'{name}_q025'] = np.quantile(v, 0.025, axis=1)
+            cols[f'{name}_q975'] = np.quantile(v, 0.975, axis=1)
+        out = pd.DataFrame(cols)
+    if species is not None:
+        out.index = pd.Index(species, name='species')
+    return out
+
+def simulate_community(n_sites: int = 200, n_visits: int = 5, n_species: int = 50, seed: int = 0):
+    """按群落占据模型模拟检测数组（用于检验与基准测试）
+    返回:
+      (y, effort, site_covs, 真值字典 psi/p)
+    """
+    rng = np.random.default_rng(seed)
+    x = rng.normal(size=(n_sites, 1))
+    w = rng.normal(size=(n_sites, n_visits))
+    a0 = rng.normal(-0.3, 1.0, n_species)
+    a1 = rng.normal(0.5, 0.5, n_species)
+    b0 = rng.normal(-0.8, 0.8, n_species)
+    b1 = rng.normal(0.4, 0.3, n_species)
+    psi = 1 / (1 + np.exp(-(a0 + x * a1)))
+    z = rng.random((n_sites, n_species)) < psi
+    p = 1 / (1 + np.exp(-(b0 + w[..., None] * b1)))
+    y = (rng.random((n_sites, n_visits, n_species)) < p) & z[:, None, :]
+    truth = {'psi': 1 / (1 + np.exp(-a0)), 'p': 1 / (1 + np.exp(-b0))}
+    return y.astype(np.float64), w, x, truth
+
+def benchmark_occupancy(n_species=(10, 50, 200), methods=('map', 'advi'), n_sites: int = 200,
+                        n_visits: int = 5, seed: int = 0, **fit_kwargs):
+    """占据模型基准：不同物种数 × 推断方式的耗时（含模型构建与编译）
+    返回:
+      DataFrame：method, n_species, seconds, seconds_per_species, psi_mae, p_mae（相对模拟真值）
+    """
+    rows = []
+    for n in n_species:
+        y, w, x, truth = simulate_community(n_sites, n_visits, n, seed)
+        for method in methods:
+            t0 = time.perf_counter()
+            res = fit_occupancy(community_occupancy_model(y, w, x), method=method, seed=seed, **fit_kwargs)
+            sec = time.perf_counter() - t0
+            est = occupancy_summary(res)
+            rows.append({'method': method, 'n_species': n, 'seconds': sec, 'seconds_per_species': sec / n,
+                         'psi_mae': float(np.abs(est['psi'] - truth['psi']).mean()),
+                         'p_mae': float(np.abs(est['p'] - truth['p']).mean())})
+    return pd.DataFrame(rows)
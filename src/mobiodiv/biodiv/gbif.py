@@ -1,13 +1,43 @@
 # -*- coding: utf-8 -*-
 """GBIF 物种记录下载与栅格聚合（示例）"""
+import hashlib
+import os
+import shutil
+import warnings
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from pathlib import Path
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import Point
-from ..config import FILES, CRS_WGS84
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import shapely
+from shapely.geometry import Point, box
+from shapely.geometry.polygon import orient
+from pygbif import occurrences as gbif_occ
+from ..config import FILES, INTERIM_DIR, CRS_WGS84
+from ..utils.parquet import tile_index, write_partitioned, bbox_expr, time_expr, and_exprs, read_partitioned
+from ..utils.io import call_with_retry
+from ..utils.profiling import profiled
 
+# 列式存储保留的字段（源文件中不存在的字段自动忽略）
+GBIF_USECOLS = ['species', 'eventDate', 'decimalLatitude', 'decimalLongitude',
+                'occurrenceID', 'basisOfRecord', 'datasetKey']
+GBIF_PARQUET_DIR = INTERIM_DIR / 'gbif_parquet'
+
+# GBIF 检索 API 限制：单页最多 300 条，offset + limit 不超过 100000
+GBIF_PAGE_LIMIT = 300
+GBIF_OFFSET_CAP = 100_000
+# API 拉取时保留的字段（统一为字符串，坐标为 float64，保证各批次 schema 一致）
+GBIF_API_FIELDS = ['key', 'occurrenceID', 'scientificName', 'species', 'decimalLatitude', 'decimalLongitude',
+                   'eventDate', 'year', 'basisOfRecord', 'datasetKey']
+GBIF_API_SCHEMA = pa.schema([(c, pa.float64() if c.startswith('decimal') else pa.string()) for c in GBIF_API_FIELDS])
+
+@profiled()
 def load_gbif_occ(csv_path: Path = FILES['gbif_occ']):
-    """读取 GBIF 导出的 CSV（请在官网或 API 申请并下载），并转为 GeoDataFrame"""
+    """读取 GBIF 导出的 CSV（请在官网或 API 申请并下载），并转为 GeoDataFrame
+    注意：每次调用都会完整解析 CSV；大文件请先 convert_gbif_to_parquet，再用 query_gbif 按需读取。
+    """
     df = pd.read_csv(csv_path)
     df = df.dropna(subset=['decimalLatitude', 'decimalLongitude'])
     gdf = gpd.GeoDataFrame(
@@ -16,3 +46,214 @@ def load_gbif_occ(csv_path: Path = FILES['gbif_occ']):
         crs=CRS_WGS84
     )
     return gdf[['species', 'eventDate', 'geometry']]
+
+def _parse_event_date(s: pd.Series) -> pd.Series:
+    """解析 DwC eventDate：区间取起点（'2019-05-01/2019-05-03'），支持 年/年-月/年-月-日"""
+    head = s.astype('str').str.split('/').str[0].str.slice(0, 10)
+    return pd.to_datetime(head, format='ISO8601', errors='coerce')
+
+@profiled(records=lambda r: r[1])
+def convert_gbif_to_parquet(csv_path: Path = FILES['gbif_occ'], out_dir: Path = GBIF_PARQUET_DIR,
+                            sep: str = ',', chunksize: int = 1_000_000, tile_deg: float = 1.0):
+    """一次性把 GBIF CSV / DwC-A occurrence.txt（sep='\\t'）转为 年份/空间瓦片 分区的列式存储
+    说明：
+      - 分批读取，坐标存为 float32，species 等重复字符串存为 category
+      - 无有效日期的记录 year=-1（带时间窗的查询会自动排除）
+      - 完成后写入 _SUCCESS 标记，gbif_store 据此判断是否需要重建
+    返回:
+      (out_dir, 写出行数)
+    """
+    out_dir = Path(out_dir)
+    if out_dir.exists():
+        shutil.rmtree(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    # 片段名前缀：源文件（路径+大小+修改时间）的哈希，不同来源写入同一目录时互不覆盖
+    st = Path(csv_path).stat()
+    run_id = hashlib.sha1(f'{Path(csv_path).resolve()}:{st.st_size}:{st.st_mtime_ns}'.encode()).hexdigest()[:12]
+
+    reader = pd.read_csv(csv_path, sep=sep, usecols=lambda c: c in GBIF_USECOLS,
+                         dtype={'decimalLatitude': 'float32', 'decimalLongitude': 'float32'},
+                         chunksize=chunksize, on_bad_lines='skip')
+    n_rows = 0
+    for i, chunk in enumerate(reader):
+        chunk = chunk.dropna(subset=['decimalLatitude', 'decimalLongitude'])
+        if chunk.empty:
+            continue
+        for col in ('species', 'basisOfRecord', 'datasetKey'):
+            if col in chunk:
+                chunk[col] = chunk[col].astype('category')
+        chunk['eventDate'] = _parse_event_date(chunk['eventDate'])
+        chunk['year'] = chunk['eventDate'].dt.year.fillna(-1).astype('int16')
+        chunk['tile_x'], chunk['tile_y'] = tile_index(chunk['decimalLongitude'], chunk['decimalLatitude'], tile_deg)
+        write_partitioned(chunk, out_dir, basename=f'{run_id}-part-{i:05d}')
+        n_rows += len(chunk)
+    (out_dir / '_SUCCESS').write_text(f'{n_rows}\n')
+    return out_dir, n_rows
+
+def gbif_store(csv_path: Path = FILES['gbif_occ'], out_dir: Path = GBIF_PARQUET_DIR, **kwargs):
+    """返回列式存储目录；若尚未转换或源文件更新过，则先转换"""
+    marker = Path(out_dir) / '_SUCCESS'
+    if not marker.exists() or marker.stat().st_mtime < Path(csv_path).stat().st_mtime:
+        convert_gbif_to_parquet(csv_path, out_dir, **kwargs)
+    return Path(out_dir)
+
+@profiled()
+def query_gbif(root: Path = GBIF_PARQUET_DIR, bbox=None, polygon=None, start=None, end=None,
+               species=None, columns=None, as_geodataframe: bool = False, tile_deg: float = 1.0):
+    """按 bbox/多边形/时间窗/物种列表 查询 GBIF 列式存储
+    参数:
+      polygon: shapely 多边形（WGS84）；以其外包框做分区裁剪，再做精确的点在面内判断
+      columns: 需要的字段（默认全部）；坐标列总会读取
+      as_geodataframe: True 时才构造点几何，否则返回带 decimalLongitude/decimalLatitude 坐标数组的 DataFrame
+      tile_deg: 需与转换时一致
+    """
+    if polygon is not None:
+        pb = polygon.bounds
+        bbox = pb if bbox is None else (max(bbox[0], pb[0]), max(bbox[1], pb[1]),
+                                        min(bbox[2], pb[2]), min(bbox[3], pb[3]))
+    expr = and_exprs(
+        bbox_expr(bbox, 'decimalLongitude', 'decimalLatitude', tile_deg) if bbox is not None else None,
+        time_expr('eventDate', start, end),
+        pc.field('species').isin(list(species)) if species is not None else None,
+    )
+    if columns is not None:
+        columns = list(dict.fromkeys(list(columns) + ['decimalLongitude', 'decimalLatitude']))
+    df = read_partitioned(root, columns=columns, filter=expr)
+
+    if polygon is not None and len(df):
+        inside = shapely.contains_xy(polygon, df['decimalLongitude'].to_numpy(), df['decimalLatitude'].to_numpy())
+        df = df.loc[inside].reset_index(drop=True)
+    if as_geodataframe:
+        return gpd.GeoDataFrame(
+            df,
+            geometry=gpd.points_from_xy(df['decimalLongitude'], df['decimalLatitude']),
+            crs=CRS_WGS84
+        )
+    return df
+
+def _gbif_wkt(geom, tolerance: float = 1e-4) -> str:
+    """GBIF 要求逆时针外环的 WKT；先轻度简化，避免 URL 过长"""
+    geom = geom.simplify(tolerance, preserve_topology=True)
+    if geom.geom_type == 'Polygon':
+        geom = orient(geom, 1.0)
+    elif geom.geom_type == 'MultiPolygon':
+        geom = shapely.MultiPolygon([orient(g, 1.0) for g in geom.geoms])
+    return geom.wkt
+
+def plan_gbif_tiles(polygon, search=None, cap: int = GBIF_OFFSET_CAP, max_depth: int = 12, **params):
+    """把研究区多边形按四叉树切分，使每块的记录数不超过 API 的 offset 上限
+    返回:
+      [(wkt, count), ...]（count 为 0 的块被丢弃）
+    说明：达到 max_depth 仍超过 cap 的块只能取到前 cap 条，发出警告并报告被截断的记录数
+    """
+    search = search or gbif_occ.search
+    plan = []
+    n_truncated, dropped = 0, 0
+    stack = [(polygon, 0)]
+    while stack:
+        geom, depth = stack.pop()
+        if geom.is_empty:
+            continue
+        wkt = _gbif_wkt(geom)
+        count = call_with_retry(search, geometry=wkt, limit=0, **params).get('count', 0)
+        if count == 0:
+            continue
+        if count <= cap or depth >= max_depth:
+            if count > cap:
+                n_truncated += 1
+                dropped += count - cap
+            plan.append((wkt, count))
+            continue
+        minx, miny, maxx, maxy = geom.bounds
+        midx, midy = (minx + maxx) / 2, (miny + maxy) / 2
+        for q in (box(minx, miny, midx, midy), box(midx, miny, maxx, midy),
+                  box(minx, midy, midx, maxy), box(midx, midy, maxx, maxy)):
+            stack.append((geom.intersection(q), depth + 1))
+    if n_truncated:
+        warnings.warn(f"{n_truncated} 个块在最大切分深度 {max_depth} 处仍超过 {cap} 条记录，"
+                      f"共 {dropped} 条记录无法通过检索 API 取得（可增大 max_depth，或改用 GBIF 下载服务）")
+    return plan
+
+def _fetch_page(search, wkt, offset, limit, params):
+    out = call_with_retry(search, geometry=wkt, limit=limit, offset=offset, **params)
+    return out.get('results', [])
+
+def _records_to_table(records) -> pa.Table:
+    df = pd.DataFrame.from_records(records)
+    cols = {}
+    for c in GBIF_API_FIELDS:
+        col = df[c] if c in df else pd.Series([None] * len(df), dtype='object')
+        if c.startswith('decimal'):
+            cols[c] = pd.to_numeric(col, errors='coerce').astype('float64')
+        else:
+            cols[c] = col.astype('object').where(col.notna(), None).map(lambda v: v if v is None else str(v))
+    return pa.Table.from_pandas(pd.DataFrame(cols), schema=GBIF_API_SCHEMA, preserve_index=False)
+
+@profiled(records=lambda r: r[1])
+def fetch_gbif_to_parquet(polygon, out_path: Path, search=None, max_workers: int = 4,
+                          batch_rows: int = 50_000, cap: int = GBIF_OFFSET_CAP, **params):
+    """按研究区多边形分块、分页并发拉取 GBIF 记录，去重后流式写入单个 Parquet
+    参数:
+      polygon: 研究区多边形（WGS84），以 WKT geometry 参数传给 API（而非外包框）
+      search: 检索函数（默认 pygbif.occurrences.search；测试时可替换为录制/本地模拟 API）
+      max_workers: 同时在途的请求数
+      batch_rows: 累积多少条写一个行组（内存中最多保留约一个批次）
+      cap: 单块记录数上限（API 的 offset 上限），超过则继续切分
+      params: 其他检索条件，如 scientificName='Aves'、hasCoordinate=True、year='2015,2020'
+    说明：按 occurrenceID（缺失时用 GBIF key）去重，块边界上的重复记录只保留一次；
+      每个请求遇临时性网络错误按退避重试（utils.io.call_with_retry）；先写 <名>.tmp.parquet，
+      全部页成功后才替换 out_path，失败时删除临时文件，不会留下被截断但格式有效的 Parquet
+    返回:
+      (out_path, 写出记录数)
+    """
+    search = search or gbif_occ.search
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    cap = min(cap, GBIF_OFFSET_CAP)
+    plan = plan_gbif_tiles(polygon, search=search, cap=cap, **params)
+    # 每页满足 offset + limit ≤ cap，最后一页按剩余条数缩小 limit
+    pages = [(wkt, off, min(GBIF_PAGE_LIMIT, end - off)) for wkt, count in plan
+             for end in (min(count, cap),)
+             for off in range(0, end, GBIF_PAGE_LIMIT)]
+
+    seen = set()
+    buffer = []
+    n_rows = 0
+    tmp_path = out_path.with_suffix('.tmp.parquet')
+    writer = pq.ParquetWriter(tmp_path, GBIF_API_SCHEMA)
+    ok = False
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            pending = set()
+            todo = iter(pages)
+            while True:
+                # 有界提交：在途请求不超过 2×max_workers，结果随到随写
+                for wkt, off, limit in todo:
+                    pending.add(ex.submit(_fetch_page, search, wkt, off, limit, params))
+                    if len(pending) >= 2 * max_workers:
+                        break
+                if not pending:
+                    break
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    for rec in fut.result():
+                        rid = rec.get('occurrenceID') or f"key:{rec.get('key')}"
+                        if rid in seen:
+                            continue
+                        seen.add(rid)
+                        buffer.append(rec)
+                if len(buffer) >= batch_rows:
+                    writer.write_table(_records_to_table(buffer))
+                    n_rows += len(buffer)
+                    buffer = []
+        if buffer:
+            writer.write_table(_records_to_table(buffer))
+            n_rows += len(buffer)
+        ok = True
+    finally:
+        writer.close()
+        if ok:
+            os.replace(tmp_path, out_path)
+        else:
+            tmp_path.unlink(missing_ok=True)
+    return out_path, n_rows
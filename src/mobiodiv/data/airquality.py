@@ -1,25 +1,191 @@
 # -*- coding: utf-8 -*-
 """空气污染（NO2/PM2.5）读取与标准化（占位示例）"""
 from pathlib import Path
+import dask
+import dask.array as dsa
+import rasterio
 import rioxarray as rxr
 import xarray as xr
 import numpy as np
+from rasterio.enums import Resampling
+from rasterio.vrt import WarpedVRT
 from ..config import FILES, CRS_WGS84
+from ..utils.raster_cache import cached_reproject, target_grid
+from ..utils.profiling import profiled
 
-def load_no2(no2_path: Path = FILES['no2']):
-    """读取 NO2 格网（例如 TROPOMI 的年度或多年月均合成）"""
+@profiled()
+def open_aligned(path: Path, like: xr.DataArray = None, chunks=None, resampling=Resampling.bilinear,
+                 use_cache: bool = True):
+    """读取栅格并对齐到参考格网（like 的 CRS/transform/shape）；like 为 None 时仅重投影到 WGS84
+    说明：
+      - use_cache=True：对齐结果写入内容寻址缓存（utils.raster_cache），重复运行直接读取缓存 COG
+      - use_cache=False：通过 WarpedVRT 由 GDAL 按块重投影，每块只读对应源窗口
+      - chunks 非 None 时返回惰性 dask 数组；masked=True：nodata 统一转为 NaN，后续统计自动忽略
+    """
+    if use_cache:
+        cached = cached_reproject(path, CRS_WGS84, like=like, resampling=resampling)
+        return rxr.open_rasterio(cached, chunks=chunks, masked=True, lock=False).squeeze()
+    with rasterio.open(path) as src:
+        with WarpedVRT(src, resampling=resampling, **target_grid(src, CRS_WGS84, like=like)) as vrt:
+            da = rxr.open_rasterio(vrt, chunks=chunks, masked=True, lock=False).squeeze()
+    return da
+
+def load_no2(no2_path: Path = FILES['no2'], like: xr.DataArray = None, chunks=None, use_cache: bool = True):
+    """读取 NO2 格网（例如 TROPOMI 的年度或多年月均合成）
+    like/chunks 非 None 时对齐到参考格网并分块惰性读取（见 open_aligned）
+    """
+    if use_cache or like is not None or chunks is not None:
+        return open_aligned(no2_path, like=like, chunks=chunks, use_cache=use_cache)
     da = rxr.open_rasterio(no2_path).squeeze().rio.reproject(CRS_WGS84)
     return da
 
-def load_pm25(pm25_path: Path = FILES['pm25']):
+def load_pm25(pm25_path: Path = FILES['pm25'], like: xr.DataArray = None, chunks=None, use_cache: bool = True):
+    if use_cache or like is not None or chunks is not None:
+        return open_aligned(pm25_path, like=like, chunks=chunks, use_cache=use_cache)
     da = rxr.open_rasterio(pm25_path).squeeze().rio.reproject(CRS_WGS84)
     return da
 
-def standardize_layers(*arrays):
-    """对多层指标做标准化（z-score），便于构建 “干扰指数”"""
-    std_layers = []
+def _same_grid(da: xr.DataArray, like: xr.DataArray) -> bool:
+    return (da.rio.crs == like.rio.crs and da.rio.shape == like.rio.shape
+            and np.allclose(tuple(da.rio.transform()), tuple(like.rio.transform())))
+
+def _mask_nodata(da: xr.DataArray) -> xr.DataArray:
+    """把数值型 nodata（如 -9999）转为 NaN；已为 NaN 或未设置时原样返回"""
+    nodata = da.rio.nodata
+    if nodata is not None and not np.isnan(nodata):
+        da = da.where(da != nodata).rio.write_nodata(np.nan, encoded=False)
+    return da
+
+def align_layers(*arrays, like: xr.DataArray = None, resampling=Resampling.bilinear):
+    """把各层对齐到同一参考格网（默认第一层）；已对齐的层原样返回
+    nodata 先转为 NaN（避免 -9999 等参与重采样与统计）
+    说明：
+      - 格网不同的 dask 层若来自文件（encoding['source']），改经 open_aligned 由 GDAL 按块重投影，
+        保持惰性且沿用原分块
+      - rio.reproject_match 会把整幅 dask 数组读入内存，故无源文件的 dask 层直接报错，
+        请先写盘或用 open_aligned(path, like=...) 读取；内存数组仍用 reproject_match
+    """
+    like = arrays[0] if like is None else like
+    out = []
     for da in arrays:
-        mu = float(da.mean().values)
-        sigma = float(da.std().values)
+        if not _same_grid(da, like):
+            if isinstance(da.data, dsa.Array):
+                source = da.encoding.get('source')
+                if not source or not Path(source).exists():
+                    raise ValueError("dask 图层与参考格网不一致且无源文件，无法分块对齐；"
+                                     "请用 open_aligned(path, like=...) 读取该图层")
+                chunks = {'y': da.chunks[-2][0], 'x': da.chunks[-1][0]}
+                da = open_aligned(Path(source), like=like, chunks=chunks, resampling=resampling)
+            else:
+                da = _mask_nodata(da).rio.reproject_match(like, resampling=resampling)
+        out.append(_mask_nodata(da))
+    return out
+
+def _chunk_moments(block):
+    """单块的 (有效像元数, 均值, 离差平方和, 最小值, 最大值)，忽略 NaN/inf"""
+    x = np.asarray(block, dtype='float64')
+    x = x[np.isfinite(x)]
+    if x.size == 0:
+        return 0, 0.0, 0.0, np.inf, -np.inf
+    mu = x.mean()
+    return x.size, mu, float(((x - mu) ** 2).sum()), x.min(), x.max()
+
+def _merge_moments(a, b):
+    """合并两组分块矩（Chan 等并行方差算法）"""
+    na, ma, m2a, lo_a, hi_a = a
+    nb, mb, m2b, lo_b, hi_b = b
+    n = na + nb
+    if n == 0:
+        return a
+    delta = mb - ma
+    mean = ma + delta * nb / n
+    m2 = m2a + m2b + delta * delta * na * nb / n
+    return n, mean, m2, min(lo_a, lo_b), max(hi_a, hi_b)
+
+def _moments(da: xr.DataArray):
+    """单次遍历：各 dask 块并行求矩，再两两合并；非 dask 数组视为一个块"""
+    data = da.data
+    if isinstance(data, dsa.Array):
+        parts = dask.compute(*[dask.delayed(_chunk_moments)(b) for b in data.to_delayed().ravel()])
+    else:
+        parts = [_chunk_moments(data)]
+    acc = (0, 0.0, 0.0, np.inf, -np.inf)
+    for p in parts:
+        acc = _merge_moments(acc, p)
+    return acc
+
+def _hist_quantile(counts, edges, q):
+    """由直方图线性插值求分位数"""
+    cum = np.cumsum(counts)
+    target = q * cum[-1]
+    i = int(np.searchsorted(cum, target))
+    prev = cum[i - 1] if i > 0 else 0
+    frac = (target - prev) / counts[i] if counts[i] > 0 else 0.0
+    return edges[i] + frac * (edges[i + 1] - edges[i])
+
+@profiled()
+def layer_stats(da: xr.DataArray, robust: bool = False, bins: int = 16384):
+    """掩膜（忽略 NaN）统计，按 dask 块流式计算，不整体载入内存
+    返回:
+      dict：count、mean、std、min、max；robust=True 时另含 median、mad、iqr
+      （均由固定分箱直方图求得，误差不超过 (max-min)/bins；mad 已乘 1.4826、iqr 已除以 1.349，
+      二者均与正态 σ 可比）
+    """
+    n, mean, m2, lo, hi = _moments(da)
+    stats = {'count': int(n), 'mean': mean if n else np.nan,
+             'std': float(np.sqrt(m2 / n)) if n else np.nan, 'min': lo, 'max': hi}
+    if robust and n:
+        hi_edge = hi if hi > lo else lo + 1.0
+        data = da.data
+        if isinstance(data, dsa.Array):
+            counts, edges = dsa.histogram(data, bins=bins, range=(lo, hi_edge))
+            counts, edges = dask.compute(counts, edges)
+        else:
+            counts, edges = np.histogram(np.asarray(data), bins=bins, range=(lo, hi_edge))
+        median = _hist_quantile(counts, edges, 0.5)
+        # 以箱中心近似 |x - median| 的分布，求其加权中位数
+        centers = (edges[:-1] + edges[1:]) / 2
+        dev = np.abs(centers - median)
+        order = np.argsort(dev)
+        cum = np.cumsum(counts[order])
+        mad = dev[order][int(np.searchsorted(cum, cum[-1] / 2))]
+        iqr = _hist_quantile(counts, edges, 0.75) - _hist_quantile(counts, edges, 0.25)
+        stats.update(median=float(median), mad=float(mad * 1.4826), iqr=float(iqr / 1.349))
+    return stats
+
+# MAD 低于该比例 × 标准差即视为退化（如大片零值），改用 IQR 或标准差作尺度
+MAD_FLOOR = 0.05
+
+def robust_scale(stats: dict) -> float:
+    """稳健尺度：默认 MAD；MAD 退化时依次回退到 IQR/1.349、标准差
+    说明：超过一半像元取同一值（如 75% 为 0 的道路密度）时 MAD≈0，直接相除会把 z 值放大到上万，
+    故以 MAD_FLOOR × std 为下限判断退化
+    """
+    floor = MAD_FLOOR * stats['std']
+    for key in ('mad', 'iqr'):
+        if stats[key] > floor:
+            return stats[key]
+    return stats['std']
+
+@profiled()
+def standardize_layers(*arrays, like: xr.DataArray = None, method: str = 'zscore',
+                       resampling=Resampling.bilinear):
+    """对多层指标做标准化（z-score），便于构建 “干扰指数”
+    参数:
+      like: 参考格网（默认第一层）；其余层先对齐到该格网
+      method: 'zscore'（(x-均值)/标准差）或 'robust'（(x-中位数)/MAD）
+    说明：统计量按 dask 块单次流式计算并忽略 nodata；标准化本身保持惰性
+      robust 下 MAD 退化（低于 MAD_FLOOR × 标准差）时改用 IQR/1.349，仍退化则用标准差（见 robust_scale）
+    """
+    if method not in ('zscore', 'robust'):
+        raise ValueError(f"不支持的标准化方法: {method}")
+    aligned = align_layers(*arrays, like=like, resampling=resampling)
+    std_layers = []
+    for da in aligned:
+        stats = layer_stats(da, robust=(method == 'robust'))
+        if method == 'robust':
+            mu, sigma = stats['median'], robust_scale(stats)
+        else:
+            mu, sigma = stats['mean'], stats['std']
         std_layers.append((da - mu) / (sigma + 1e-9))
     return std_layers
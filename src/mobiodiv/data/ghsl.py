@@ -1,44 +1,180 @@
 # -*- coding: utf-8 -*-
 """GHSL（UCDB/SMOD/FUA/POP）读取与城市-城郊-农村分层构建"""
+import json
+import os
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
 from pathlib import Path
 import geopandas as gpd
 import rioxarray as rxr
 import xarray as xr
 import numpy as np
-from shapely.geometry import box
-from ..config import FILES, OUTPUTS, CRS_WGS84
+import rasterio
+from rasterio import features, windows
+from rasterio.enums import Resampling
+from rasterio.errors import WindowError
+from rasterio.vrt import WarpedVRT
+from pyproj import Transformer
+from shapely.geometry import box, shape
+from shapely.ops import transform as shp_transform, unary_union
+from ..config import FILES, OUTPUTS, INTERIM_DIR, CRS_WGS84
+from ..utils.io import write_json
+from ..utils.raster_cache import cached_reproject, source_digest
+from ..utils.profiling import profiled
 
+# SMOD（Degree of Urbanisation）编码 → 分层；类别值 1/2/3 写入中间分类栅格
+SMOD_CLASSES = {
+    'urban': (30, 31),
+    'periurban': (23, 24),
+    'rural': (11, 12, 13),
+}
+STRATA_CODES = {name: i + 1 for i, name in enumerate(SMOD_CLASSES)}
+
+# 工作进程内打开的分类栅格（每个进程只打开一次）
+_WORKER_SRC = None
+
+@profiled()
+def classify_smod(smod_path: Path = FILES['ghsl_smod'],
+                  out_path: Path = INTERIM_DIR / 'ghsl_smod_strata_wgs84.tif',
+                  classes=None, block: int = 2048, overwrite: bool = False, use_cache: bool = True):
+    """一次性把 SMOD 重投影到 WGS84 并分类为 城市/城郊/农村（1/2/3，0 为其他）
+    说明：
+      - use_cache=True 时重投影结果取自内容寻址缓存（utils.raster_cache），分类只读缓存 COG；
+        否则以 WarpedVRT 按窗口读取（重投影由 GDAL 逐块完成）；查表分类后逐块写出，单次栅格遍历
+      - 结果为分块压缩 GeoTIFF，供逐城市窗口读取；先写临时文件再原子替换，
+        旁注文件（同名 .json）记录源文件哈希与 classes，二者都一致时直接复用
+    返回:
+      out_path
+    """
+    classes = classes or SMOD_CLASSES
+    out_path = Path(out_path)
+    meta_path = out_path.with_suffix('.json')
+    meta = {'source': str(smod_path), 'sha256': source_digest(smod_path),
+            'classes': [[name, list(codes)] for name, codes in classes.items()]}
+    if (not overwrite and out_path.exists() and meta_path.exists()
+            and json.loads(meta_path.read_text(encoding='utf-8')) == meta):
+        return out_path
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    # 先删旧旁注：重写中途失败时不会把旧的分类参数误认给新文件
+    meta_path.unlink(missing_ok=True)
+    tmp = out_path.with_name(f'{out_path.stem}.{os.getpid()}.tmp.tif')
+
+    # 编码查找表：lut[smod_code] = 分层类别
+    lut = np.zeros(256, dtype=np.uint8)
+    for i, codes in enumerate(classes.values()):
+        lut[list(codes)] = i + 1
+
+    with ExitStack() as stack:
+        if use_cache:
+            vrt = stack.enter_context(rasterio.open(
+                cached_reproject(smod_path, CRS_WGS84, resampling=Resampling.nearest)))
+        else:
+            src = stack.enter_context(rasterio.open(smod_path))
+            vrt = stack.enter_context(WarpedVRT(src, crs=CRS_WGS84, resampling=Resampling.nearest))
+        profile = {
+            'driver': 'GTiff', 'dtype': 'uint8', 'count': 1, 'nodata': 0,
+            'crs': CRS_WGS84, 'transform': vrt.transform,
+            'width': vrt.width, 'height': vrt.height,
+            'tiled': True, 'blockxsize': 512, 'blockysize': 512, 'compress': 'deflate',
+        }
+        try:
+            with rasterio.open(tmp, 'w', **profile) as dst:
+                for row in range(0, vrt.height, block):
+                    for col in range(0, vrt.width, block):
+                        win = windows.Window(col, row, min(block, vrt.width - col), min(block, vrt.height - row))
+                        codes = vrt.read(1, window=win)
+                        # 负值/越界编码（如 nodata=-200）统一视为“其他”
+                        valid = (codes >= 0) & (codes < 256)
+                        out = np.where(valid, lut[np.clip(codes, 0, 255).astype(np.intp)], 0)
+                        dst.write(out.astype(np.uint8), 1, window=win)
+            os.replace(tmp, out_path)
+        finally:
+            tmp.unlink(missing_ok=True)
+    write_json(meta_path, meta, indent=1)
+    return out_path
+
+def _utm_epsg(lon: float, lat: float) -> int:
+    zone = int((lon + 180) // 6) % 60 + 1
+    return (32600 if lat >= 0 else 32700) + zone
+
+@lru_cache(maxsize=None)
+def _utm_transformers(epsg: int):
+    """返回 (WGS84→UTM, UTM→WGS84) 变换器（每个进程按 UTM 带缓存）"""
+    fwd = Transformer.from_crs(CRS_WGS84, f'EPSG:{epsg}', always_xy=True)
+    inv = Transformer.from_crs(f'EPSG:{epsg}', CRS_WGS84, always_xy=True)
+    return fwd, inv
+
+def _init_worker(class_path):
+    global _WORKER_SRC
+    _WORKER_SRC = rasterio.open(class_path)
+
+def _strata_for_city(task):
+    """单个城市：缓冲（米，局部 UTM）→ 窗口读取分类栅格 → 矢量化 → 按分层合并"""
+    idx, geom, buffer_m = task
+    src = _WORKER_SRC
+    c = geom.centroid
+    fwd, inv = _utm_transformers(_utm_epsg(c.x, c.y))
+    ring = shp_transform(inv.transform, shp_transform(fwd.transform, geom).buffer(buffer_m))
+
+    win = windows.from_bounds(*ring.bounds, transform=src.transform)
+    win = win.round_offsets().round_lengths()
+    try:
+        win = win.intersection(windows.Window(0, 0, src.width, src.height))
+    except WindowError:
+        return []
+    arr = src.read(1, window=win)
+    if not arr.any():
+        return []
+    win_transform = windows.transform(win, src.transform)
+
+    parts = {}
+    for geojson, value in features.shapes(arr, mask=arr > 0, transform=win_transform):
+        parts.setdefault(int(value), []).append(shape(geojson))
+    records = []
+    for name, code in STRATA_CODES.items():
+        if code not in parts:
+            continue
+        merged = unary_union(parts[code]).intersection(ring)
+        if not merged.is_empty:
+            records.append((idx, name, merged))
+    return records
+
+@profiled()
 def build_strata(ucdb_path: Path = FILES['ghsl_ucdb'],
                  smod_path: Path = FILES['ghsl_smod'],
-                 out_path: Path = OUTPUTS['strata_gpkg']):
+                 out_path: Path = OUTPUTS['strata_gpkg'],
+                 class_path: Path = INTERIM_DIR / 'ghsl_smod_strata_wgs84.tif',
+                 buffer_km: float = 30.0, max_workers: int = None, chunksize: int = 64):
     """基于 UCDB 城市多边形和 SMOD 栅格构建分层（城市-城郊-农村）
     说明：
-      - SMOD（Degree of Urbanisation）常见编码：城市(30/31)、城镇/半密集(23/24)、农村(11/12/13)
-      - 这里提供一个简单阈值法，你可以按需微调分类规则
+      - SMOD（Degree of Urbanisation）常见编码：城市(30/31)、城镇/半密集(23/24)、农村(11/12/13)，见 SMOD_CLASSES
+      - SMOD 只重投影、分类一次（classify_smod），各城市在进程池中按窗口读取并矢量化
+      - 每个城市外扩 buffer_km（在局部 UTM 中按米计算）形成 城市-城郊-农村 环
+    返回:
+      out_path（GPKG，每行一个 城市×分层，字段 city_idx/stratum + UCDB 原属性）
     """
     # 读取城市边界（UCDB）
     cities = gpd.read_file(ucdb_path).to_crs(CRS_WGS84)
-    # 读取 SMOD 栅格
-    smod = rxr.open_rasterio(smod_path, masked=True).squeeze()  # 2D
-    smod = smod.rio.reproject(CRS_WGS84)
+    class_path = classify_smod(smod_path, class_path)
 
+    tasks = [(idx, geom, buffer_km * 1000.0) for idx, geom in zip(cities.index, cities.geometry)
+             if geom is not None and not geom.is_empty]
+    max_workers = max_workers or os.cpu_count()
     records = []
-    for _, row in cities.iterrows():
-        geom = row.geometry
-        # 裁剪栅格到城市外扩一定缓冲（例如 30km）形成 城市-城郊-农村 环
-        buffer_km = 30_000  # 30km
-        bbox = gpd.GeoSeries([geom.buffer(buffer_km)], crs=CRS_WGS84).total_bounds
-        clipped = smod.rio.clip_box(minx=bbox[0], miny=bbox[1], maxx=bbox[2], maxy=bbox[3])
-
-        # 简单分类（示例）
-        city_mask = np.isin(clipped.values, [30,31])
-        town_mask = np.isin(clipped.values, [23,24])
-        rural_mask = np.isin(clipped.values, [11,12,13])
-
-        # 将三类掩膜转为矢量多边形（可选：简化/合并）
-        # 为简洁起见，这里不展开栅格→矢量步骤；生产中可用 rasterio.features.shapes 或 rioxarray 的向量化。
-        # TODO: 将掩膜矢量化并写入 out_path
-
-    # 占位：写空的 gpkg，避免后续报错
-    cities.to_file(out_path, driver='GPKG')
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                             initargs=(str(class_path),)) as ex:
+        for recs in ex.map(_strata_for_city, tasks, chunksize=chunksize):
+            records.extend(recs)
+
+    strata = gpd.GeoDataFrame(
+        {'city_idx': [r[0] for r in records], 'stratum': [r[1] for r in records]},
+        geometry=[r[2] for r in records], crs=CRS_WGS84,
+    )
+    attrs = cities.drop(columns=cities.geometry.name)
+    strata = strata.merge(attrs, left_on='city_idx', right_index=True, how='left')
+
+    # 一次性写出
+    Path(out_path).parent.mkdir(parents=True, exist_ok=True)
+    strata.to_file(out_path, driver='GPKG')
     return out_path
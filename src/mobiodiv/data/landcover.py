@@ -1,24 +1,150 @@
 # -*- coding: utf-8 -*-
 """陆覆/植被（WorldCover/CGLS/Landsat NDVI/Hansen/GEDI）处理与栖息地指标"""
+import math
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import geopandas as gpd
 import rioxarray as rxr
 import numpy as np
 import pandas as pd
+import rasterio
+from rasterio import windows
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.vrt import WarpedVRT
 from skimage import measure
 from ..config import FILES, CRS_WGS84
+from ..utils.raster_cache import cached_reproject, target_grid
 import pylandstats as pls
+from ..utils.profiling import profiled
 
-def load_worldcover(path: Path = FILES['worldcover']):
-    """读取 WorldCover 10m/100m 重采样栅格，并保持到 WGS84"""
-    da = rxr.open_rasterio(path).squeeze().rio.reproject(CRS_WGS84)
+@profiled()
+def load_worldcover(path: Path = FILES['worldcover'], bbox=None, chunks=None, use_cache: bool = True):
+    """读取 WorldCover 10m/100m 重采样栅格，并保持到 WGS84
+    参数:
+      bbox: 研究区范围 (minx, miny, maxx, maxy)，WGS84；仅读取该窗口
+      chunks: dask 分块大小（如 2048、'auto'）；为 None 时整景读入
+      use_cache: 重投影结果写入内容寻址缓存（utils.raster_cache），重复运行直接复用
+    返回:
+      xr.DataArray；chunks 非 None 时为惰性（dask）数组
+    """
+    if use_cache:
+        cached = cached_reproject(path, CRS_WGS84, bbox=bbox, resampling=Resampling.nearest)
+        return rxr.open_rasterio(cached, chunks=chunks, lock=False).squeeze()
+
+    if chunks is None:
+        da = rxr.open_rasterio(path).squeeze().rio.reproject(CRS_WGS84)
+        if bbox is not None:
+            da = da.rio.clip_box(*bbox)
+        return da
+
+    # 惰性模式：用 WarpedVRT 把“重投影”交给 GDAL 按块完成，
+    # 目标网格只覆盖 AOI，因此每个 dask 块只读取并重投影对应的源窗口
+    with rasterio.open(path) as src:
+        vrt_kwargs = target_grid(src, CRS_WGS84, bbox=bbox)
+        with WarpedVRT(src, resampling=Resampling.nearest, **vrt_kwargs) as vrt:
+            # rioxarray 会记录 VRT 参数，并在每个块读取时重建 VRT（可被序列化到多进程）
+            da = rxr.open_rasterio(vrt, chunks=chunks, lock=False).squeeze()
     return da
 
+# ESA WorldCover 2021 v200：3°×3° COG 瓦片，按瓦片西南角命名，如 ESA_WorldCover_10m_2021_v200_N39E115_Map.tif
+WORLDCOVER_BASE = "/vsis3/esa-worldcover/v200/2021/map"
+WORLDCOVER_TILE = "ESA_WorldCover_10m_2021_v200_{name}_Map.tif"
+
+def worldcover_tile_names(bbox):
+    """由 bbox 直接推算相交的 3°×3° 瓦片名（如 'N39E115'），无需列目录"""
+    minx, miny, maxx, maxy = bbox
+    names = []
+    for lat in range(math.floor(miny / 3) * 3, math.ceil(maxy / 3) * 3, 3):
+        for lon in range(math.floor(minx / 3) * 3, math.ceil(maxx / 3) * 3, 3):
+            ns = 'N' if lat >= 0 else 'S'
+            ew = 'E' if lon >= 0 else 'W'
+            names.append(f"{ns}{abs(lat):02d}{ew}{abs(lon):03d}")
+    return names
+
+def worldcover_tile_hrefs(bbox, base: str = WORLDCOVER_BASE):
+    """瓦片名 → GDAL 可读路径（/vsis3/、/vsicurl/http://... 或本地目录均可作为 base）"""
+    return [f"{base.rstrip('/')}/{WORLDCOVER_TILE.format(name=n)}" for n in worldcover_tile_names(bbox)]
+
+def _read_tile_window(href, bounds, res):
+    """读取单个 COG 与输出范围相交的窗口（HTTP Range 只取需要的块），返回 (行偏移, 列偏移, 数组)"""
+    minx, miny, maxx, maxy = bounds
+    with rasterio.Env(AWS_NO_SIGN_REQUEST='YES', GDAL_DISABLE_READDIR_ON_OPEN='EMPTY_DIR'):
+        with rasterio.open(href) as src:
+            left, bottom, right, top = src.bounds
+            ix0, iy0 = max(minx, left), max(miny, bottom)
+            ix1, iy1 = min(maxx, right), min(maxy, top)
+            if ix0 >= ix1 or iy0 >= iy1:
+                return None
+            # 瓦片与输出网格像元对齐，直接按整数像元号计算窗口
+            sx, sy = src.res
+            c0, c1 = int(round((ix0 - left) / sx)), int(round((ix1 - left) / sx))
+            r0, r1 = int(round((top - iy1) / sy)), int(round((top - iy0) / sy))
+            data = src.read(1, window=windows.Window(c0, r0, c1 - c0, r1 - r0))
+            row_off = int(round((maxy - (top - r0 * sy)) / res))
+            col_off = int(round((left + c0 * sx - minx) / res))
+    return row_off, col_off, data
+
+@profiled()
+def fetch_worldcover_mosaic(bbox, out_path: Path, hrefs=None, base: str = WORLDCOVER_BASE,
+                            res: float = 1 / 12000, max_workers: int = 8):
+    """按 bbox 并发读取所有相交 WorldCover 瓦片的窗口，镶嵌为单个分块压缩 GeoTIFF
+    参数:
+      hrefs: 瓦片路径列表（如 STAC 返回的 href）；为 None 时由 bbox 推算瓦片名
+      base: 推算瓦片路径时的前缀（测试时可指向本地 HTTP 替身或目录）
+      res: 瓦片像元大小（度，WorldCover 10m 为 1/12000）
+    返回:
+      (out_path, 成功读取的瓦片列表)；无任何瓦片可读时 out_path 为 None
+    """
+    hrefs = hrefs or worldcover_tile_hrefs(bbox, base)
+    # 输出网格对齐到瓦片像元网格
+    minx = math.floor(bbox[0] / res) * res
+    miny = math.floor(bbox[1] / res) * res
+    maxx = math.ceil(bbox[2] / res) * res
+    maxy = math.ceil(bbox[3] / res) * res
+    width, height = int(round((maxx - minx) / res)), int(round((maxy - miny) / res))
+    profile = {
+        'driver': 'GTiff', 'dtype': 'uint8', 'count': 1, 'nodata': 0,
+        'crs': CRS_WGS84, 'transform': from_origin(minx, maxy, res, res),
+        'width': width, 'height': height,
+        'tiled': True, 'blockxsize': 512, 'blockysize': 512, 'compress': 'deflate',
+    }
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    used = []
+    with rasterio.open(out_path, 'w', **profile) as dst, ThreadPoolExecutor(max_workers=max_workers) as ex:
+        futures = {ex.submit(_read_tile_window, h, (minx, miny, maxx, maxy), res): h for h in hrefs}
+        # 只在主线程写出，读取在线程池中并发进行
+        for fut in as_completed(futures):
+            try:
+                got = fut.result()
+            except rasterio.errors.RasterioIOError:
+                # 海洋等无数据区域没有瓦片
+                continue
+            if got is None:
+                continue
+            row_off, col_off, data = got
+            h = min(data.shape[0], height - row_off)
+            w = min(data.shape[1], width - col_off)
+            if h <= 0 or w <= 0:
+                continue
+            dst.write(data[:h, :w], 1, window=windows.Window(col_off, row_off, w, h))
+            used.append(futures[fut])
+    if not used:
+        out_path.unlink(missing_ok=True)
+        return None, used
+    return out_path, used
+
 def habitat_mask(da, habitat_codes=(10, 20, 30)):
-    """根据陆覆编码创建“栖息地”掩膜（示例：森林/灌丛/草地）"""
+    """根据陆覆编码创建“栖息地”掩膜（示例：森林/灌丛/草地）
+    若 da 为 dask 分块数组，则返回同样分块的惰性 dask 布尔数组（不整体载入内存）
+    """
+    if da.chunks is not None:
+        return da.isin(list(habitat_codes)).data
     mask = np.isin(da.values, list(habitat_codes))
     return mask
 
+@profiled()
 def compute_patch_metrics(mask: np.ndarray, transform, crs=CRS_WGS84):
     """使用 pylandstats 计算景观指标（面积、边界、最大斑块指数等）
     参数:
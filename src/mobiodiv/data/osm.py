@@ -1,38 +1,195 @@
 # -*- coding: utf-8 -*-
 """OSM 道路数据下载（基于 osmnx）并计算道路密度/长度等指标"""
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import geopandas as gpd
+import numpy as np
+import pandas as pd
 import osmnx as ox
+try:
+    from osmnx._errors import InsufficientResponseError
+except ImportError:
+    # osmnx 未公开该异常（位于私有模块）；模块调整时退回其公开基类 ValueError
+    InsufficientResponseError = ValueError
+import shapely
+import xarray as xr
+from pyproj import Transformer
 from shapely.geometry import box
 from pathlib import Path
-from ..config import OUTPUTS, CRS_WGS84
+from ..config import OUTPUTS, INTERIM_DIR, CRS_WGS84
+from ..metrics.community import grid_site_index
+from ..utils.grid import cell_area_km2
+from ..utils.profiling import profiled
 
-def download_osm_roads(polygon: gpd.GeoSeries, network_type: str = "drive"):
+# 道路瓦片缓存：每个 tile_deg×tile_deg 瓦片的道路边存为一个 GeoParquet，重叠的 AOI 只下载一次
+ROAD_TILE_DIR = INTERIM_DIR / 'osm_tiles'
+ROAD_COLUMNS = ['u', 'v', 'key', 'osmid', 'highway', 'length', 'geometry']
+
+def _osmnx_edges(polygon, network_type: str) -> gpd.GeoDataFrame:
+    """默认取数函数：用 osmnx 从 Overpass 拉取多边形内的道路边（端点在内即保留，跨瓦片的边两侧都会取到）
+    离线/测试时可把 ox.settings.overpass_url 指向本地替身服务，或通过 fetcher 参数替换本函数
+    """
+    try:
+        G = ox.graph_from_polygon(polygon, network_type=network_type, simplify=True,
+                                  retain_all=True, truncate_by_edge=True)
+    except InsufficientResponseError:
+        # 瓦片内没有道路（水面/荒地），缓存为空瓦片，避免重复请求
+        return gpd.GeoDataFrame(columns=ROAD_COLUMNS, geometry='geometry', crs=CRS_WGS84)
+    return ox.graph_to_gdfs(G, nodes=False, edges=True).reset_index()
+
+def road_tiles(polygon, tile_deg: float = 0.25):
+    """与多边形相交的瓦片行列号列表 [(ix, iy), ...]"""
+    minx, miny, maxx, maxy = polygon.bounds
+    ix, iy = np.meshgrid(np.arange(math.floor(minx / tile_deg), math.floor(maxx / tile_deg) + 1),
+                         np.arange(math.floor(miny / tile_deg), math.floor(maxy / tile_deg) + 1))
+    ix, iy = ix.ravel(), iy.ravel()
+    boxes = shapely.box(ix * tile_deg, iy * tile_deg, (ix + 1) * tile_deg, (iy + 1) * tile_deg)
+    hit = shapely.intersects(boxes, polygon)
+    return list(zip(ix[hit].tolist(), iy[hit].tolist()))
+
+def road_tile_path(ix: int, iy: int, network_type: str = 'drive', tile_deg: float = 0.25,
+                   cache_dir: Path = ROAD_TILE_DIR) -> Path:
+    return Path(cache_dir) / network_type / f'{tile_deg:g}' / f'x{ix}_y{iy}.parquet'
+
+def fetch_road_tile(ix: int, iy: int, network_type: str = 'drive', tile_deg: float = 0.25,
+                    cache_dir: Path = ROAD_TILE_DIR, fetcher=None) -> Path:
+    """下载单个瓦片并写入缓存（已缓存则直接返回路径）；先写临时文件再改名，中断不会留下半个瓦片"""
+    path = road_tile_path(ix, iy, network_type, tile_deg, cache_dir)
+    if path.exists():
+        return path
+    fetcher = fetcher or _osmnx_edges
+    tile = box(ix * tile_deg, iy * tile_deg, (ix + 1) * tile_deg, (iy + 1) * tile_deg)
+    edges = fetcher(tile, network_type).to_crs(CRS_WGS84)
+    edges = edges[[c for c in ROAD_COLUMNS if c in edges.columns]].copy()
+    # osmid/highway 可能为列表（简化后合并的边），统一转为字符串以便列式存储
+    for col in ('osmid', 'highway'):
+        if col in edges:
+            edges[col] = edges[col].map(lambda v: ';'.join(map(str, v)) if isinstance(v, list) else v).astype('str')
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix('.tmp')
+    edges.to_parquet(tmp, index=False)
+    os.replace(tmp, path)
+    return path
+
+@profiled()
+def load_roads_cached(polygon, network_type: str = 'drive', tile_deg: float = 0.25,
+                      cache_dir: Path = ROAD_TILE_DIR, max_workers: int = 4,
+                      offline: bool = False, fetcher=None) -> gpd.GeoDataFrame:
+    """从瓦片缓存拼装研究区道路；缺失的瓦片并发下载后写入缓存
+    参数:
+      polygon: 研究区多边形（WGS84）
+      offline: True 时只使用已缓存（或预先放入）的瓦片，不访问网络
+      fetcher: 取数函数 (tile_polygon, network_type) -> GeoDataFrame，默认 osmnx/Overpass
+    说明：
+      单个瓦片失败不影响其他瓦片，已成功的瓦片留在缓存中，重跑时只补缺失部分
+    返回:
+      GeoDataFrame（按 u/v/key 去重，仅保留与 polygon 相交的边）
+    """
+    tiles = road_tiles(polygon, tile_deg)
+    missing = [t for t in tiles if not road_tile_path(*t, network_type, tile_deg, cache_dir).exists()]
+    if missing and offline:
+        raise FileNotFoundError(f"离线模式下缺少 {len(missing)} 个道路瓦片，例如 {missing[:5]}")
+    failed = {}
+    if missing:
+        with ThreadPoolExecutor(max_workers=max_workers) as ex:
+            futures = {ex.submit(fetch_road_tile, ix, iy, network_type, tile_deg, cache_dir, fetcher): (ix, iy)
+                       for ix, iy in missing}
+            for fut in as_completed(futures):
+                try:
+                    fut.result()
+                except Exception as e:
+                    failed[futures[fut]] = e
+    if failed:
+        raise RuntimeError(f"{len(failed)} 个道路瓦片下载失败（其余已缓存，可重试）：{list(failed.items())[:5]}")
+
+    parts = [gpd.read_parquet(road_tile_path(ix, iy, network_type, tile_deg, cache_dir)) for ix, iy in tiles]
+    parts = [p for p in parts if len(p)]
+    if not parts:
+        return gpd.GeoDataFrame(columns=ROAD_COLUMNS, geometry='geometry', crs=CRS_WGS84)
+    roads = gpd.GeoDataFrame(pd.concat(parts, ignore_index=True), geometry='geometry', crs=CRS_WGS84)
+    key = [c for c in ('u', 'v', 'key') if c in roads.columns]
+    if key:
+        roads = roads.drop_duplicates(subset=key)
+    roads = roads[roads.intersects(polygon)].reset_index(drop=True)
+    return roads
+
+def download_osm_roads(polygon: gpd.GeoSeries, network_type: str = "drive", use_cache: bool = True, **kwargs):
     """根据研究区多边形下载 OSM 道路网络
     参数:
       polygon: GeoSeries（单个多边形，WGS84）
       network_type: 'drive'（机动车道），也可用 'walk'、'bike' 等
+      use_cache: 是否经由瓦片缓存（load_roads_cached，其余参数透传）；False 时整区一次性拉取
     返回:
       roads: GeoDataFrame（道路边）
     """
     poly = polygon.values[0]
+    if use_cache:
+        return load_roads_cached(poly, network_type=network_type, **kwargs)
     G = ox.graph_from_polygon(poly, network_type=network_type, simplify=True)
     edges = ox.graph_to_gdfs(G, nodes=False, edges=True)
     roads = edges.to_crs(CRS_WGS84)
     return roads
 
-def road_density(roads: gpd.GeoDataFrame, area_gdf: gpd.GeoDataFrame, buffer_m: int = 0):
-    """计算道路密度（道路总长度 / 面积），可选缓冲
+@profiled()
+def road_density(roads: gpd.GeoDataFrame, area_gdf: gpd.GeoDataFrame, buffer_m: int = 0, metric_crs=None):
+    """计算每个面单元的道路密度（道路总长度 / 面积），可选缓冲
+    说明：
+      - 在米制投影中计算（默认按研究区估计 UTM 带；跨多个 UTM 带的大范围请显式传入 metric_crs）
+      - 用 STRtree 找出 单元×道路 的相交对，完全落在单元内部的道路直接取长度，只对跨边界的道路做裁剪
     返回:
-      area_gdf 带新字段 'road_km_per_km2'
+      area_gdf 副本，新增字段 'road_km'、'area_km2'、'road_km_per_km2'（逐单元）
     """
+    area_gdf = area_gdf.copy()
+    metric_crs = metric_crs or area_gdf.estimate_utm_crs()
+    areas = area_gdf.geometry.to_crs(metric_crs)
     if buffer_m > 0:
-        area_gdf = area_gdf.copy()
-        area_gdf['geometry'] = area_gdf.buffer(buffer_m)
-    # 叠加裁剪
-    clipped = gpd.overlay(roads[['geometry']], area_gdf[['geometry']], how='intersection')
-    clipped['len_km'] = clipped.length / 1000.0
-    total_len = clipped['len_km'].sum()
-    area_km2 = area_gdf.to_crs(3857).area.sum() / 1e6
-    density = total_len / area_km2 if area_km2 > 0 else 0.0
-    area_gdf['road_km_per_km2'] = density
+        areas = areas.buffer(buffer_m)
+    lines = roads.geometry.to_crs(metric_crs)
+
+    area_idx, road_idx = lines.sindex.query(areas.values, predicate='intersects')
+    a_geoms = areas.values[area_idx]
+    r_geoms = lines.values[road_idx]
+    shapely.prepare(a_geoms)
+    inside = shapely.contains_properly(a_geoms, r_geoms)
+    seg_len = np.where(inside, shapely.length(r_geoms), 0.0)
+    cross = ~inside
+    seg_len[cross] = shapely.length(shapely.intersection(r_geoms[cross], a_geoms[cross]))
+
+    road_km = np.bincount(area_idx, weights=seg_len, minlength=len(areas)) / 1000.0
+    area_km2 = areas.area.to_numpy() / 1e6
+    area_gdf['road_km'] = road_km
+    area_gdf['area_km2'] = area_km2
+    area_gdf['road_km_per_km2'] = np.divide(road_km, area_km2, out=np.zeros_like(road_km), where=area_km2 > 0)
     return area_gdf
+
+@profiled()
+def road_density_raster(roads: gpd.GeoDataFrame, like: xr.DataArray, metric_crs=None, segments_per_cell: int = 4):
+    """把道路密度（km / km²）写到与 like 对齐的格网（如干扰指数/NO2 栅格）
+    做法：道路按 格元边长/segments_per_cell 加密为短线段，线段长度在米制投影中计算，
+    按线段中点落入的格元累加（bincount），再除以格元面积
+    返回:
+      xr.DataArray（与 like 同 transform/shape/CRS），可标准化后作为 composite_disturbance 的 std_roads
+    """
+    transform, shape, crs = like.rio.transform(), like.shape[-2:], like.rio.crs
+    lines = roads.geometry.to_crs(crs).explode(index_parts=False)
+    lines = lines[lines.geom_type == 'LineString']
+    max_seg = min(abs(transform.a), abs(transform.e)) / segments_per_cell
+    dense = shapely.segmentize(lines.values, max_seg)
+    coords, line_id = shapely.get_coordinates(dense, return_index=True)
+    same = line_id[1:] == line_id[:-1]
+
+    metric_crs = metric_crs or roads.estimate_utm_crs()
+    mx, my = Transformer.from_crs(crs, metric_crs, always_xy=True).transform(coords[:, 0], coords[:, 1])
+    seg_len = np.hypot(np.diff(mx), np.diff(my))[same]
+    mid_x = ((coords[:-1, 0] + coords[1:, 0]) / 2)[same]
+    mid_y = ((coords[:-1, 1] + coords[1:, 1]) / 2)[same]
+
+    cell = grid_site_index(mid_x, mid_y, transform, shape)
+    ok = cell >= 0
+    km = np.bincount(cell[ok], weights=seg_len[ok] / 1000.0, minlength=shape[0] * shape[1]).reshape(shape)
+    density = km / cell_area_km2(transform, shape, crs)[:, None]
+
+    out = xr.DataArray(density.astype('float32'), dims=('y', 'x'),
+                       coords={'y': like['y'].values, 'x': like['x'].values}, name='road_km_per_km2')
+    return out.rio.write_crs(crs).rio.write_transform(transform)
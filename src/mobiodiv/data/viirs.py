@@ -4,7 +4,9 @@ from pathlib import Path
 from . import ghsl
 from ..utils.io import download_file
 from ..config import FILES
+from ..utils.profiling import profiled
 
+@profiled()
 def download_viirs_annual(year: int, out_path: Path = FILES['viirs_vnl']):
     """下载 VIIRS 年度合成（示例：需要你将 BASE_URL 替换为官方年度产品地址）
     提示：不同年份/版本的路径可能不同，请按官方目录结构修改。
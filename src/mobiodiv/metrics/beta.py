@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""分块、外存、多进程的 β 多样性引擎（含 Baselga 周转/嵌套分解）
+结果写为内存映射的压缩（condensed，仅 i<j）距离向量 .npy，下游按块流式汇总，不需要整体载入 n×n 矩阵
+"""
+import math
+import os
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from ..config import INTERIM_DIR
+from .diversity import _sum_min
+from ..utils.profiling import profiled
+
+# 各指标族输出的分量：总体相异度、周转（替换）分量、嵌套（丰度梯度）分量
+BETA_FAMILIES = {
+    'sorensen': ('sor', 'sim', 'sne'),
+    'jaccard': ('jac', 'jtu', 'jne'),
+    'braycurtis': ('bray', 'bray_bal', 'bray_gra'),
+}
+
+# 每个行块同时存在的 b×(n-start) float64 临时数组个数上限，用于由字节预算推算块行数
+# _partition_block：a/b/c/m、b+c、两个分母、total/turn/nested 及写出前的行片段；site_summaries：seg/U/矩阵积
+_BLOCK_TEMPS = 10
+_SUMMARY_TEMPS = 3
+
+# 工作进程共享的只读数据（由 initializer 设置，每个进程只反序列化一次）
+_W = {}
+
+def condensed_index(n: int, i, j):
+    """(i, j)（i<j）在压缩距离向量中的位置（与 scipy.spatial.distance.squareform 一致）"""
+    i, j = np.minimum(i, j), np.maximum(i, j)
+    return n * i - i * (i + 1) // 2 + (j - i - 1)
+
+def n_from_condensed(length: int) -> int:
+    return int(round((1 + math.sqrt(1 + 8 * length)) / 2))
+
+def _partition_block(X, P, row_sum, rich, family, start, stop):
+    """第 start:stop 行与 j>=start 各列的 (总体, 周转, 嵌套) 三个分量，形状均为 b×(n-start)"""
+    if family == 'braycurtis':
+        a = _sum_min(X[start:stop].toarray(), X[start:])
+        b = row_sum[start:stop, None] - a
+        c = row_sum[None, start:] - a
+    else:
+        a = (P[start:stop] @ P[start:].T).toarray()
+        b = rich[start:stop, None] - a
+        c = rich[None, start:] - a
+    # 原地运算并及早释放 b、c，限制同时存在的临时数组（见 _BLOCK_TEMPS）
+    m = np.minimum(b, c)
+    b += c
+    bc = b
+    del b, c
+    if family == 'jaccard':
+        # jac = (b+c)/(a+b+c)，jtu = 2m/(a+2m)
+        den = a + bc
+        m *= 2
+        den_t = a + m
+    else:
+        # sorensen 与 braycurtis 形式相同（后者 a/b/c 为丰度量，Baselga 2013）
+        # sor = (b+c)/(2a+b+c)，sim = m/(a+m)
+        den = a + a
+        den += bc
+        den_t = a + m
+    del a
+    total = np.divide(bc, den, out=np.zeros_like(bc), where=den > 0)
+    del bc, den
+    turn = np.divide(m, den_t, out=np.zeros_like(m), where=den_t > 0)
+    del m, den_t
+    return total, turn, total - turn
+
+def _init_worker(X, family, paths):
+    _W['X'] = X
+    _W['P'] = (X > 0).astype('float64').tocsr()
+    _W['row_sum'] = np.asarray(X.sum(axis=1)).ravel()
+    _W['rich'] = np.diff(_W['P'].indptr).astype('float64')
+    _W['family'] = family
+    _W['out'] = [np.load(p, mmap_mode='r+') for p in paths]
+
+def _run_block(task):
+    start, stop = task
+    X = _W['X']
+    n = X.shape[0]
+    comps = _partition_block(X, _W['P'], _W['row_sum'], _W['rich'], _W['family'], start, stop)
+    # 第 i 行在压缩向量中对应 j=i+1..n-1 的连续片段，整块行也连续
+    offset = int(condensed_index(n, start, start + 1)) if start < n - 1 else 0
+    for comp, out in zip(comps, _W['out']):
+        pos = offset
+        for r, i in enumerate(range(start, stop)):
+            seg = comp[r, i - start + 1:]
+            out[pos:pos + len(seg)] = seg
+            pos += len(seg)
+        out.flush()
+    return stop - start
+
+@profiled()
+def beta_partition(count_matrix, family: str = 'sorensen', out_dir: Path = INTERIM_DIR / 'beta',
+                   block_rows: int = None, max_workers: int = None, dtype='float32',
+                   mem_budget: int = 1 << 30):
+    """计算 β 多样性及其周转/嵌套分解，写为内存映射的压缩距离向量
+    参数:
+      count_matrix: 站点×物种矩阵（numpy 或 scipy.sparse，见 community.build_count_matrix）
+      family: 'sorensen'（sor/sim/sne）、'jaccard'（jac/jtu/jne）、'braycurtis'（bray/bray_bal/bray_gra）
+      block_rows: 每个任务处理的行数；默认按 mem_budget 自动确定
+      max_workers: 进程数（默认 CPU 核数；1 时在本进程内计算）
+      mem_budget: 行块临时数组的总字节预算（所有工作进程合计，默认 1GB）；
+        块行数 = mem_budget / (进程数 × 同时存在的临时数组个数 × 8 字节 × n)
+      dtype: 输出精度（默认 float32，5 万站点约 5GB/分量）
+    返回:
+      dict：分量名 → .npy 路径（np.load(path, mmap_mode='r') 按需读取）
+    """
+    if family not in BETA_FAMILIES:
+        raise ValueError(f"不支持的 β 指标族: {family}（可选 {list(BETA_FAMILIES)}）")
+    X = sparse.csr_matrix(count_matrix, dtype='float64')
+    n = X.shape[0]
+    length = n * (n - 1) // 2
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    paths = {}
+    for name in BETA_FAMILIES[family]:
+        paths[name] = out_dir / f'{name}.npy'
+        np.lib.format.open_memmap(paths[name], mode='w+', dtype=dtype, shape=(length,)).flush()
+
+    max_workers = max_workers or os.cpu_count()
+    block_rows = block_rows or max(1, mem_budget // (max_workers * _BLOCK_TEMPS * 8 * max(n, 1)))
+    tasks = [(s, min(s + block_rows, n)) for s in range(0, n - 1, block_rows)]
+    init_args = (X, family, [str(p) for p in paths.values()])
+    if max_workers == 1:
+        _init_worker(*init_args)
+        for t in tasks:
+            _run_block(t)
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=init_args) as ex:
+            list(ex.map(_run_block, tasks))
+    return paths
+
+def site_summaries(path: Path, groups=None, block_rows: int = None, mem_budget: int = 1 << 30):
+    """按行块流式读取压缩距离向量，汇总每个站点的平均相异度
+    参数:
+      groups: 每个站点的分组标签（如所属分层/城市）；给出时额外计算到同组其他站点的平均相异度
+      mem_budget: 行块临时数组的字节预算（默认 1GB）
+    返回:
+      DataFrame：mean_all（到全部其他站点）、mean_group（到同组其他站点，组内只有 1 个站点时为 NaN）
+    """
+    cond = np.load(path, mmap_mode='r')
+    n = n_from_condensed(len(cond))
+    if groups is not None:
+        g_codes, _ = pd.factorize(pd.Series(groups))
+        G = sparse.csr_matrix((np.ones(n), (np.arange(n), g_codes)), shape=(n, g_codes.max() + 1))
+        group_sum = np.zeros((n, G.shape[1]))
+    total = np.zeros(n)
+
+    block_rows = block_rows or max(1, mem_budget // (_SUMMARY_TEMPS * 8 * max(n, 1)))
+    for start in range(0, n - 1, block_rows):
+        stop = min(start + block_rows, n - 1)
+        lo = int(condensed_index(n, start, start + 1))
+        hi = int(condensed_index(n, stop - 1, n - 1)) + 1
+        seg = np.asarray(cond[lo:hi], dtype='float64')
+        # 还原为 b×(n-start) 的上三角块（j<=i 处为 0）
+        U = np.zeros((stop - start, n - start))
+        pos = 0
+        for r, i in enumerate(range(start, stop)):
+            k = n - i - 1
+            U[r, i - start + 1:] = seg[pos:pos + k]
+            pos += k
+        total[start:stop] += U.sum(axis=1)
+        total[start:] += U.sum(axis=0)
+        if groups is not None:
+            group_sum[start:stop] += (G[start:].T @ U.T).T
+            group_sum[start:] += (G[start:stop].T @ U).T
+
+    out = pd.DataFrame({'mean_all': total / max(n - 1, 1)})
+    if groups is not None:
+        size = np.bincount(g_codes)
+        own = group_sum[np.arange(n), g_codes]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out['mean_group'] = np.where(size[g_codes] > 1, own / (size[g_codes] - 1), np.nan)
+    return out
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+"""群落矩阵：把物种记录（GBIF/eBird）按栅格格网或分层单元聚合为 站点×物种 稀疏计数矩阵"""
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from scipy import sparse
+from rasterio.transform import rowcol
+from ..utils.profiling import profiled
+
+def grid_site_index(lon, lat, transform, shape):
+    """点坐标 → 栅格格网的扁平格元号（row * width + col），落在格网外的点为 -1
+    参数:
+      transform: 格网仿射变换（与干扰/陆覆栅格一致即可对齐）
+      shape: (height, width)
+    """
+    height, width = shape
+    lon = np.asarray(lon, dtype='float64')
+    lat = np.asarray(lat, dtype='float64')
+    rows, cols = rowcol(transform, lon, lat, op=np.floor)
+    rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+    inside = (rows >= 0) & (rows < height) & (cols >= 0) & (cols < width)
+    return np.where(inside, rows * width + cols, -1)
+
+def unit_site_index(lon, lat, units: gpd.GeoDataFrame):
+    """点坐标 → 所在分层单元（units 的行位置），不在任何单元内的点为 -1
+    使用 STRtree 批量查询；单元重叠时取第一个命中的单元
+    """
+    pts = shapely.points(np.asarray(lon, dtype='float64'), np.asarray(lat, dtype='float64'))
+    pt_idx, unit_idx = units.sindex.query(pts, predicate='within')
+    site = np.full(len(pts), -1, dtype=np.int64)
+    # 逆序赋值，使每个点最终保留第一个命中的单元
+    site[pt_idx[::-1]] = unit_idx[::-1]
+    return site
+
+@profiled()
+def build_count_matrix(site_index, species, counts=None, n_sites: int = None, drop_empty: bool = True):
+    """向量化聚合为 站点×物种 CSR 稀疏计数矩阵
+    参数:
+      site_index: 每条记录的站点号（-1 表示丢弃）
+      species: 每条记录的物种标签（字符串或 category）
+      counts: 每条记录的个体数（默认每条记 1；NaN 记 1，如 eBird 的 'X'）
+      n_sites: 站点总数（格网为 height*width，单元为 len(units)）；默认取最大站点号 + 1
+      drop_empty: 是否去掉没有任何记录的站点行
+    返回:
+      (matrix, site_ids, species_labels)
+      matrix: scipy.sparse.csr_matrix（float64，行=站点，列=物种）
+      site_ids: 每行对应的站点号（格网格元号或单元行位置）
+      species_labels: 每列对应的物种标签
+    """
+    site_index = np.asarray(site_index, dtype=np.int64)
+    sp_codes, sp_labels = pd.factorize(pd.Series(species), sort=True)
+    sp_codes = np.asarray(sp_codes)
+    if counts is None:
+        values = np.ones(len(site_index), dtype='float64')
+    else:
+        values = np.asarray(counts, dtype='float64')
+        values = np.where(np.isnan(values), 1.0, values)
+
+    keep = (site_index >= 0) & (sp_codes >= 0)
+    site_index, sp_codes, values = site_index[keep], sp_codes[keep], values[keep]
+    if n_sites is None:
+        n_sites = int(site_index.max()) + 1 if len(site_index) else 0
+
+    if drop_empty:
+        site_ids, rows = np.unique(site_index, return_inverse=True)
+    else:
+        site_ids, rows = np.arange(n_sites), site_index
+    # COO → CSR 时重复的 (站点, 物种) 自动求和
+    matrix = sparse.coo_matrix((values, (rows, sp_codes)),
+                               shape=(len(site_ids), len(sp_labels))).tocsr()
+    matrix.sum_duplicates()
+    return matrix, site_ids, np.asarray(sp_labels)
+
+def count_matrix_from_grid(lon, lat, species, transform, shape, counts=None, drop_empty: bool = True):
+    """按栅格格网聚合（格元号见 grid_site_index）"""
+    site = grid_site_index(lon, lat, transform, shape)
+    return build_count_matrix(site, species, counts=counts, n_sites=shape[0] * shape[1], drop_empty=drop_empty)
+
+def count_matrix_from_units(lon, lat, species, units: gpd.GeoDataFrame, counts=None, drop_empty: bool = True):
+    """按分层单元（如 strata.gpkg 的 城市×分层 多边形）聚合；site_ids 为 units 的行位置"""
+    site = unit_site_index(lon, lat, units)
+    return build_count_matrix(site, species, counts=counts, n_sites=len(units), drop_empty=drop_empty)
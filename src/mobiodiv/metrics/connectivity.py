@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+"""电路理论连通性（Circuitscape 式）：阻力面 → 稀疏图拉普拉斯 → 预条件共轭梯度求解电压/电流
+- 图结构（节点编号、边、CSR 稀疏模式、连通分量）只构建一次，各情景只替换阻力值
+- 预条件子为按格网 3×3 聚合的光滑聚合代数多重网格（SA-AMG）V 循环，多个右端项成块同时迭代
+- 接地一个焦点后对其余焦点各解一次，成对有效电阻与 all-to-one 电压均由这组解线性组合得到
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.sparse.linalg import splu
+from ..utils.profiling import profiled
+
+# WorldCover 编码 → 基础阻力（示例取值：森林/灌丛/草地低，农田中等，建成区/水体高）
+DEFAULT_LC_RESISTANCE = {
+    10: 1.0, 20: 2.0, 30: 3.0, 40: 20.0, 50: 200.0, 60: 50.0,
+    70: 100.0, 80: 100.0, 90: 5.0, 95: 5.0, 100: 10.0,
+}
+
+# 工作进程共享的图结构（由 initializer 设置）
+_W = {}
+
+@profiled()
+def resistance_surface(landcover, disturbance=None, lc_resistance=None, beta: float = 1.0,
+                       max_resistance: float = 1e4):
+    """由陆覆与干扰指数构建阻力面：r = 基础阻力[陆覆] × exp(beta × 干扰)
+    参数:
+      landcover: 陆覆编码栅格（与 disturbance 同格网，见 airquality.open_aligned）
+      disturbance: 标准化干扰指数（缺失处不加权）
+      lc_resistance: 编码 → 基础阻力（默认 DEFAULT_LC_RESISTANCE）
+    返回:
+      np.ndarray（float64）；未知编码处为 NaN（不进入电路）
+    """
+    lc_resistance = lc_resistance or DEFAULT_LC_RESISTANCE
+    lc = np.asarray(getattr(landcover, 'values', landcover))
+    lut = np.full(256, np.nan)
+    for code, r in lc_resistance.items():
+        lut[code] = r
+    valid = np.isfinite(lc) & (lc >= 0) & (lc < 256)
+    res = np.where(valid, lut[np.where(valid, lc, 0).astype(np.intp)], np.nan)
+    if disturbance is not None:
+        d = np.asarray(getattr(disturbance, 'values', disturbance), dtype='float64')
+        res = res * np.exp(beta * np.where(np.isfinite(d), d, 0.0))
+    return np.minimum(res, max_resistance)
+
+def build_circuit(resistance, focal_rows, focal_cols, connect: int = 8):
+    """构建与阻力取值无关的图结构（各情景复用）
+    参数:
+      resistance: 基准阻力面；NaN 处不建节点（情景若要打通屏障，应在基准中设为高阻力而非 NaN）
+      focal_rows/focal_cols: 焦点（如城市中心、保护地）所在行列号
+      connect: 4 或 8 邻域
+    返回:
+      dict 图结构（节点、边、CSR 稀疏模式、连通分量、焦点节点号等）
+    """
+    res = np.asarray(resistance, dtype='float64')
+    H, W = res.shape
+    node_of = np.full(H * W, -1, dtype=np.int64)
+    cells = np.flatnonzero(np.isfinite(res.ravel()))
+    node_of[cells] = np.arange(len(cells))
+    node_of = node_of.reshape(H, W)
+
+    offsets = [(0, 1, 1.0), (1, 0, 1.0)]
+    if connect == 8:
+        offsets += [(1, 1, np.sqrt(2)), (1, -1, np.sqrt(2))]
+    ei, ej, el = [], [], []
+    for dr, dc, length in offsets:
+        a = node_of[:H - dr, max(0, -dc):W - max(0, dc)]
+        b = node_of[dr:, max(0, dc):W - max(0, -dc)]
+        ok = (a >= 0) & (b >= 0)
+        ei.append(a[ok])
+        ej.append(b[ok])
+        el.append(np.full(ok.sum(), length))
+    ei, ej, el = np.concatenate(ei), np.concatenate(ej), np.concatenate(el)
+    n = len(cells)
+
+    # 拉普拉斯 COO 顺序：[上三角 -w, 下三角 -w, 对角]；记录到 CSR data 的置换，之后只需重排数值
+    rows = np.concatenate([ei, ej, np.arange(n)])
+    cols = np.concatenate([ej, ei, np.arange(n)])
+    pattern = sparse.csr_matrix((np.arange(1, len(rows) + 1, dtype='float64'), (rows, cols)), shape=(n, n))
+    order = pattern.data.astype(np.int64) - 1
+
+    adj = sparse.csr_matrix((np.ones(len(ei)), (ei, ej)), shape=(n, n))
+    _, comp = connected_components(adj, directed=False)
+
+    focal_rows, focal_cols = np.asarray(focal_rows), np.asarray(focal_cols)
+    focal = node_of[focal_rows, focal_cols]
+    if (focal < 0).any():
+        raise ValueError("部分焦点落在 NaN（无阻力值）像元上")
+    return {
+        'shape': (H, W), 'cells': cells, 'n': n, 'ei': ei, 'ej': ej, 'length': el,
+        'indptr': pattern.indptr, 'indices': pattern.indices, 'order': order,
+        'comp': comp, 'focal': focal, 'row': cells // W, 'col': cells % W,
+    }
+
+def laplacian(graph, resistance):
+    """按阻力值组装图拉普拉斯（复用 build_circuit 的 CSR 稀疏模式）
+    边导纳 = 1 / (两端阻力均值 × 边长)（同 Circuitscape 的平均阻力规则）
+    """
+    r = np.asarray(resistance, dtype='float64').ravel()[graph['cells']]
+    if not np.isfinite(r).all():
+        raise ValueError("情景阻力面在图节点上出现 NaN（节点集合须与基准一致）")
+    w = 1.0 / ((r[graph['ei']] + r[graph['ej']]) / 2 * graph['length'])
+    diag = np.bincount(graph['ei'], w, graph['n']) + np.bincount(graph['ej'], w, graph['n'])
+    data = np.concatenate([-w, -w, diag])[graph['order']]
+    L = sparse.csr_matrix((data, graph['indices'], graph['indptr']), shape=(graph['n'], graph['n']))
+    return L, w
+
+def _sa_hierarchy(A, rows, cols, max_coarse: int = 4000, omega: float = 2 / 3):
+    """按格网坐标 3×3 聚合的光滑聚合 AMG 层级；最粗层做稀疏 LU"""
+    levels = []
+    while A.shape[0] > max_coarse:
+        key = (rows // 3) * (cols.max() // 3 + 1) + cols // 3
+        agg, inv = np.unique(key, return_inverse=True)
+        n, nc = A.shape[0], len(agg)
+        if nc == n:
+            break
+        P0 = sparse.csr_matrix((np.ones(n), (np.arange(n), inv)), shape=(n, nc))
+        dinv = 1.0 / A.diagonal()
+        P = (P0 - omega * (sparse.diags(dinv) @ (A @ P0))).tocsr()
+        levels.append((A, P, P.T.tocsr(), dinv))
+        A = (P.T @ A @ P).tocsr()
+        ncols = cols.max() // 3 + 1
+        rows, cols = agg // ncols, agg % ncols
+    return levels, splu(A.tocsc())
+
+def _vcycle(levels, coarse, B, lvl: int = 0, omega: float = 2 / 3):
+    """对称 V 循环（前后各两次加权 Jacobi 光滑），B 可为多列"""
+    if lvl == len(levels):
+        return coarse.solve(B)
+    A, P, R, dinv = levels[lvl]
+    d = dinv[:, None] if B.ndim == 2 else dinv
+    X = omega * d * B
+    X += omega * d * (B - A @ X)
+    X += P @ _vcycle(levels, coarse, R @ (B - A @ X), lvl + 1, omega)
+    X += omega * d * (B - A @ X)
+    X += omega * d * (B - A @ X)
+    return X
+
+def _block_pcg(A, B, precond, tol: float = 1e-6, maxiter: int = 500):
+    """多右端项同时迭代的预条件共轭梯度；返回 (解, 迭代次数)"""
+    X = np.zeros_like(B)
+    R = B.copy()
+    Z = precond(R)
+    P = Z.copy()
+    rz = np.einsum('ij,ij->j', R, Z)
+    bnorm = np.linalg.norm(B, axis=0)
+    bnorm[bnorm == 0] = 1.0
+    for it in range(1, maxiter + 1):
+        AP = A @ P
+        alpha = rz / np.einsum('ij,ij->j', P, AP)
+        X += alpha * P
+        R -= alpha * AP
+        if (np.linalg.norm(R, axis=0) / bnorm).max() < tol:
+            return X, it
+        Z = precond(R)
+        rz_new = np.einsum('ij,ij->j', R, Z)
+        P = Z + (rz_new / rz) * P
+        rz = rz_new
+    return X, maxiter
+
+def _node_current(ei, ej, w, X, mode: str, chunk: int = 1 << 20):
+    """累计节点电流：各注入情形下支路电流绝对值按边求和，再把每条边的一半分给两端节点
+    X 为接地后各焦点单独注入的电压解（列），按边分块计算以限制内存
+    """
+    n, m = X.shape
+    flow = np.empty(len(ei))
+    for s in range(0, len(ei), chunk):
+        D = X[ei[s:s + chunk]] - X[ej[s:s + chunk]]
+        if mode == 'pairwise':
+            # 焦点 a→b 的电压差为 X[:, a] - X[:, b]
+            f = sum(np.abs(D[:, [a]] - D[:, a + 1:]).sum(axis=1) for a in range(m - 1))
+        else:
+            # 依次接地焦点 g、其余各注入 1A：电压 = ΣX - m·X[:, g]
+            f = np.abs(D.sum(axis=1)[:, None] - m * D).sum(axis=1)
+        flow[s:s + chunk] = f * w[s:s + chunk]
+    return 0.5 * (np.bincount(ei, flow, n) + np.bincount(ej, flow, n))
+
+@profiled(pixels=lambda r: r['current'].size)
+def solve_circuit(graph, resistance, mode: str = 'pairwise', tol: float = 1e-6,
+                  maxiter: int = 500, batch: int = 16):
+    """求解一个情景
+    参数:
+      mode: 'pairwise'（焦点两两注入 1A/接地）或 'all-to-one'（其余焦点各注入 1A，依次接地每个焦点）
+      batch: 每次同时迭代的右端项个数（控制内存：约 5 × 节点数 × batch × 8 字节）
+    返回:
+      dict：resistance（焦点×焦点有效电阻 DataFrame，pairwise；不连通为 inf）、
+            current（累计电流栅格，NaN 为非节点）、iterations（各分量 PCG 迭代次数）
+    """
+    if mode not in ('pairwise', 'all-to-one'):
+        raise ValueError(f"不支持的模式: {mode}")
+    L, w = laplacian(graph, resistance)
+    focal, comp, n = graph['focal'], graph['comp'], graph['n']
+    k = len(focal)
+    reff = np.full((k, k), np.inf)
+    np.fill_diagonal(reff, 0.0)
+    current = np.zeros(n)
+    iterations = []
+    for c in np.unique(comp[focal]):
+        fidx = np.flatnonzero(comp[focal] == c)
+        nodes = np.flatnonzero(comp == c)
+        local = np.full(n, -1, dtype=np.int64)
+        local[nodes] = np.arange(len(nodes))
+        ground = local[focal[fidx[0]]]
+        keep = np.delete(np.arange(len(nodes)), ground)
+        Lc = L[nodes][:, nodes]
+        A = Lc[keep][:, keep].tocsr()
+        rows, cols = graph['row'][nodes][keep], graph['col'][nodes][keep]
+        levels, coarse = _sa_hierarchy(A, rows, cols)
+        precond = lambda R: _vcycle(levels, coarse, R)
+
+        # X[:, f]：在 fidx[f] 注入 1A、ground 接地时的节点电压（ground 处为 0）
+        X = np.zeros((len(nodes), len(fidx)))
+        pos = np.full(len(nodes), -1, dtype=np.int64)
+        pos[keep] = np.arange(len(keep))
+        targets = list(range(1, len(fidx)))
+        for s in range(0, len(targets), batch):
+            cols_b = targets[s:s + batch]
+            B = np.zeros((len(keep), len(cols_b)))
+            B[pos[local[focal[fidx[cols_b]]]], np.arange(len(cols_b))] = 1.0
+            sol, it = _block_pcg(A, B, precond, tol=tol, maxiter=maxiter)
+            X[keep[:, None], np.array(cols_b)[None, :]] = sol
+            iterations.append(it)
+
+        fl = local[focal[fidx]]
+        G = X[fl]  # G[a, b] = 在 b 注入时 a 处电压
+        d = np.diag(G)
+        reff[np.ix_(fidx, fidx)] = d[:, None] + d[None, :] - G - G.T
+
+        in_comp = (comp[graph['ei']] == c)
+        ei, ej, wc = local[graph['ei'][in_comp]], local[graph['ej'][in_comp]], w[in_comp]
+        m = len(fidx)
+        current[nodes] += _node_current(ei, ej, wc, X, mode)
+        # 源/汇节点的外部注入电流（计一半）：pairwise 每个焦点参与 m-1 对；
+        # all-to-one 每个焦点作为汇一次（(m-1)/2）、作为源 m-1 次（各 1/2）
+        current[focal[fidx]] += 0.5 * (m - 1) if mode == 'pairwise' else m - 1
+
+    H, W = graph['shape']
+    cmap = np.full(H * W, np.nan)
+    cmap[graph['cells']] = current
+    labels = list(range(k))
+    return {
+        'resistance': pd.DataFrame(reff, index=labels, columns=labels),
+        'current': cmap.reshape(H, W).astype('float32'),
+        'iterations': iterations,
+    }
+
+def _init_worker(graph, base, kwargs):
+    _W['graph'], _W['base'], _W['kwargs'] = graph, base, kwargs
+
+def _run_scenario(item):
+    name, scenario = item
+    res = scenario(_W['base']) if callable(scenario) else scenario
+    return name, solve_circuit(_W['graph'], res, **_W['kwargs'])
+
+@profiled()
+def run_scenarios(graph, base_resistance, scenarios: dict, max_workers: int = None, **kwargs):
+    """批量求解多个情景（复用同一图结构），情景间多进程并行
+    参数:
+      scenarios: 名称 → 阻力面数组，或 以基准阻力面为输入返回新阻力面的函数（须可序列化）
+      kwargs: 传给 solve_circuit（mode/tol/maxiter/batch）
+    返回:
+      dict：名称 → solve_circuit 结果
+    """
+    items = list(scenarios.items())
+    max_workers = max_workers or min(len(items), os.cpu_count())
+    if max_workers == 1:
+        _init_worker(graph, base_resistance, kwargs)
+        return dict(_run_scenario(it) for it in items)
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                             initargs=(graph, base_resistance, kwargs)) as ex:
+        return dict(ex.map(_run_scenario, items))
@@ -1,18 +1,103 @@
 # -*- coding: utf-8 -*-
 """构建“人类干扰指数”（夜光 + 道路密度 + NO2/PM2.5 的标准化合成）"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
 import numpy as np
 import xarray as xr
+import rasterio
+import rasterio.shutil
+from rasterio import windows
+from ..utils.profiling import profiled, add_counts
+
+def _weights(n: int, weights=None):
+    if weights is None:
+        return np.ones(n) / n
+    weights = np.asarray(weights, dtype='float64')
+    if weights.shape != (n,):
+        raise ValueError(f"权重个数（{weights.size}）与图层数（{n}）不一致")
+    return weights
+
+def _weighted_block(blocks, weights):
+    """逐层累加 Σw·x 与 Σw（仅有效像元），返回重新归一化的加权平均；全部缺失处为 NaN"""
+    num = np.zeros(blocks[0].shape, dtype='float64')
+    den = np.zeros(blocks[0].shape, dtype='float64')
+    for x, w in zip(blocks, weights):
+        ok = np.isfinite(x)
+        num += np.where(ok, x, 0.0) * w
+        den += ok * w
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(den > 0, num / den, np.nan).astype('float32')
 
 def composite_disturbance(std_viirs: xr.DataArray, std_roads: xr.DataArray, std_no2: xr.DataArray, std_pm25: xr.DataArray, weights=None):
     """将多个标准化层合成为单一干扰指数（加权平均）
     参数:
-      std_*: 皆为已 z-score 标准化的栅格
+      std_*: 皆为已 z-score 标准化的栅格（须同一格网，见 airquality.standardize_layers）
       weights: 权重（默认等权）
     返回:
       xr.DataArray 干扰指数
+    说明：逐层累加而不拼接波段栈，输入为 dask 数组时保持惰性、按块融合计算；
+      某层缺失（NaN）的像元按其余层的权重重新归一化
     """
-    stack = xr.concat([std_viirs, std_roads, std_no2, std_pm25], dim='band')
-    if weights is None:
-        weights = np.ones(stack.sizes['band']) / stack.sizes['band']
-    out = (stack * xr.DataArray(weights, dims=['band'])).sum('band')
+    layers = [std_viirs, std_roads, std_no2, std_pm25]
+    weights = _weights(len(layers), weights)
+    num = den = 0
+    for da, w in zip(layers, weights):
+        ok = np.isfinite(da)
+        num = num + da.where(ok, 0.0) * w
+        den = den + ok * w
+    out = (num / den).where(den > 0)
     return out
+
+@profiled()
+def write_disturbance_cog(layers, out_path: Path, weights=None, block: int = 512,
+                          compress: str = 'deflate', max_workers: int = 4):
+    """按块融合加权合成并直接写出云优化 GeoTIFF（COG，分块、压缩、含金字塔）
+    参数:
+      layers: 同一格网的标准化图层列表（numpy 后端或 dask 惰性均可，如 open_aligned 的结果）
+      block: 处理与输出的块大小（像元）；内存占用约为 层数 × block² × 8 字节 × max_workers
+      max_workers: 并发计算块的线程数（只在主线程写出）
+    返回:
+      out_path
+    说明：先逐块写入分块中间 GeoTIFF，再由 GDAL COG 驱动流式生成金字塔并重排为临时 COG，
+      成功后原子替换 out_path；中途失败时删除中间文件，不留下残缺输出
+    """
+    ref = layers[0]
+    weights = _weights(len(layers), weights)
+    height, width = ref.shape[-2:]
+    add_counts(pixels=height * width)
+    for da in layers[1:]:
+        if da.shape[-2:] != (height, width):
+            raise ValueError("各图层须先对齐到同一格网（见 airquality.align_layers）")
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = out_path.with_name(f'{out_path.stem}.{os.getpid()}.tmp.tif')
+    cog_path = out_path.with_name(f'{out_path.stem}.{os.getpid()}.cog.tmp.tif')
+    profile = {
+        'driver': 'GTiff', 'dtype': 'float32', 'count': 1, 'nodata': np.nan,
+        'crs': ref.rio.crs, 'transform': ref.rio.transform(),
+        'width': width, 'height': height,
+        'tiled': True, 'blockxsize': block, 'blockysize': block, 'compress': compress,
+        'BIGTIFF': 'IF_SAFER',
+    }
+    wins = [windows.Window(c, r, min(block, width - c), min(block, height - r))
+            for r in range(0, height, block) for c in range(0, width, block)]
+
+    def _compute(win):
+        sl = dict(y=slice(win.row_off, win.row_off + win.height), x=slice(win.col_off, win.col_off + win.width))
+        blocks = [np.asarray(da.isel(**sl).values, dtype='float64') for da in layers]
+        return win, _weighted_block(blocks, weights)
+
+    try:
+        with rasterio.open(tmp_path, 'w', **profile) as dst, ThreadPoolExecutor(max_workers=max_workers) as ex:
+            # 分批提交，限制在途块数，避免结果堆积
+            for i in range(0, len(wins), max_workers * 4):
+                for win, data in ex.map(_compute, wins[i:i + max_workers * 4]):
+                    dst.write(data, 1, window=win)
+        rasterio.shutil.copy(tmp_path, cog_path, driver='COG', COMPRESS=compress.upper(),
+                             BLOCKSIZE=block, RESAMPLING='AVERAGE', PREDICTOR='YES', BIGTIFF='IF_SAFER')
+        os.replace(cog_path, out_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+        cog_path.unlink(missing_ok=True)
+    return out_path
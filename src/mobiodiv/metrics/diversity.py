@@ -1,24 +1,228 @@
 # -*- coding: utf-8 -*-
 """多样性指标：α、β（周转/嵌套）、功能/系统发育（基于 scikit-bio 的示例）"""
+from functools import lru_cache
 import numpy as np
 import pandas as pd
+from scipy import sparse
 from skbio.diversity import alpha_diversity, beta_diversity
 from skbio.tree import TreeNode
 from skbio import DistanceMatrix
+from ..utils.profiling import profiled
 
-def compute_alpha(count_matrix: np.ndarray, metric='shannon'):
-    """alpha 多样性（对每个样方/分层单元）"""
-    return alpha_diversity(metric=metric, counts=count_matrix, ids=[f'site_{i}' for i in range(count_matrix.shape[0])])
+# 向量化 α 内核支持的指标（名称与 skbio 一致，数值与 skbio.diversity.alpha_diversity 相同）
+ALPHA_METRICS = ('shannon', 'simpson', 'dominance', 'inv_simpson', 'enspie', 'observed_features', 'sobs',
+                 'chao1', 'pielou_e', 'margalef', 'menhinick', 'goods_coverage', 'berger_parker_d',
+                 'singles', 'doubles')
+DEFAULT_ALPHA_METRICS = ('shannon', 'simpson', 'observed_features', 'chao1', 'pielou_e')
+# 稀疏矩阵可直接计算（不致密化）的 β 指标
+SPARSE_BETA_METRICS = ('braycurtis', 'jaccard', 'sorensen')
 
-def compute_beta(count_matrix: np.ndarray, metric='braycurtis'):
-    """beta 多样性（场地两两之间），返回距离矩阵"""
-    dm = beta_diversity(metric=metric, counts=count_matrix, ids=[f'site_{i}' for i in range(count_matrix.shape[0])])
-    return dm
+def _site_ids(n, ids=None):
+    return list(ids) if ids is not None else [f'site_{i}' for i in range(n)]
 
-def phylogenetic_diversity(count_matrix: np.ndarray, tree_newick: str):
-    """系统发育多样性（Faith's PD 等，可按需扩展）
-    注意：需要物种-树端点的一致性与树校正。
+def _alpha_kernel(X: sparse.csr_matrix, metrics) -> dict:
+    """单次遍历 CSR 非零元，同时计算多个 α 指标
+    各指标只依赖少数逐行统计量（总数 N、物种数 S、单/双例数、Σp²、Σp·ln p、最大值），
+    先用 bincount 一次求出这些统计量，再组合为各指标；全零站点与 skbio 一样返回 NaN（计数类为 0）
+    """
+    n = X.shape[0]
+    nnz_per_row = np.diff(X.indptr)
+    rows = np.repeat(np.arange(n), nnz_per_row)
+    data = X.data
+    N = np.bincount(rows, weights=data, minlength=n)
+    S = nnz_per_row.astype('float64')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        N_nan = np.where(N > 0, N, np.nan)
+        p = data / N[rows]
+        stats = {}
+        need = set(metrics)
+        if need & {'shannon', 'pielou_e'}:
+            stats['H'] = np.where(N > 0, np.bincount(rows, weights=-p * np.log(p), minlength=n), np.nan)
+        if need & {'simpson', 'dominance', 'inv_simpson', 'enspie'}:
+            stats['D'] = np.where(N > 0, np.bincount(rows, weights=p * p, minlength=n), np.nan)
+        if need & {'chao1', 'singles', 'goods_coverage'}:
+            stats['F1'] = np.bincount(rows, weights=(data == 1), minlength=n)
+        if need & {'chao1', 'doubles'}:
+            stats['F2'] = np.bincount(rows, weights=(data == 2), minlength=n)
+        if 'berger_parker_d' in need:
+            mx = np.zeros(n)
+            nonempty = nnz_per_row > 0
+            mx[nonempty] = np.maximum.reduceat(data, X.indptr[:-1][nonempty])
+            stats['max'] = mx
+
+        out = {}
+        for m in metrics:
+            if m == 'shannon':
+                out[m] = stats['H']
+            elif m == 'simpson':
+                out[m] = 1.0 - stats['D']
+            elif m == 'dominance':
+                out[m] = stats['D']
+            elif m in ('inv_simpson', 'enspie'):
+                out[m] = 1.0 / stats['D']
+            elif m in ('observed_features', 'sobs'):
+                out[m] = nnz_per_row.astype('int64')
+            elif m == 'chao1':
+                F1, F2 = stats['F1'], stats['F2']
+                out[m] = S + F1 * (F1 - 1) / (2 * (F2 + 1))
+            elif m == 'pielou_e':
+                out[m] = np.where(S == 1, 1.0, stats['H'] / np.log(np.where(S > 0, S, np.nan)))
+            elif m == 'margalef':
+                out[m] = (S - 1) / np.log(N_nan)
+            elif m == 'menhinick':
+                out[m] = S / np.sqrt(N_nan)
+            elif m == 'goods_coverage':
+                out[m] = 1.0 - stats['F1'] / N_nan
+            elif m == 'berger_parker_d':
+                out[m] = stats['max'] / N_nan
+            elif m == 'singles':
+                out[m] = stats['F1'].astype('int64')
+            elif m == 'doubles':
+                out[m] = stats['F2'].astype('int64')
+            else:
+                raise ValueError(f"不支持的 α 指标: {m}（可选 {ALPHA_METRICS}）")
+    return out
+
+@profiled()
+def compute_alpha_batch(count_matrix, metrics=DEFAULT_ALPHA_METRICS, ids=None):
+    """批量 α 多样性：一次向量化遍历同时计算多个指标
+    参数:
+      count_matrix: 站点×物种计数（numpy 或 scipy.sparse；致密输入只做一次非零元提取）
+      metrics: 指标列表（见 ALPHA_METRICS）
+    返回:
+      DataFrame：行=站点（ids），列=指标
+    """
+    X = sparse.csr_matrix(count_matrix, dtype='float64')
+    X.eliminate_zeros()
+    out = _alpha_kernel(X, list(metrics))
+    return pd.DataFrame(out, index=_site_ids(X.shape[0], ids))
+
+def compute_alpha(count_matrix, metric='shannon', ids=None):
+    """alpha 多样性（对每个样方/分层单元）
+    count_matrix 可为 numpy 数组或 scipy.sparse 矩阵（如 community.build_count_matrix 的输出）；
+    ALPHA_METRICS 中的指标走向量化内核（稀疏输入不致密化），其余指标交给 skbio（仅支持致密输入）
+    多个指标请用 compute_alpha_batch，避免重复遍历矩阵
+    """
+    if metric in ALPHA_METRICS:
+        return compute_alpha_batch(count_matrix, [metric], ids=ids)[metric]
+    if sparse.issparse(count_matrix):
+        raise ValueError(f"稀疏矩阵不支持的 α 指标: {metric}（可选 {ALPHA_METRICS}）")
+    return alpha_diversity(metric=metric, counts=count_matrix, ids=_site_ids(count_matrix.shape[0], ids))
+
+def _sum_min(A: np.ndarray, X: sparse.csr_matrix, max_elems: int = 1 << 24) -> np.ndarray:
+    """Σ_k min(A[i,k], X[j,k])：A 为致密的少量行 (b×s)，X 为稀疏 (n×s)，返回 (b×n)
+    只在 X 的非零元上计算（X 为零处 min=0），用累积和按行分段求和；
+    中间数组为 行数×nnz，按 max_elems 再细分行以限制内存
+    """
+    out = np.empty((A.shape[0], X.shape[0]))
+    step = max(1, max_elems // max(X.nnz, 1))
+    for i in range(0, A.shape[0], step):
+        M = np.minimum(A[i:i + step, X.indices], X.data)
+        C = np.zeros((M.shape[0], M.shape[1] + 1))
+        np.cumsum(M, axis=1, out=C[:, 1:])
+        out[i:i + step] = C[:, X.indptr[1:]] - C[:, X.indptr[:-1]]
+    return out
+
+def _beta_sparse_block(X: sparse.csr_matrix, start: int, stop: int, metric: str,
+                       row_sum: np.ndarray = None, P: sparse.csr_matrix = None) -> np.ndarray:
+    """计算第 start:stop 行与全部站点之间的相异度（稀疏输入），返回 (stop-start)×n
+    braycurtis: 1 - 2Σmin / (Σa + Σb)；jaccard: 1 - |A∩B| / |A∪B|；sorensen: 1 - 2|A∩B| / (|A| + |B|)
+    """
+    if metric == 'braycurtis':
+        row_sum = np.asarray(X.sum(axis=1)).ravel() if row_sum is None else row_sum
+        num = 2.0 * _sum_min(X[start:stop].toarray(), X)
+        denom = row_sum[start:stop, None] + row_sum[None, :]
+    elif metric in ('jaccard', 'sorensen'):
+        # 存在/缺失：交集 = P Pᵀ
+        P = (X > 0).astype('float64').tocsr() if P is None else P
+        rich = np.diff(P.indptr).astype('float64')
+        inter = (P[start:stop] @ P.T).toarray()
+        denom = rich[start:stop, None] + rich[None, :]
+        if metric == 'jaccard':
+            num, denom = inter, denom - inter
+        else:
+            num = 2.0 * inter
+    else:
+        raise ValueError(f"稀疏矩阵不支持的 β 指标: {metric}（可选 {SPARSE_BETA_METRICS}）")
+    with np.errstate(divide='ignore', invalid='ignore'):
+        d = np.where(denom > 0, 1.0 - num / denom, 0.0)
+    return d
+
+@profiled()
+def compute_beta(count_matrix, metric='braycurtis', ids=None, block_rows: int = 256):
+    """beta 多样性（场地两两之间），返回距离矩阵
+    count_matrix 为 scipy.sparse 时，按行块直接在非零元上计算（SPARSE_BETA_METRICS），不致密化计数矩阵
+    """
+    if not sparse.issparse(count_matrix):
+        dm = beta_diversity(metric=metric, counts=count_matrix, ids=_site_ids(count_matrix.shape[0], ids))
+        return dm
+    X = sparse.csr_matrix(count_matrix, dtype='float64')
+    n = X.shape[0]
+    out = np.empty((n, n))
+    row_sum = np.asarray(X.sum(axis=1)).ravel()
+    P = (X > 0).astype('float64').tocsr()
+    for start in range(0, n, block_rows):
+        stop = min(start + block_rows, n)
+        out[start:stop] = _beta_sparse_block(X, start, stop, metric, row_sum=row_sum, P=P)
+    np.fill_diagonal(out, 0.0)
+    # 消除浮点误差带来的不对称
+    out = (out + out.T) / 2.0
+    return DistanceMatrix(out, ids=_site_ids(n, ids))
+
+@lru_cache(maxsize=8)
+def _tree_arrays(tree_newick: str):
+    """把 Newick 树预处理为扁平数组（按字符串缓存，跨分层/年份重复调用不再遍历树）
+    返回:
+      tip_names: 端点名（后序顺序）
+      lengths: 每个节点上方枝的枝长（根枝长度若有也计入，与 skbio 一致）
+      incidence: 端点×枝 CSR 矩阵，1 表示该枝位于端点到根的路径上
+    说明：按后序编号时，每个节点的子树端点是一段连续区间 [lo, hi)，据此直接构造稀疏矩阵
     """
     tree = TreeNode.read([tree_newick])
-    # TODO: 实现 PD 计算逻辑（此处留空，建议后续补充或使用现成函数）
-    return None
+    tip_names, lengths, lo, hi = [], [], [], []
+    first_tip = {}
+    n_tips = 0
+    for node in tree.postorder(include_self=True):
+        if node.is_tip():
+            first_tip[id(node)] = n_tips
+            tip_names.append(node.name)
+            n_tips += 1
+        else:
+            first_tip[id(node)] = first_tip[id(node.children[0])]
+        lo.append(first_tip[id(node)])
+        hi.append(n_tips)
+        lengths.append(node.length or 0.0)
+    lo, hi = np.asarray(lo), np.asarray(hi)
+    span = hi - lo
+    branch = np.repeat(np.arange(len(lo)), span)
+    tips = np.repeat(lo - np.cumsum(span) + span, span) + np.arange(span.sum())
+    incidence = sparse.csr_matrix((np.ones(len(tips)), (tips, branch)), shape=(n_tips, len(lo)))
+    return np.asarray(tip_names, dtype=object), np.asarray(lengths, dtype='float64'), incidence
+
+def phylogenetic_diversity(count_matrix, tree_newick: str, taxa=None, ids=None):
+    """系统发育多样性（Faith's PD），一次稀疏矩阵乘法得到全部站点
+    参数:
+      count_matrix: 站点×物种矩阵（numpy 或 scipy.sparse）
+      tree_newick: Newick 字符串（物种名需与树端点一致；预处理结果按字符串缓存）
+      taxa: 各列的物种名；为 None 时假定列已按树端点（后序）顺序排列
+    返回:
+      pd.Series：每个站点的 Faith's PD（端点到根路径上所有枝长之和，与 skbio faith_pd 一致）
+    """
+    tip_names, lengths, incidence = _tree_arrays(tree_newick)
+    X = sparse.csr_matrix(count_matrix)
+    if taxa is None:
+        if X.shape[1] != len(tip_names):
+            raise ValueError("未给出 taxa 时，列数必须等于树的端点数")
+        cols = np.arange(len(tip_names))
+    else:
+        pos = pd.Index(tip_names).get_indexer(list(taxa))
+        if (pos < 0).any():
+            missing = [t for t, p in zip(taxa, pos) if p < 0]
+            raise ValueError(f"以下物种不在系统发育树中: {missing[:10]}")
+        cols = pos
+    # 存在/缺失 → 覆盖到各枝的端点数 → 枝是否被覆盖 → 加权求和
+    presence = (X > 0).astype('float64')
+    covered = presence @ incidence[cols]
+    covered.data[:] = 1.0
+    pd_values = covered @ lengths
+    return pd.Series(np.asarray(pd_values).ravel(), index=_site_ids(X.shape[0], ids), name='faith_pd')
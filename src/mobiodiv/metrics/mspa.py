@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+"""形态学空间格局分析（MSPA）：把栖息地掩膜分为 核心/孤岛/穿孔/边缘/环/桥/支线 七类
+全部由向量化的形态学运算与连通标记完成；大幅掩膜按瓦片并行处理：局部运算带光晕（halo），
+依赖整个连通体的判定用整幅连通标记（跨瓦片接缝合并），结果与整幅计算一致
+类别编码沿用 GuidosToolbox 的取值，便于与其输出对照
+"""
+import os
+import shutil
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from scipy import ndimage
+from ..config import INTERIM_DIR, CRS_WGS84
+from ..utils.grid import cell_area_km2, unit_ids
+from ..utils.parallel import as_memmap, tile_windows, run_tasks
+from .landscape import label_components, global_ids
+from ..utils.profiling import profiled, add_counts
+
+MSPA_CLASSES = {
+    'core': 17, 'islet': 9, 'perforation': 5, 'edge': 3,
+    'loop': 65, 'bridge': 33, 'branch': 1,
+}
+
+_EIGHT = np.ones((3, 3), dtype=bool)
+_FOUR = ndimage.generate_binary_structure(2, 1)
+
+# 分瓦片分类的状态位：前 4 位为局部形态学结果，后 2 位为整幅连通判定结果
+_FG, _CORE, _OPENED, _CONTACT, _ISLET, _HOLE = 1, 2, 4, 8, 16, 32
+
+# 工作进程共享的只读数据（由 initializer 设置）
+_W = {}
+
+def _neighbor_pairs(lab_a, lab_b):
+    """lab_a 的像元与其 8 邻域内 lab_b 的像元构成的 (a, b) 标号对（去重）"""
+    H, W = lab_a.shape
+    pa = np.pad(lab_a, 1)
+    pb = np.pad(lab_b, 1)
+    pairs = []
+    for dr in (-1, 0, 1):
+        for dc in (-1, 0, 1):
+            if dr == 0 and dc == 0:
+                continue
+            a = pa[1:H + 1, 1:W + 1]
+            b = pb[1 + dr:H + 1 + dr, 1 + dc:W + 1 + dc]
+            ok = (a > 0) & (b > 0)
+            pairs.append(np.stack([a[ok], b[ok]], axis=1))
+    pairs = np.concatenate(pairs)
+    return np.unique(pairs, axis=0) if len(pairs) else pairs.reshape(0, 2)
+
+def mspa_block(mask, edge_width: int = 1):
+    """单块 MSPA 分类（块外视为背景）
+    参数:
+      mask: 二值栖息地掩膜（前景 8 邻域连通）
+      edge_width: 边缘宽度（像元）
+    返回:
+      uint8 类别数组（0 为背景，其余见 MSPA_CLASSES）
+    """
+    fg = np.asarray(mask) > 0
+    out = np.zeros(fg.shape, dtype=np.uint8)
+    if not fg.any():
+        return out
+    core = ndimage.binary_erosion(fg, _EIGHT, iterations=edge_width, border_value=0)
+
+    # 孤岛：不含核心的前景连通体
+    lab_fg, n_fg = ndimage.label(fg, _EIGHT)
+    has_core = np.zeros(n_fg + 1, dtype=bool)
+    has_core[np.unique(lab_fg[core])] = True
+    has_core[0] = False
+    islet = fg & ~has_core[lab_fg]
+
+    # 核心区（开运算）：核心外扩 edge_width 且在前景内；其中非核心像元为边缘或穿孔
+    opened = ndimage.binary_dilation(core, _EIGHT, iterations=edge_width) & fg
+    boundary = opened & ~core
+    # 开运算结果以外的 4 邻域连通体中，不接触块边界的是核心区内部的孔洞
+    lab_bg, n_bg = ndimage.label(~opened, _FOUR)
+    touches = np.zeros(n_bg + 1, dtype=bool)
+    touches[np.unique(np.concatenate([lab_bg[0], lab_bg[-1], lab_bg[:, 0], lab_bg[:, -1]]))] = True
+    hole = (lab_bg > 0) & ~touches[lab_bg]
+    exterior = (lab_bg > 0) & touches[lab_bg]
+    near_hole = ndimage.binary_dilation(hole, _EIGHT)
+    near_ext = ndimage.binary_dilation(exterior, _EIGHT)
+    perforation = boundary & near_hole & ~near_ext
+
+    # 其余前景：连接多个核心区为桥，同一核心区多处相接为环，否则为支线
+    rest = fg & ~opened & ~islet
+    lab_r, n_r = ndimage.label(rest, _EIGHT)
+    lab_o, _ = ndimage.label(opened, _EIGHT)
+    n_core = np.zeros(n_r + 1, dtype=np.int64)
+    pairs = _neighbor_pairs(lab_r, lab_o)
+    np.add.at(n_core, pairs[:, 0], 1)
+    contact = rest & ndimage.binary_dilation(opened, _EIGHT)
+    lab_c, _ = ndimage.label(contact, _EIGHT)
+    n_contact = np.bincount(np.unique(np.stack([lab_r[contact], lab_c[contact]], axis=1), axis=0)[:, 0],
+                            minlength=n_r + 1) if contact.any() else np.zeros(n_r + 1, dtype=np.int64)
+    kind = np.full(n_r + 1, MSPA_CLASSES['branch'], dtype=np.uint8)
+    kind[(n_core == 1) & (n_contact >= 2)] = MSPA_CLASSES['loop']
+    kind[n_core >= 2] = MSPA_CLASSES['bridge']
+
+    out[rest] = kind[lab_r[rest]]
+    out[boundary] = MSPA_CLASSES['edge']
+    out[perforation] = MSPA_CLASSES['perforation']
+    out[core] = MSPA_CLASSES['core']
+    out[islet] = MSPA_CLASSES['islet']
+    return out
+
+def _init_worker(state):
+    _W.clear()
+    _W.update(state)
+    for key in ('mask', 'bits', 'classes', 'lab_a', 'lab_b', 'lab_c'):
+        if f'{key}_path' in state:
+            _W[key] = np.load(state[f'{key}_path'], mmap_mode='r+' if key in ('bits', 'classes') else 'r')
+    if 'geoms' in state:
+        _W['tree'] = shapely.STRtree(state['geoms'])
+
+def _halo_window(r0, r1, c0, c1, halo):
+    H, W = _W['shape']
+    return max(r0 - halo, 0), min(r1 + halo, H), max(c0 - halo, 0), min(c1 + halo, W)
+
+def _gid(key, r0, r1, c0, c1):
+    """窗口内某个标记栅格（lab_a/lab_b/lab_c）的全局连通体号"""
+    base, comp = _W[f'{key}_comp']
+    return global_ids(_W[key][r0:r1, c0:c1], r0, c0, _W['tile'], _W['n_tc'], base, comp)
+
+def _morph_tile(task):
+    """局部形态学：核心、开运算、与开运算相接的非核心前景；只依赖 2×edge_width+1 邻域，带光晕计算即与整幅一致"""
+    r0, r1, c0, c1 = task
+    ew = _W['edge_width']
+    hr0, hr1, hc0, hc1 = _halo_window(r0, r1, c0, c1, 2 * ew + 2)
+    fg = np.asarray(_W['mask'][hr0:hr1, hc0:hc1]) > 0
+    core = ndimage.binary_erosion(fg, _EIGHT, iterations=ew, border_value=0)
+    opened = ndimage.binary_dilation(core, _EIGHT, iterations=ew) & fg
+    contact = fg & ~opened & ndimage.binary_dilation(opened, _EIGHT)
+    bits = (fg * _FG | core * _CORE | opened * _OPENED | contact * _CONTACT).astype(np.uint8)
+    _W['bits'][r0:r1, c0:c1] = bits[r0 - hr0:r1 - hr0, c0 - hc0:c1 - hc0]
+    _W['bits'].flush()
+    return r1 - r0
+
+def _core_components(task):
+    """瓦片内含核心像元的前景连通体号"""
+    r0, r1, c0, c1 = task
+    g = _gid('lab_a', r0, r1, c0, c1)
+    return np.unique(g[(np.asarray(_W['bits'][r0:r1, c0:c1]) & _CORE) > 0])
+
+def _mark_tile(task):
+    """lab_a 中 flag 为 True 的连通体像元置位 _W['bit']"""
+    r0, r1, c0, c1 = task
+    if not len(_W['flag']):
+        return r1 - r0
+    g = _gid('lab_a', r0, r1, c0, c1)
+    hit = (g >= 0) & _W['flag'][np.maximum(g, 0)]
+    if hit.any():
+        bits = np.asarray(_W['bits'][r0:r1, c0:c1])
+        _W['bits'][r0:r1, c0:c1] = np.where(hit, bits | _W['bit'], bits)
+        _W['bits'].flush()
+    return r1 - r0
+
+def _rest_pairs(task):
+    """非核心区前景连通体（lab_b）与 8 邻接的开运算连通体（lab_a）、其内接触段（lab_c）的 (连通体, 连通体) 对
+    瓦片外读 1 像元光晕，跨瓦片的邻接由 rest 像元所在瓦片负责统计
+    """
+    r0, r1, c0, c1 = task
+    hr0, hr1, hc0, hc1 = _halo_window(r0, r1, c0, c1, 1)
+    rest = _gid('lab_b', r0, r1, c0, c1)
+    R = np.full((hr1 - hr0 + 2, hc1 - hc0 + 2), -1, dtype=np.int64)
+    O = np.full_like(R, -1)
+    R[1 + r0 - hr0:1 + r1 - hr0, 1 + c0 - hc0:1 + c1 - hc0] = rest
+    O[1:-1, 1:-1] = _gid('lab_a', hr0, hr1, hc0, hc1)
+    h, w = R.shape[0] - 2, R.shape[1] - 2
+    a = R[1:h + 1, 1:w + 1]
+    core_pairs = []
+    for dr in (-1, 0, 1):
+        for dc in (-1, 0, 1):
+            if dr == 0 and dc == 0:
+                continue
+            b = O[1 + dr:h + 1 + dr, 1 + dc:w + 1 + dc]
+            ok = (a >= 0) & (b >= 0)
+            core_pairs.append(np.stack([a[ok], b[ok]], axis=1))
+    core_pairs = np.unique(np.concatenate(core_pairs), axis=0)
+    contact = _gid('lab_c', r0, r1, c0, c1)
+    sel = contact >= 0
+    contact_pairs = np.unique(np.stack([rest[sel], contact[sel]], axis=1), axis=0)
+    return core_pairs, contact_pairs
+
+def _classify_tile(task):
+    """由状态位与非核心区连通体类别写出最终类别（穿孔判定读 1 像元光晕）"""
+    r0, r1, c0, c1 = task
+    hr0, hr1, hc0, hc1 = _halo_window(r0, r1, c0, c1, 1)
+    win = np.asarray(_W['bits'][hr0:hr1, hc0:hc1])
+    cs = (slice(r0 - hr0, r1 - hr0), slice(c0 - hc0, c1 - hc0))
+    near_hole = ndimage.binary_dilation((win & _HOLE) > 0, _EIGHT)[cs]
+    near_ext = ndimage.binary_dilation((win & (_OPENED | _HOLE)) == 0, _EIGHT)[cs]
+    bits = win[cs]
+    fg, core, opened, islet = ((bits & b) > 0 for b in (_FG, _CORE, _OPENED, _ISLET))
+    boundary = opened & ~core
+    rest = fg & ~opened & ~islet
+    out = np.zeros(bits.shape, dtype=np.uint8)
+    if rest.any():
+        out[rest] = _W['kind'][_gid('lab_b', r0, r1, c0, c1)[rest]]
+    out[boundary] = MSPA_CLASSES['edge']
+    out[boundary & near_hole & ~near_ext] = MSPA_CLASSES['perforation']
+    out[core] = MSPA_CLASSES['core']
+    out[islet] = MSPA_CLASSES['islet']
+    _W['classes'][r0:r1, c0:c1] = out
+    _W['classes'].flush()
+    return r1 - r0
+
+def _summary_tile(task):
+    """单瓦片：按 (单元, 类别) 累加面积（m²）"""
+    r0, r1, c0, c1 = task
+    units = unit_ids(_W, r0, r1, c0, c1)
+    cls = np.asarray(_W['classes'][r0:r1, c0:c1])
+    sel = (units >= 0) & (cls > 0)
+    if not sel.any():
+        return None
+    area = np.broadcast_to(_W['row_area_m2'][r0:r1, None], cls.shape)[sel]
+    return pd.DataFrame({'unit': units[sel], 'cls': cls[sel], 'area_m2': area}).groupby(['unit', 'cls']).sum()
+
+@profiled()
+def mspa_classify(mask, edge_width: int = 1, tile: int = 2048, max_workers: int = None,
+                  work_dir: Path = INTERIM_DIR / 'mspa'):
+    """分瓦片并行 MSPA 分类，结果与整幅 mspa_block 逐像元一致
+    参数:
+      mask: 栖息地二值掩膜（numpy、dask 或 xr.DataArray，如 landcover.habitat_mask 的结果）
+      edge_width: 边缘宽度（像元）
+      tile: 瓦片大小（像元）
+      max_workers: 进程数（默认 CPU 核数；1 时在本进程内计算）
+    返回:
+      np.memmap（uint8 类别栅格，work_dir/classes.npy）
+    说明：
+      1) 核心/开运算/接触像元只依赖 2×edge_width+1 邻域，按 瓦片+光晕 计算后写入状态位栅格
+      2) 依赖整个连通体的判定在整幅上做：前景（孤岛 = 不含核心）、开运算以外的 4 邻域连通体
+         （不接触栅格边界的为孔洞）、开运算区、非核心区前景及其接触段，分别逐瓦片标记后
+         按 landscape.label_components 合并接缝，得到全局连通体号
+      3) 非核心区连通体与开运算连通体的邻接对、接触段数在瓦片间汇总后确定 桥/环/支线，再逐瓦片写出类别
+    """
+    work_dir = Path(work_dir)
+    work_dir.mkdir(parents=True, exist_ok=True)
+    mm = as_memmap(mask, work_dir / 'mask.npy')
+    shape = mm.shape
+    H, W = shape
+    max_workers = max_workers or os.cpu_count()
+    tasks = tile_windows(shape, tile)
+    paths = {key: work_dir / f'{key}.npy' for key in ('bits', 'lab_a', 'lab_b', 'lab_c', 'classes')}
+    for key, path in paths.items():
+        dtype = np.uint8 if key in ('bits', 'classes') else np.int32
+        np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape).flush()
+    state = {'shape': shape, 'tile': tile, 'n_tc': -(-W // tile), 'edge_width': edge_width,
+             'mask_path': str(mm.filename), 'bits_path': str(paths['bits'])}
+
+    def label(key, **bits):
+        return label_components(paths['bits'], paths[key], shape, tile, max_workers, **bits)
+
+    def n_comp(comp):
+        return int(comp.max()) + 1 if len(comp) else 0
+
+    # 1) 局部形态学 → 状态位
+    run_tasks(_morph_tile, tasks, _init_worker, state, max_workers)
+
+    # 2a) 孤岛：不含核心像元的前景连通体
+    fg_comp = label('lab_a', any_bits=_FG)
+    st = {**state, 'lab_a_path': str(paths['lab_a']), 'lab_a_comp': fg_comp}
+    has_core = np.zeros(n_comp(fg_comp[1]), dtype=bool)
+    for ids in run_tasks(_core_components, tasks, _init_worker, st, max_workers):
+        has_core[ids] = True
+    run_tasks(_mark_tile, tasks, _init_worker, {**st, 'flag': ~has_core, 'bit': _ISLET}, max_workers)
+
+    # 2b) 孔洞：开运算以外、不接触栅格边界的 4 邻域连通体
+    bg_comp = label('lab_a', any_bits=0, none_bits=_OPENED, diagonal=False)
+    lab = np.load(paths['lab_a'], mmap_mode='r')
+    touches = np.zeros(n_comp(bg_comp[1]), dtype=bool)
+    n_tc = state['n_tc']
+    for line, r0, c0 in ((lab[:1], 0, 0), (lab[-1:], H - 1, 0), (lab[:, :1], 0, 0), (lab[:, -1:], 0, W - 1)):
+        g = global_ids(line, r0, c0, tile, n_tc, *bg_comp)
+        touches[g[g >= 0]] = True
+    del lab
+    run_tasks(_mark_tile, tasks, _init_worker, {**state, 'lab_a_path': str(paths['lab_a']),
+                                                'lab_a_comp': bg_comp, 'flag': ~touches, 'bit': _HOLE},
+              max_workers)
+
+    # 3) 非核心区前景：相接的开运算连通体数（≥2 为桥）、接触段数（同一核心区相接 ≥2 处为环）
+    st = {**state, 'lab_a_path': str(paths['lab_a']), 'lab_b_path': str(paths['lab_b']),
+          'lab_c_path': str(paths['lab_c'])}
+    st['lab_a_comp'] = label('lab_a', any_bits=_OPENED)
+    st['lab_b_comp'] = label('lab_b', any_bits=_FG, none_bits=_OPENED | _ISLET)
+    st['lab_c_comp'] = label('lab_c', any_bits=_CONTACT)
+    n_rest = n_comp(st['lab_b_comp'][1])
+    results = run_tasks(_rest_pairs, tasks, _init_worker, st, max_workers)
+    core_pairs = np.unique(np.concatenate([r[0] for r in results]), axis=0)
+    contact_pairs = np.unique(np.concatenate([r[1] for r in results]), axis=0)
+    n_core = np.bincount(core_pairs[:, 0], minlength=n_rest)
+    n_contact = np.bincount(contact_pairs[:, 0], minlength=n_rest)
+    kind = np.full(n_rest, MSPA_CLASSES['branch'], dtype=np.uint8)
+    kind[(n_core == 1) & (n_contact >= 2)] = MSPA_CLASSES['loop']
+    kind[n_core >= 2] = MSPA_CLASSES['bridge']
+
+    # 4) 逐瓦片写出类别
+    st.update(classes_path=str(paths['classes']), kind=kind)
+    run_tasks(_classify_tile, tasks, _init_worker, st, max_workers)
+    for key in ('bits', 'lab_a', 'lab_b', 'lab_c'):
+        paths[key].unlink(missing_ok=True)
+    return np.load(paths['classes'], mmap_mode='r')
+
+def check_tiling(shape=(600, 600), tile: int = 128, edge_width: int = 1, density: float = 0.6,
+                 seed: int = 0, max_workers: int = 1, work_dir: Path = INTERIM_DIR / 'mspa_check'):
+    """分瓦片分类与整幅 mspa_block 的一致性检查（随机平滑掩膜，tile 小于掩膜以覆盖接缝）
+    返回:
+      不一致的像元数（应为 0）
+    """
+    rng = np.random.default_rng(seed)
+    field = ndimage.gaussian_filter(rng.random(shape), 3)
+    mask = (field > np.quantile(field, 1 - density)).astype(np.uint8)
+    tiled = mspa_classify(mask, edge_width=edge_width, tile=tile, max_workers=max_workers, work_dir=work_dir)
+    n_diff = int((np.asarray(tiled) != mspa_block(mask, edge_width)).sum())
+    del tiled
+    shutil.rmtree(work_dir, ignore_errors=True)
+    return n_diff
+
+@profiled()
+def mspa_summary(classes, transform, crs=CRS_WGS84, units: gpd.GeoDataFrame = None,
+                 block: int = None, tile: int = 2048, max_workers: int = None):
+    """按单元（或规则分块）汇总各 MSPA 类别面积
+    参数:
+      classes: mspa_classify 的结果（内存映射 .npy）
+      units/block: 同 landscape.patch_metrics
+    返回:
+      DataFrame：<类别>_ha（面积，公顷）与 <类别>_pct（占该单元栖息地面积的百分比）
+    """
+    if units is None and block is None:
+        raise ValueError("需要给出 units（单元多边形）或 block（分块边长）")
+    if not isinstance(classes, np.memmap):
+        raise ValueError("classes 须为 mspa_classify 返回的内存映射数组")
+    shape = classes.shape
+    add_counts(pixels=shape[0] * shape[1])
+    state = {'classes_path': str(classes.filename), 'shape': shape,
+             'transform': transform, 'block': block,
+             'row_area_m2': cell_area_km2(transform, shape, crs) * 1e6}
+    if units is not None:
+        units = units.to_crs(crs)
+        state['geoms'] = list(units.geometry.values)
+    parts = [r for r in run_tasks(_summary_tile, tile_windows(shape, tile), _init_worker, state,
+                                  max_workers or os.cpu_count())
+             if r is not None]
+    names = {code: name for name, code in MSPA_CLASSES.items()}
+    if parts:
+        wide = pd.concat(parts).groupby(level=['unit', 'cls'])['area_m2'].sum().unstack('cls', fill_value=0.0)
+    else:
+        wide = pd.DataFrame(dtype='float64')
+    wide = wide.reindex(columns=list(MSPA_CLASSES.values()), fill_value=0.0).rename(columns=names) / 1e4
+    wide.columns.name = None
+    if units is not None:
+        wide = wide.reindex(range(len(units)), fill_value=0.0)
+        wide.index = units.index
+    total = wide.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pct = wide.div(total, axis=0) * 100
+    out = pd.concat([wide.add_suffix('_ha'), pct.add_suffix('_pct')], axis=1)
+    out.index.name = 'unit' if units is None else units.index.name
+    return out
@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
-"""差分中的差分（DiD）与面板模型（linearmodels）"""
+"""差分中的差分（DiD）与面板模型（linearmodels）
+批量估计：双向固定效应用交替投影一次性去均值，多个结局变量作为多右端最小二乘同时求解，
+标准误按聚类稳健（CR1）计算；支持按子样本（分层 × 城市等）分组与事件研究（前导/滞后）
+"""
+import warnings
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
+from scipy import stats
 from linearmodels.panel import PanelOLS
-import statsmodels.api as sm
+from ..utils.profiling import profiled, add_counts
 
+@profiled()
 def run_did(df: pd.DataFrame, y: str, treat: str, post: str, fe_unit: str, fe_time: str, covars=None):
     """经典二元 DiD：y ~ treat*post + FE(单位, 时间) + 协变量
     参数:
@@ -16,12 +24,210 @@ def run_did(df: pd.DataFrame, y: str, treat: str, post: str, fe_unit: str, fe_ti
       covars: 其他控制变量列表
     返回:
       回归结果对象
+    说明：treat、post 与常数项分别被个体、时间固定效应吸收，只保留交互项；
+      多个结局或子样本请用 did_batch（系数相同；did_batch 的 K 不含嵌套于聚类的个体固定效应，
+      标准误略小于本函数）
     """
-    work = df.copy().set_index([fe_unit, fe_time])
-    X_terms = [f'{treat}', f'{post}', f'{treat}:{post}']
-    if covars:
-        X_terms += covars
-    X = sm.add_constant(work[X_terms], has_constant='add')
+    cols = [fe_unit, fe_time, y] + list(covars or [])
+    work = df[cols].set_index([fe_unit, fe_time])
+    work[f'{treat}:{post}'] = (df[treat].to_numpy() * df[post].to_numpy()).astype(float)
+    X = work[[f'{treat}:{post}'] + list(covars or [])]
     mod = PanelOLS(work[y], X, entity_effects=True, time_effects=True)
     res = mod.fit(cov_type='clustered', cluster_entity=True)
     return res
+
+def _drop_singletons(codes, keep):
+    """反复剔除在任一固定效应中只出现一次的观测（对系数无信息，且会低估自由度）"""
+    while True:
+        drop = np.zeros(len(keep), dtype=bool)
+        for c in codes:
+            cnt = np.bincount(c[keep], minlength=c.max() + 1)
+            drop |= keep & (cnt[c] == 1)
+        if not drop.any():
+            return keep
+        keep = keep & ~drop
+
+def demean_fe(M, codes, tol: float = 1e-8, maxiter: int = 1000):
+    """交替投影（逐个固定效应减组均值，直到各组均值趋零）吸收多组固定效应
+    参数:
+      M: (n, p) 数组；列优先（order='F'）的 float64 数组原地修改，否则先复制
+      codes: 各固定效应的整数编码列表（0..G-1）
+      tol: 收敛阈值（各组均值相对列标准差的最大值）
+    返回:
+      (去均值后的数组, 最大迭代次数)
+    说明：各列独立迭代（np.bincount 求组均值），单个固定效应或平衡面板一轮即精确收敛
+    """
+    M = np.asarray(M, dtype=np.float64)
+    if not M.flags.f_contiguous:
+        M = np.asfortranarray(M)
+    fes = [(c, np.maximum(np.bincount(c), 1).astype(np.float64)) for c in codes]
+    iters = 0
+    for j in range(M.shape[1]):
+        col = M[:, j]
+        scale = col.std() or 1.0
+        for it in range(1, maxiter + 1):
+            delta = 0.0
+            for c, cnt in fes:
+                means = np.bincount(c, weights=col, minlength=len(cnt)) / cnt
+                col -= means[c]
+                delta = max(delta, float(np.abs(means).max()) / scale)
+            if len(fes) == 1 or delta < tol:
+                break
+        iters = max(iters, it)
+    return M, iters
+
+def _event_terms(rel, window, ref):
+    """相对处理时间 → 事件研究虚拟变量（两端分箱，ref 期为基期；从未处理的单位全为 0）"""
+    lo, hi = window
+    rel = np.clip(rel, lo, hi)
+    names, cols = [], []
+    for k in range(lo, hi + 1):
+        if k == ref:
+            continue
+        names.append(f'lead{-k}' if k < 0 else f'lag{k}')
+        cols.append((rel == k).astype(np.float64))
+    return names, np.column_stack(cols)
+
+def _relative_time(unit_codes, time_codes, treated):
+    """各单位首次处理的期次 → 相对期次（期次按时间排序编码；从未处理为 NaN）"""
+    first = np.full(unit_codes.max() + 1, np.inf)
+    np.minimum.at(first, unit_codes[treated], time_codes[treated])
+    rel = time_codes - first[unit_codes]
+    return np.where(np.isfinite(rel), rel, np.nan)
+
+def _fit(Z, q, codes, cl, tol, maxiter):
+    """单个样本：去均值 → 多右端最小二乘 → 聚类稳健协方差（CR1）
+    Z 为列优先的 [结局(q 列) | 解释变量] 矩阵，原地去均值
+    返回: (B, se, n, G, iters)；解释变量在吸收固定效应后共线（不可识别）时返回 None
+    """
+    n, k = Z.shape[0], Z.shape[1] - q
+    Z, iters = demean_fe(Z, codes, tol, maxiter)
+    Yd, Xd = Z[:, :q], np.ascontiguousarray(Z[:, q:])
+    XtX = Xd.T @ Xd
+    if np.linalg.matrix_rank(XtX) < k:
+        return None
+    bread = np.linalg.inv(XtX)
+    B = bread @ (Xd.T @ Yd)
+    cl_codes = pd.factorize(cl)[0]
+    G = int(cl_codes.max()) + 1
+    C = sp.csr_matrix((np.ones(n), (cl_codes, np.arange(n))), shape=(G, n))
+    # 固定效应若嵌套于聚类（如按单位聚类时的单位 FE），其自由度不计入 K
+    df_fe = 0
+    for c in codes:
+        owner = np.empty(int(c.max()) + 1, dtype=np.int64)
+        owner[c] = cl_codes
+        if not (owner[c] == cl_codes).all():
+            df_fe += len(owner) - 1
+    adj = G / (G - 1) * (n - 1) / max(n - k - df_fe, 1)
+    se = np.empty((k, q))
+    for j in range(q):
+        u = Yd[:, j] - Xd @ B[:, j]
+        S = C @ (Xd * u[:, None])
+        V = adj * bread @ (S.T @ S) @ bread
+        se[:, j] = np.sqrt(np.clip(np.diag(V), 0, None))
+    return B, se, n, G, iters
+
+@profiled()
+def did_batch(df: pd.DataFrame, outcomes, fe_unit: str, fe_time: str, treat: str = None, post: str = None,
+              covars=None, cluster: str = None, by=None, event_window: tuple = None,
+              event_time: str = None, ref: int = -1, tol: float = 1e-8, maxiter: int = 1000):
+    """批量双向固定效应 DiD / 事件研究
+    参数:
+      df: 长表面板
+      outcomes: 结局变量列名列表（同一样本内一起求解）
+      fe_unit/fe_time: 个体与时间固定效应键
+      treat/post: 处理组与处理后指示；回归项为二者交互（主效应被固定效应吸收）
+      covars: 随时间变化的控制变量列表
+      cluster: 聚类变量（默认 fe_unit）
+      by: 分组列（如 ['stratum', 'city_id']），每组单独估计
+      event_window: (最早前导, 最晚滞后)，如 (-4, 4)；给出时改为事件研究，两端期次分箱
+      event_time: 相对处理期次列；缺省时由 treat*post 首次为 1 的观测期次推算（期次按 fe_time 排序编码）
+      ref: 事件研究基期（默认 -1）
+      tol/maxiter: 交替投影的收敛阈值与最大迭代次数
+    返回:
+      长表：[by...] outcome, term, coef, se, t, p, ci_low, ci_high, nobs, n_clusters, fe_iter
+    说明：各组内按结局的缺失模式划分样本，缺失模式相同的结局共用一次去均值；先反复剔除单例观测；
+      小样本调整 G/(G-1)·(N-1)/(N-K)，K 不含嵌套于聚类的固定效应（同 reghdfe）；p 值与置信区间按 t(G-1) 分布
+      与 run_did（PanelOLS）相比系数一致，但 PanelOLS 把个体固定效应计入 K，按个体聚类时其标准误
+      略大（如 0.243 对 0.227）；需与其对齐时请用 run_did
+      观测不足、聚类少于 2 个或解释变量共线（如处理变量在组内无变异）的样本不输出，并以一条 warning
+      列出被跳过的分组键、结局与原因
+    """
+    outcomes = [outcomes] if isinstance(outcomes, str) else list(outcomes)
+    covars = list(covars or [])
+    cluster = cluster or fe_unit
+    add_counts(records=len(df))
+    by = [by] if isinstance(by, str) else list(by or [])
+    if event_window is None and (treat is None or post is None):
+        raise ValueError("需要给出 treat 与 post，或 event_window（事件研究）")
+    if event_window is not None and event_time is None and (treat is None or post is None):
+        raise ValueError("事件研究需要 event_time 列，或 treat 与 post 以推算相对期次")
+
+    unit_codes = pd.factorize(df[fe_unit])[0]
+    time_codes = pd.factorize(df[fe_time], sort=True)[0]
+    if event_window is None:
+        terms = [f'{treat}:{post}']
+        D = (df[treat].to_numpy(dtype=float) * df[post].to_numpy(dtype=float))[:, None]
+    else:
+        if event_time is not None:
+            rel = df[event_time].to_numpy(dtype=float)
+        else:
+            treated = (df[treat].to_numpy(dtype=float) * df[post].to_numpy(dtype=float)) > 0
+            rel = _relative_time(unit_codes, time_codes, treated)
+        terms, D = _event_terms(rel, event_window, ref)
+    # 按列取数，避免复制整表
+    xcols = list(D.T) + [df[c].to_numpy(dtype=float) for c in covars]
+    ycols = [df[c].to_numpy(dtype=float) for c in outcomes]
+    terms = terms + covars
+    cl = df[cluster].to_numpy()
+    base = (unit_codes >= 0) & (time_codes >= 0) & pd.notna(cl)
+    for x in xcols:
+        base &= np.isfinite(x)
+
+    groups = df.groupby(by, sort=True).indices.items() if by else [((), np.arange(len(df)))]
+    rows, skipped = [], []
+    for key, idx in groups:
+        key = key if isinstance(key, tuple) else (key,)
+        idx = idx[base[idx]]
+        # 按缺失模式把结局分组：每种“哪些结局可用”的行集合只去均值一次
+        col_sets = {}
+        for j, y in enumerate(ycols):
+            col_sets.setdefault(np.isfinite(y[idx]).tobytes(), []).append(j)
+        for pattern, js in col_sets.items():
+            sel = np.frombuffer(pattern, dtype=bool)
+            codes = [unit_codes[idx], time_codes[idx]]
+            keep = _drop_singletons(codes, sel.copy())
+            names = [outcomes[j] for j in js]
+            if keep.sum() <= len(terms) + 1:
+                skipped.append((key, names, '观测不足'))
+                continue
+            rows_k = idx[keep]
+            codes = [pd.factorize(c[keep])[0] for c in codes]
+            if len(np.unique(cl[rows_k])) < 2:
+                skipped.append((key, names, '聚类少于 2 个'))
+                continue
+            Z = np.empty((len(rows_k), len(js) + len(xcols)), order='F')
+            for i, col in enumerate([ycols[j] for j in js] + xcols):
+                np.take(col, rows_k, out=Z[:, i])
+            fit = _fit(Z, len(js), codes, cl[rows_k], tol, maxiter)
+            if fit is None:
+                # 该子样本内处理变量无变异（如全为处理组），无法识别
+                skipped.append((key, names, '解释变量共线'))
+                continue
+            B, se, n, G, iters = fit
+            for jj, j in enumerate(js):
+                for t, term in enumerate(terms):
+                    rows.append(key + (outcomes[j], term, B[t, jj], se[t, jj], n, G, iters))
+    if skipped:
+        detail = '；'.join(f"{dict(zip(by, key)) if by else '全样本'} {names}：{why}" for key, names, why in skipped)
+        warnings.warn(f"{len(skipped)} 个样本无法估计，已跳过：{detail}")
+    out = pd.DataFrame(rows, columns=by + ['outcome', 'term', 'coef', 'se', 'nobs', 'n_clusters', 'fe_iter'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out['t'] = out['coef'] / out['se']
+    dof = np.maximum(out['n_clusters'].to_numpy() - 1, 1)
+    out['p'] = 2 * stats.t.sf(np.abs(out['t']), dof)
+    crit = stats.t.ppf(0.975, dof)
+    out['ci_low'] = out['coef'] - crit * out['se']
+    out['ci_high'] = out['coef'] + crit * out['se']
+    return out[by + ['outcome', 'term', 'coef', 'se', 't', 'p', 'ci_low', 'ci_high',
+                     'nobs', 'n_clusters', 'fe_iter']]
@@ -1,26 +1,53 @@
 # -*- coding: utf-8 -*-
-"""简化的中介分解（参数化法）与 PyMC 层级模型占位"""
+"""简化的中介分解（参数化法）与批量自助法中介估计
+批量估计：各路径回归只依赖交叉乘积矩阵 Σ v vᵀ（v = [1, x, 协变量, 中介, 结局]），
+自助重抽样等价于按抽中次数加权求和，所有重抽样的 a/b/c 路径由批量 np.linalg.solve 一次求出
+"""
+import os
+from pathlib import Path
+import numpy as np
 import pandas as pd
+import scipy.sparse as sp
+from scipy import stats
 import statsmodels.api as sm
+from ..config import OUTPUTS
+from ..utils.parallel import run_tasks
+from ..utils.profiling import profiled, add_counts
+
+EFFECTS = ['a', 'b', 'indirect', 'direct', 'total', 'prop_mediated']
+
+# 每批重抽样同时存在的 block×n_units 缓冲区个数（float64 抽中次数 + int64 下标），用于由字节预算推算批大小
+_BOOT_TEMPS = 2
+
+# 工作进程共享的只读数据（由 initializer 设置）
+_W = {}
+
+def _as_frame(covars):
+    if covars is None:
+        return []
+    if isinstance(covars, (pd.Series, pd.DataFrame)):
+        return [covars]
+    return list(covars)
 
 def paramed_linear(y, x, m, covars=None):
     """最简单的线性中介分解（Baron–Kenny 思路，仅作占位）
     路径: x -> m, y ~ x + m (+ covars)
+    covars: Series/DataFrame 或其列表
     返回: 总效应、直接效应、间接效应（线性近似）
     """
-    covars = covars or []
+    covars = _as_frame(covars)
     # x->m
-    Xm = sm.add_constant(pd.concat([x] + [covars], axis=1), has_constant='add')
+    Xm = sm.add_constant(pd.concat([x] + covars, axis=1), has_constant='add')
     mhat = sm.OLS(m, Xm).fit()
     a = mhat.params[x.name]
     # y ~ x + m
-    Xy = sm.add_constant(pd.concat([x, m] + [covars], axis=1), has_constant='add')
+    Xy = sm.add_constant(pd.concat([x, m] + covars, axis=1), has_constant='add')
     yhat = sm.OLS(y, Xy).fit()
     b = yhat.params[m.name]
     c_prime = yhat.params[x.name]
     ab = a * b
     # 总效应（不含 m）
-    Xc = sm.add_constant(pd.concat([x] + [covars], axis=1), has_constant='add')
+    Xc = sm.add_constant(pd.concat([x] + covars, axis=1), has_constant='add')
     chat = sm.OLS(y, Xc).fit()
     c_total = chat.params[x.name]
     return {
@@ -29,3 +56,208 @@ def paramed_linear(y, x, m, covars=None):
         "indirect_effect": ab,
         "models": {"x_to_m": mhat, "y_on_xm": yhat}
     }
+
+def _moments(V, codes, n_groups, chunk: int = 65536):
+    """按组汇总交叉乘积的上三角：(n_groups, d(d+1)/2)，分块计算避免 n×d² 的中间数组"""
+    d = V.shape[1]
+    iu = np.triu_indices(d)
+    out = np.zeros((n_groups, len(iu[0])))
+    for r0 in range(0, len(V), chunk):
+        v = V[r0:r0 + chunk]
+        prod = v[:, iu[0]] * v[:, iu[1]]
+        if codes is None:
+            out[r0:r0 + len(v)] = prod
+        else:
+            g = codes[r0:r0 + chunk]
+            C = sp.csr_matrix((np.ones(len(v)), (g, np.arange(len(v)))), shape=(n_groups, len(v)))
+            out += C @ prod
+    return out
+
+def _unpack(tri, d):
+    """上三角向量 (..., d(d+1)/2) → 对称矩阵 (..., d, d)"""
+    iu = np.triu_indices(d)
+    M = np.zeros(tri.shape[:-1] + (d, d))
+    M[..., iu[0], iu[1]] = tri
+    M[..., iu[1], iu[0]] = tri
+    return M
+
+def _paths(M, p, K, L):
+    """由交叉乘积矩阵批量求各路径
+    参数:
+      M: (B, d, d)，变量顺序 [常数, x, 协变量(p-2 个), 中介(K), 结局(L)]
+    返回:
+      (B, K, L, 6)，依次为 EFFECTS
+    """
+    B = M.shape[0]
+    base = np.arange(p)
+    med = np.arange(p, p + K)
+    out = np.arange(p + K, p + K + L)
+    # x → m 与 x → y（总效应）共用同一设计矩阵：一次多右端求解
+    coef = np.linalg.solve(M[:, :p, :p], M[:, :p, p:])
+    a, c = coef[:, 1, :K], coef[:, 1, K:]
+    res = np.empty((B, K, L, 6))
+    for j in range(K):
+        R = np.append(base, med[j])
+        coef = np.linalg.solve(M[:, R][:, :, R], M[:, R][:, :, out])
+        res[:, j, :, 1] = coef[:, -1, :]
+        res[:, j, :, 3] = coef[:, 1, :]
+    res[..., 0] = a[:, :, None]
+    res[..., 2] = res[..., 0] * res[..., 1]
+    res[..., 4] = c[:, None, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        res[..., 5] = res[..., 2] / res[..., 4]
+    return res
+
+def _init_worker(state):
+    _W.clear()
+    _W.update(state)
+
+def _boot_block(task):
+    """一批自助重抽样：抽中次数矩阵 × 单元交叉乘积 → 各重抽样的路径
+    每次重抽样使用各自的种子，结果与批大小、进程数无关
+    """
+    seeds = task
+    b = len(seeds)
+    G, d = _W['n_units'], _W['d']
+    # 抽样缓冲区在同一进程的各批之间复用
+    if 'buf' not in _W:
+        _W['buf'] = np.empty((_W['block'], G))
+        _W['idx'] = np.empty((_W['block'], G), dtype=np.int64)
+    counts, idx = _W['buf'][:b], _W['idx'][:b]
+    for i, seed in enumerate(seeds):
+        np.random.default_rng(seed).random(out=counts[i])
+    counts *= G
+    np.copyto(idx, counts, casting='unsafe')
+    idx += (np.arange(b) * G)[:, None]
+    counts[:] = 0.0
+    np.add.at(counts.reshape(-1), idx.reshape(-1), 1.0)
+    if _W.get('unit_mom') is not None:
+        tri = counts @ _W['unit_mom']
+    else:
+        # 观测层面重抽样：逐块生成交叉乘积，不保留 n×d² 数组
+        V, chunk = _W['V'], _W['chunk']
+        tri = 0.0
+        for r0 in range(0, G, chunk):
+            tri = tri + counts[:, r0:r0 + chunk] @ _moments(V[r0:r0 + chunk], None, min(chunk, G - r0))
+    return _paths(_unpack(tri, d), _W['p'], _W['K'], _W['L'])
+
+def _intervals(boot, est, jack, alpha, method):
+    """百分位或 BCa 区间；boot (B, S)，est (S,)，jack (J, S)"""
+    lo, hi = alpha / 2, 1 - alpha / 2
+    if method == 'percentile':
+        return np.nanquantile(boot, lo, axis=0), np.nanquantile(boot, hi, axis=0)
+    # 偏差校正 z0 与加速常数 a（刀切法）
+    z0 = stats.norm.ppf(np.clip((boot < est).mean(axis=0) + 0.5 * (boot == est).mean(axis=0),
+                                1 / len(boot), 1 - 1 / len(boot)))
+    dev = np.nanmean(jack, axis=0) - jack
+    with np.errstate(divide='ignore', invalid='ignore'):
+        acc = np.nansum(dev ** 3, axis=0) / (6 * np.nansum(dev ** 2, axis=0) ** 1.5)
+    acc = np.nan_to_num(acc)
+    ci = []
+    for q in (lo, hi):
+        z = stats.norm.ppf(q)
+        level = stats.norm.cdf(z0 + (z0 + z) / (1 - acc * (z0 + z)))
+        srt = np.sort(boot, axis=0)
+        pos = np.clip(level, 0, 1) * (len(boot) - 1)
+        i0 = np.floor(pos).astype(int)
+        i1 = np.minimum(i0 + 1, len(boot) - 1)
+        w = pos - i0
+        cols = np.arange(boot.shape[1])
+        ci.append(srt[i0, cols] * (1 - w) + srt[i1, cols] * w)
+    return ci[0], ci[1]
+
+@profiled()
+def mediation_bootstrap(df: pd.DataFrame, treatment: str, mediators, outcomes, covars=None,
+                        cluster: str = None, n_boot: int = 2000, ci: str = 'bca', alpha: float = 0.05,
+                        seed: int = 0, block: int = None, jack_max: int = 1000, max_workers: int = None,
+                        mem_budget: int = 1 << 30, out_path: Path = OUTPUTS['effects_parquet']):
+    """批量线性中介分解 + 自助法推断（每个 中介 × 结局 组合为一个单中介模型）
+    参数:
+      df: 数据表（分析单元 × 期等）
+      treatment: 处理/暴露变量 x
+      mediators: 中介变量列表（生境、连通性、干扰分项等）
+      outcomes: 结局变量列表（多样性指标等）
+      covars: 控制变量列表
+      cluster: 聚类变量；给出时整簇重抽样（cluster bootstrap），BCa 的刀切法按簇删一
+      n_boot: 自助重抽样次数
+      ci: 'bca' 或 'percentile'
+      block: 每批重抽样次数（每批一次矩阵乘法 + 批量求解，按批并行）；默认按 mem_budget 自动确定
+      mem_budget: 抽样缓冲区的总字节预算（所有工作进程合计，默认 1GB）；
+        批大小 = mem_budget / (进程数 × 缓冲区个数 × 8 字节 × 重抽样单元数)，不超过 n_boot
+      jack_max: 刀切单元（观测或簇）超过此数时随机合并为 jack_max 组（删一组刀切）
+      max_workers: 进程数（默认 CPU 核数；1 时在本进程内计算）
+      out_path: 结果写出路径（parquet，None 则不写）
+    返回:
+      长表：treatment, mediator, outcome, effect, estimate, se, ci_low, ci_high, ci_method, n_boot, nobs, n_units
+      effect 取 a（x→m）、b（m→y|x）、indirect（a·b）、direct（c'）、total（c）、prop_mediated（a·b/c）
+    说明：使用所有变量均非缺失的观测；固定种子下结果与进程数、批大小无关
+    """
+    mediators = [mediators] if isinstance(mediators, str) else list(mediators)
+    outcomes = [outcomes] if isinstance(outcomes, str) else list(outcomes)
+    covars = list(covars or [])
+    if ci not in ('bca', 'percentile'):
+        raise ValueError("ci 只支持 'bca' 或 'percentile'")
+    cols = [treatment] + covars + mediators + outcomes
+    add_counts(records=len(df))
+    ok = np.ones(len(df), dtype=bool)
+    for c in cols:
+        ok &= np.isfinite(df[c].to_numpy(dtype=float))
+    if cluster is not None:
+        ok &= pd.notna(df[cluster]).to_numpy()
+    n = int(ok.sum())
+    V = np.empty((n, len(cols) + 1))
+    V[:, 0] = 1.0
+    for i, c in enumerate(cols):
+        V[:, i + 1] = df[c].to_numpy(dtype=float)[ok]
+    d, p, K, L = V.shape[1], 2 + len(covars), len(mediators), len(outcomes)
+    if n <= p + 1:
+        raise ValueError("有效观测不足")
+
+    # 点估计
+    full = _moments(V, np.zeros(n, dtype=np.int64), 1)
+    est = _paths(_unpack(full, d), p, K, L)[0]
+
+    # 重抽样单元：簇或观测
+    if cluster is not None:
+        codes = pd.factorize(df[cluster].to_numpy()[ok])[0]
+        n_units = int(codes.max()) + 1
+        unit_mom = _moments(V, codes, n_units)
+    else:
+        codes, n_units = None, n
+        # 观测层面：交叉乘积不大时预先算好，否则在每批中逐块生成
+        unit_mom = _moments(V, None, n) if n * d * (d + 1) // 2 <= 5e7 else None
+    max_workers = max_workers or os.cpu_count()
+    block = block or max(1, min(n_boot, mem_budget // (max_workers * _BOOT_TEMPS * 8 * max(n_units, 1))))
+    state = {'n_units': n_units, 'block': block, 'd': d, 'p': p, 'K': K, 'L': L, 'unit_mom': unit_mom,
+             'V': V if unit_mom is None else None, 'chunk': max(1, int(2e7 // max(block, 1) // d))}
+    seeds = np.random.SeedSequence(seed).spawn(n_boot)
+    tasks = [seeds[s:s + block] for s in range(0, n_boot, block)]
+    parts = run_tasks(_boot_block, tasks, _init_worker, state, max_workers)
+    boot = np.concatenate(parts).reshape(n_boot, -1)
+    flat = est.reshape(-1)
+
+    jack = None
+    if ci == 'bca':
+        # 删一（组）刀切：总交叉乘积减去该组的交叉乘积
+        unit_codes = codes if codes is not None else np.arange(n)
+        if n_units > jack_max:
+            perm = np.random.default_rng(seed).permutation(n_units) % jack_max
+            unit_codes, n_jack = perm[unit_codes], jack_max
+        else:
+            n_jack = n_units
+        jm = _moments(V, unit_codes, n_jack)
+        jack = _paths(_unpack(full - jm, d), p, K, L).reshape(n_jack, -1)
+    low, high = _intervals(boot, flat, jack, alpha, ci)
+
+    idx = pd.MultiIndex.from_product([mediators, outcomes, EFFECTS], names=['mediator', 'outcome', 'effect'])
+    out = pd.DataFrame({'estimate': flat, 'se': np.nanstd(boot, axis=0, ddof=1),
+                        'ci_low': low, 'ci_high': high}, index=idx).reset_index()
+    out.insert(0, 'treatment', treatment)
+    out['ci_method'] = ci
+    out['n_boot'] = n_boot
+    out['nobs'] = n
+    out['n_units'] = n_units
+    if out_path is not None:
+        Path(out_path).parent.mkdir(parents=True, exist_ok=True)
+        out.to_parquet(out_path, index=False)
+    return out
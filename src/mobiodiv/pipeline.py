@@ -0,0 +1,242 @@
+# -*- coding: utf-8 -*-
+"""增量流水线：脚本 00–06 按阶段声明 输入/输出/依赖，按内容哈希 + 参数 + 代码指纹判断是否需要重跑
+- 指纹 = 脚本及其（递归）导入的 mobiodiv 模块源码 + 输入文件内容哈希 + 运行参数
+- 指纹未变且输出齐全、未被改动的阶段跳过；依赖已完成的阶段并行运行
+- 每个阶段成功后立即记录状态，失败只阻断其下游，重跑时从失败处继续
+"""
+import ast
+import hashlib
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+from .config import PROJECT_ROOT, FILES, OUTPUTS, INTERIM_DIR, PROCESSED_DIR, FIG_DIR
+from .utils.io import write_json
+from .utils.raster_cache import source_digest
+
+SCRIPTS_DIR = PROJECT_ROOT / 'scripts'
+SRC_DIR = PROJECT_ROOT / 'src'
+PIPELINE_DIR = INTERIM_DIR / 'pipeline'
+
+# 阶段声明：script 为 scripts/ 下的文件；inputs/outputs 为文件或目录；deps 决定运行顺序
+# inputs 只列脚本实际读取的文件，outputs 只列脚本成功退出时一定写出的文件（缺失即判为失败）
+# optional 阶段默认不运行（00 需要 --place 等参数，且依赖网络）
+STAGES = {
+    'fetch': {
+        'script': '00_fetch_open_data.py', 'deps': [], 'optional': True,
+        'inputs': [],
+        'outputs': [PROCESSED_DIR / 'aoi.gpkg'],
+    },
+    'strata': {
+        'script': '01_build_strata.py', 'deps': [],
+        'inputs': [FILES['ghsl_ucdb'], FILES['ghsl_smod']],
+        'outputs': [OUTPUTS['strata_gpkg']],
+    },
+    'mediators': {
+        'script': '02_build_mediators.py', 'deps': ['strata'],
+        'inputs': [FILES['worldcover'], FILES['no2'], FILES['pm25'], FILES['osm_roads'], OUTPUTS['strata_gpkg']],
+        'outputs': [OUTPUTS['mediators_parquet'], OUTPUTS['mediators_parquet'].with_suffix('.tif')],
+    },
+    'biodiversity': {
+        'script': '03_build_biodiversity.py', 'deps': ['strata'],
+        'inputs': [FILES['ebird_ebd'], FILES['gbif_occ'], OUTPUTS['strata_gpkg']],
+        # 脚本 03 的 GBIF/EBD 步骤出错时只打印提示，不保证写出任何文件
+        'outputs': [],
+    },
+    'models': {
+        # 脚本 04 目前使用模拟面板，不读取上游输出；改读真实数据后在此补充输入与依赖
+        'script': '04_models_effects.py', 'deps': [],
+        'inputs': [],
+        'outputs': [OUTPUTS['effects_parquet']],
+    },
+    'counterfactuals': {
+        'script': '05_counterfactuals.py', 'deps': ['mediators'],
+        'inputs': [OUTPUTS['mediators_parquet'].with_suffix('.tif'), FILES['worldcover'], OUTPUTS['strata_gpkg']],
+        'outputs': [PROCESSED_DIR / 'connectivity_scenarios.parquet'],
+    },
+    'figures': {
+        # 图 2–5 目前为示意图，只有图 1 读取分层结果
+        'script': '06_make_figures.py', 'deps': ['strata'],
+        'inputs': [OUTPUTS['strata_gpkg']],
+        'outputs': [FIG_DIR / f'fig{i}.png' for i in range(1, 6)],
+    },
+}
+
+def _module_file(name: str):
+    """模块名 → src 下的源文件（非 mobiodiv 模块返回 None）"""
+    if name != 'mobiodiv' and not name.startswith('mobiodiv.'):
+        return None
+    base = SRC_DIR.joinpath(*name.split('.'))
+    for p in (base.with_suffix('.py'), base / '__init__.py'):
+        if p.exists():
+            return p
+    return None
+
+def code_files(script: Path):
+    """脚本及其递归导入的 mobiodiv 源文件（按 ast 解析 import，含相对导入）"""
+    seen, todo = set(), [Path(script)]
+    while todo:
+        path = todo.pop()
+        if path in seen:
+            continue
+        seen.add(path)
+        pkg = None
+        if SRC_DIR in path.parents:
+            pkg = '.'.join(path.relative_to(SRC_DIR).with_suffix('').parts[:-1])
+        for node in ast.walk(ast.parse(path.read_text(encoding='utf-8'))):
+            names = []
+            if isinstance(node, ast.Import):
+                names = [a.name for a in node.names]
+            elif isinstance(node, ast.ImportFrom):
+                mod = node.module or ''
+                if node.level and pkg is not None:
+                    parts = pkg.split('.')
+                    parent = parts[:len(parts) - node.level + 1]
+                    mod = '.'.join(parent + ([mod] if mod else []))
+                # from pkg import submodule 的形式也需解析
+                names = [mod] + [f'{mod}.{a.name}' for a in node.names]
+            for name in names:
+                f = _module_file(name)
+                if f is not None and f not in seen:
+                    todo.append(f)
+    return sorted(seen)
+
+def path_digest(path: Path, memo_dir: Path = PIPELINE_DIR) -> str:
+    """文件或目录的内容哈希；文件哈希按 大小+修改时间 记忆，不存在时为 'missing'"""
+    path = Path(path)
+    if not path.exists():
+        return 'missing'
+    if path.is_file():
+        return source_digest(path, memo_dir)
+    h = hashlib.sha256()
+    for f in sorted(p for p in path.rglob('*') if p.is_file()):
+        h.update(str(f.relative_to(path)).encode())
+        h.update(source_digest(f, memo_dir).encode())
+    return h.hexdigest()
+
+def _rel(path: Path) -> str:
+    path = Path(path)
+    return str(path.relative_to(PROJECT_ROOT)) if PROJECT_ROOT in path.parents else str(path)
+
+def fingerprint(stage: dict, params: dict = None, memo_dir: Path = PIPELINE_DIR) -> dict:
+    """阶段指纹的组成部分（代码、输入、参数）及总哈希"""
+    script = SCRIPTS_DIR / stage['script']
+    parts = {
+        'code': {_rel(f): source_digest(f, memo_dir) for f in code_files(script)},
+        'inputs': {str(p): path_digest(p, memo_dir) for p in stage['inputs']},
+        'params': {'args': list(stage.get('args', [])), **(params or {})},
+    }
+    parts['sha256'] = hashlib.sha256(json.dumps(parts, sort_keys=True).encode()).hexdigest()
+    return parts
+
+def _closure(targets, stages):
+    """目标阶段及其全部上游"""
+    out, todo = set(), list(targets)
+    while todo:
+        n = todo.pop()
+        if n not in stages:
+            raise ValueError(f"未知阶段: {n}（可选：{', '.join(stages)}）")
+        if n not in out:
+            out.add(n)
+            todo.extend(stages[n]['deps'])
+    return out
+
+def _run_stage(name: str, stage: dict, log_dir: Path):
+    """子进程运行脚本，输出写入日志；返回 (退出码, 秒数)"""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([str(SRC_DIR)] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    t0 = time.perf_counter()
+    with open(log_dir / f'{name}.log', 'w', encoding='utf-8') as log:
+        proc = subprocess.run([sys.executable, str(SCRIPTS_DIR / stage['script']), *stage.get('args', [])],
+                              cwd=PROJECT_ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    return proc.returncode, time.perf_counter() - t0
+
+def run_pipeline(targets=None, stages: dict = None, args: dict = None, force=(), jobs: int = 2,
+                 dry_run: bool = False, state_dir: Path = PIPELINE_DIR, echo=print):
+    """按依赖增量运行各阶段
+    参数:
+      targets: 目标阶段（连同上游一起考虑）；默认全部非 optional 阶段
+      args: {阶段: 命令行参数列表}，覆盖阶段声明中的 args（计入指纹）
+      force: 强制重跑的阶段（其下游因输入变化自然重跑）
+      jobs: 同时运行的阶段数
+      dry_run: 只报告哪些阶段会运行
+    返回:
+      {阶段: 'skipped' | 'done' | 'failed' | 'blocked' | 'would-run'}
+    说明：状态写入 state_dir/state.json，日志写入 state_dir/logs/<阶段>.log；
+      指纹在阶段即将运行时计算（此时上游输出已更新），上游重跑但输出内容未变时下游仍会跳过
+    """
+    stages = {n: dict(s) for n, s in (stages or STAGES).items()}
+    for n, a in (args or {}).items():
+        stages[n]['args'] = list(a)
+    targets = targets or [n for n, s in stages.items() if not s.get('optional')]
+    todo = _closure(targets, stages)
+    state_dir = Path(state_dir)
+    (state_dir / 'logs').mkdir(parents=True, exist_ok=True)
+    state_path = state_dir / 'state.json'
+    state = json.loads(state_path.read_text(encoding='utf-8')) if state_path.exists() else {}
+    status = {}
+
+    def up_to_date(name, fp):
+        prev = state.get(name)
+        if name in force or not prev or prev.get('fingerprint') != fp['sha256']:
+            return False
+        return all(path_digest(p, state_dir) == prev['outputs'].get(str(p)) for p in stages[name]['outputs'])
+
+    def ready(name):
+        return all(status.get(d) in ('skipped', 'done', 'would-run') for d in stages[name]['deps'] if d in todo)
+
+    running = {}
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as ex:
+        while True:
+            busy = {n for n, _ in running.values()}
+            for name in [n for n in stages if n in todo and n not in status and n not in busy]:
+                if any(status.get(d) in ('failed', 'blocked') for d in stages[name]['deps']):
+                    status[name] = 'blocked'
+                    echo(f"[{name}] 上游失败，跳过")
+                    continue
+                if not ready(name):
+                    continue
+                if dry_run and any(status.get(d) == 'would-run' for d in stages[name]['deps']):
+                    # 上游将重跑时输入尚未更新，下游按需要运行处理
+                    status[name] = 'would-run'
+                    echo(f"[{name}] 需要运行（上游将重跑）")
+                    continue
+                fp = fingerprint(stages[name], memo_dir=state_dir)
+                if up_to_date(name, fp):
+                    status[name] = 'skipped'
+                    echo(f"[{name}] 已是最新")
+                    continue
+                if dry_run:
+                    status[name] = 'would-run'
+                    echo(f"[{name}] 需要运行")
+                    continue
+                echo(f"[{name}] 开始运行 {stages[name]['script']}")
+                running[ex.submit(_run_stage, name, stages[name], state_dir / 'logs')] = (name, fp)
+            if not running:
+                # 没有在运行的阶段时，本轮必然已确定所有能确定的阶段
+                if not all(n in status for n in todo):
+                    raise RuntimeError(f"阶段依赖无法满足：{sorted(todo - set(status))}")
+                break
+            finished, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for fut in finished:
+                name, fp = running.pop(fut)
+                code, sec = fut.result()
+                missing = [str(p) for p in stages[name]['outputs'] if not Path(p).exists()]
+                if code != 0 or missing:
+                    status[name] = 'failed'
+                    why = f"退出码 {code}" if code != 0 else f"缺少输出 {missing}"
+                    echo(f"[{name}] 失败（{why}），日志见 {state_dir / 'logs' / f'{name}.log'}")
+                    state.pop(name, None)
+                else:
+                    status[name] = 'done'
+                    echo(f"[{name}] 完成，用时 {sec:.1f} 秒")
+                    state[name] = {
+                        'fingerprint': fp['sha256'], 'seconds': round(sec, 3),
+                        'finished': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                        'outputs': {str(p): path_digest(p, state_dir) for p in stages[name]['outputs']},
+                    }
+                write_json(state_path, state, indent=1)
+    return status
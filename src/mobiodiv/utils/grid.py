@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+"""栅格格网的几何量（格元面积、瓦片像元所属单元等），供数据加载与指标模块共用"""
+import numpy as np
+import shapely
+from pyproj import CRS
+from rasterio import features, windows
+
+# 平均地球半径（km，IUGG）
+EARTH_RADIUS_KM = 6371.0088
+
+def cell_area_km2(transform, shape, crs) -> np.ndarray:
+    """逐行的格元面积（km²）：地理坐标格网按纬度带球面面积计算，投影格网为常数"""
+    height, _ = shape
+    if not CRS.from_user_input(crs).is_geographic:
+        return np.full(height, abs(transform.a * transform.e) / 1e6)
+    R = EARTH_RADIUS_KM
+    top = transform.f + np.arange(height) * transform.e
+    bottom = top + transform.e
+    dlon = np.deg2rad(abs(transform.a))
+    return R * R * dlon * np.abs(np.sin(np.deg2rad(top)) - np.sin(np.deg2rad(bottom)))
+
+def unit_ids(state, r0, r1, c0, c1):
+    """瓦片内每个像元所属单元号（-1 为不属于任何单元）
+    state: 含 block（规则分块边长）或 geoms/tree（单元多边形及其 STRtree），以及 shape/transform
+    """
+    h, w = r1 - r0, c1 - c0
+    if state.get('block'):
+        size = state['block']
+        n_wc = -(-state['shape'][1] // size)
+        rows = (np.arange(r0, r1) // size)[:, None]
+        cols = (np.arange(c0, c1) // size)[None, :]
+        return rows * n_wc + cols
+    win_transform = windows.transform(windows.Window(c0, r0, w, h), state['transform'])
+    tile_box = shapely.box(*windows.bounds(windows.Window(c0, r0, w, h), state['transform']))
+    hit = np.sort(state['tree'].query(tile_box, predicate='intersects'))
+    if len(hit) == 0:
+        return np.full((h, w), -1, dtype=np.int64)
+    # 逆序绘制：单元重叠时保留位置靠前的单元（与 community.unit_site_index 一致）
+    shapes = [(state['geoms'][i], int(i)) for i in hit[::-1]]
+    return features.rasterize(shapes, out_shape=(h, w), transform=win_transform,
+                              fill=-1, dtype='int32').astype(np.int64)
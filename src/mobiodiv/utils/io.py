@@ -1,25 +1,108 @@
 # -*- coding: utf-8 -*-
 """IO 工具函数（下载、解压、缓存等）"""
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from tqdm import tqdm
 import zipfile
 import tarfile
 
-def download_file(url: str, out_path: Path, chunk: int = 1<<20):
+# 可重试的 HTTP 状态码（限流与服务端临时错误）
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+def make_session(pool_size: int = 16, retries: int = 3) -> requests.Session:
+    """带连接池与重试的 requests 会话（多个分块/文件复用 TCP 连接）"""
+    session = requests.Session()
+    retry = Retry(total=retries, backoff_factor=0.5, status_forcelist=RETRY_STATUSES,
+                  allowed_methods=frozenset(['HEAD', 'GET']))
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def call_with_retry(fn, *args, retries: int = 3, backoff_factor: float = 0.5, **kwargs):
+    """调用 fn，遇到临时性网络错误时按指数退避重试（与 make_session 的重试策略一致）
+    说明：连接错误、超时与 RETRY_STATUSES 中的 HTTP 状态重试，等待 backoff_factor × 2^k 秒；
+      其他 HTTP 错误（如 400）与非网络异常直接抛出
+    """
+    for attempt in range(retries + 1):
+        try:
+            return fn(*args, **kwargs)
+        except requests.HTTPError as e:
+            status = e.response.status_code if e.response is not None else None
+            if status not in RETRY_STATUSES or attempt == retries:
+                raise
+        except (requests.ConnectionError, requests.Timeout):
+            if attempt == retries:
+                raise
+        time.sleep(backoff_factor * 2 ** attempt)
+
+def write_json(path: Path, obj, indent: int = None):
+    """原子写 JSON：先写同目录临时文件再 os.replace，中途失败不会留下残缺文件"""
+    path = Path(path)
+    tmp = path.with_name(path.name + f'.{os.getpid()}.tmp')
+    try:
+        tmp.write_text(json.dumps(obj, ensure_ascii=False, indent=indent), encoding='utf-8')
+        os.replace(tmp, path)
+    finally:
+        tmp.unlink(missing_ok=True)
+    return path
+
+def file_hash(path: Path, algo: str = 'sha256', chunk: int = 1 << 20) -> str:
+    h = hashlib.new(algo)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(chunk), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def verify_file(path: Path, size: int = None, checksum: str = None, algo: str = 'sha256'):
+    """校验文件大小与哈希，不一致时抛出 IOError"""
+    if size is not None and path.stat().st_size != size:
+        raise IOError(f"大小不一致: {path}（期望 {size}，实际 {path.stat().st_size}）")
+    if checksum is not None and file_hash(path, algo) != checksum.lower():
+        raise IOError(f"{algo} 校验失败: {path}")
+    return path
+
+def _content_range_start(r: requests.Response):
+    """解析 206 响应的 Content-Range 起点（'bytes 100-199/1000' → 100）"""
+    cr = r.headers.get('Content-Range', '')
+    try:
+        return int(cr.split()[1].split('-')[0])
+    except (IndexError, ValueError):
+        return None
+
+def download_file(url: str, out_path: Path, chunk: int = 1<<20, session: requests.Session = None,
+                  size: int = None, checksum: str = None, algo: str = 'sha256'):
     """下载大文件（支持断点续传）。需要你提供合法的 URL。
     参数:
       url: 下载地址
       out_path: 输出路径
+      size/checksum: 可选的期望大小与哈希（algo，默认 sha256），下载完成后校验
+    说明：续传时检查服务器是否真的按 Range 返回（206 且起点一致），否则从头重新写入
     """
     out_path.parent.mkdir(parents=True, exist_ok=True)
+    session = session or make_session(pool_size=1)
     headers = {}
     pos = 0
     if out_path.exists():
         pos = out_path.stat().st_size
+        if size is not None and pos == size:
+            return verify_file(out_path, size, checksum, algo)
         headers['Range'] = f'bytes={pos}-'
-    with requests.get(url, stream=True, headers=headers, timeout=60) as r:
+    with session.get(url, stream=True, headers=headers, timeout=60) as r:
+        if r.status_code == 416 and pos > 0:
+            # 请求起点已超出文件末尾：本地文件已完整（或已损坏），交给校验判断
+            return verify_file(out_path, size, checksum, algo)
         r.raise_for_status()
+        if pos > 0 and not (r.status_code == 206 and _content_range_start(r) == pos):
+            # 服务器忽略了 Range（返回 200 全量），不能追加，否则文件损坏
+            pos = 0
         mode = 'ab' if pos>0 else 'wb'
         total = int(r.headers.get('Content-Length', 0)) + pos
         with open(out_path, mode) as f, tqdm(total=total, initial=pos, unit='B', unit_scale=True, desc=out_path.name) as pbar:
@@ -27,8 +110,122 @@ def download_file(url: str, out_path: Path, chunk: int = 1<<20):
                 if chunk_bytes:
                     f.write(chunk_bytes)
                     pbar.update(len(chunk_bytes))
+    return verify_file(out_path, size, checksum, algo)
+
+def _manifest_path(out_path: Path) -> Path:
+    return out_path.with_name(out_path.name + '.parts.json')
+
+def _probe(url: str, session: requests.Session):
+    """HEAD 探测文件大小与是否支持 Range"""
+    r = session.head(url, allow_redirects=True, timeout=60)
+    r.raise_for_status()
+    size = int(r.headers.get('Content-Length', 0)) or None
+    ranges = r.headers.get('Accept-Ranges', '').lower() == 'bytes'
+    return size, ranges
+
+def _fetch_part(url: str, out_path: Path, part: dict, session: requests.Session, chunk: int):
+    start, end = part['start'], part['end']
+    with session.get(url, stream=True, headers={'Range': f'bytes={start}-{end}'}, timeout=60) as r:
+        r.raise_for_status()
+        if r.status_code != 206 or _content_range_start(r) != start:
+            raise IOError(f"服务器未按 Range 返回分块 {start}-{end}（HTTP {r.status_code}）")
+        written = 0
+        with open(out_path, 'r+b') as f:
+            f.seek(start)
+            for chunk_bytes in r.iter_content(chunk_size=chunk):
+                if chunk_bytes:
+                    f.write(chunk_bytes)
+                    written += len(chunk_bytes)
+    if written != end - start + 1:
+        raise IOError(f"分块 {start}-{end} 不完整（{written} 字节）")
+    return written
+
+def download_parallel(url: str, out_path: Path, part_size: int = 16 << 20, max_workers: int = 8,
+                      session: requests.Session = None, size: int = None, checksum: str = None,
+                      algo: str = 'sha256', chunk: int = 1 << 20):
+    """多连接分块下载：把文件切成若干字节区间并发拉取，写入预分配文件的对应偏移
+    说明：
+      - 分块状态记录在 <文件名>.parts.json，中断后重跑只下载未完成的分块
+      - 服务器不支持 Range 或文件较小时退回 download_file 单连接下载
+      - 全部完成后校验大小（及可选哈希），随后删除分块清单；
+        再次调用时本地文件无清单且大小与期望（或服务器报告）一致，则只校验不重新下载
+    """
+    out_path = Path(out_path)
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    session = session or make_session(pool_size=max_workers)
+    manifest_path = _manifest_path(out_path)
+
+    manifest = None
+    if manifest_path.exists():
+        manifest = json.loads(manifest_path.read_text())
+        if manifest.get('url') != url or not out_path.exists():
+            manifest = None
+    if manifest is None:
+        # 无清单且本地文件大小已与期望一致：此前已下载完成（完成后清单被删除），只做校验
+        if size is not None and out_path.exists() and out_path.stat().st_size == size:
+            return verify_file(out_path, size, checksum, algo)
+        remote_size, ranges = _probe(url, session)
+        if size is not None and remote_size is not None and size != remote_size:
+            raise IOError(f"服务器返回的大小 {remote_size} 与期望 {size} 不一致: {url}")
+        size = size or remote_size
+        if size is not None and out_path.exists() and out_path.stat().st_size == size:
+            return verify_file(out_path, size, checksum, algo)
+        if not ranges or size is None or size <= part_size:
+            return download_file(url, out_path, chunk=chunk, session=session, size=size, checksum=checksum, algo=algo)
+        parts = [{'start': s, 'end': min(s + part_size, size) - 1, 'done': False} for s in range(0, size, part_size)]
+        manifest = {'url': url, 'size': size, 'parts': parts}
+        with open(out_path, 'wb') as f:
+            f.truncate(size)
+        write_json(manifest_path, manifest)
+    size = manifest['size']
+
+    todo = [p for p in manifest['parts'] if not p['done']]
+    errors = []
+    with ThreadPoolExecutor(max_workers=max_workers) as ex, \
+            tqdm(total=size, initial=size - sum(p['end'] - p['start'] + 1 for p in todo),
+                 unit='B', unit_scale=True, desc=out_path.name) as pbar:
+        futures = {ex.submit(_fetch_part, url, out_path, p, session, chunk): p for p in todo}
+        for fut in as_completed(futures):
+            part = futures[fut]
+            try:
+                n = fut.result()
+            except Exception as e:
+                errors.append((part['start'], e))
+                continue
+            # 清单只在主线程更新
+            part['done'] = True
+            write_json(manifest_path, manifest)
+            pbar.update(n)
+    if errors:
+        raise IOError(f"{len(errors)} 个分块下载失败（已完成的分块已记录，可重跑续传）：{errors[:3]}")
+    verify_file(out_path, size, checksum, algo)
+    manifest_path.unlink(missing_ok=True)
     return out_path
 
+def download_many(entries, max_workers: int = 4, part_workers: int = 4, part_size: int = 16 << 20):
+    """按清单并发下载多个文件（有界线程池，共享连接池会话）
+    参数:
+      entries: [{'url':..., 'path':..., 'size':可选, 'checksum':可选, 'algo':可选}, ...]
+    返回:
+      dict：path → 'ok' 或异常对象（单个文件失败不影响其他文件）
+    """
+    session = make_session(pool_size=max_workers * part_workers)
+    results = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as ex:
+        futures = {
+            ex.submit(download_parallel, e['url'], Path(e['path']), part_size=part_size,
+                      max_workers=part_workers, session=session, size=e.get('size'),
+                      checksum=e.get('checksum'), algo=e.get('algo', 'sha256')): Path(e['path'])
+            for e in entries
+        }
+        for fut in as_completed(futures):
+            try:
+                fut.result()
+                results[futures[fut]] = 'ok'
+            except Exception as e:
+                results[futures[fut]] = e
+    return results
+
 def extract_any(archive_path: Path, out_dir: Path):
     """解压 zip/tar.gz 等常见归档"""
     out_dir.mkdir(parents=True, exist_ok=True)
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""分块并行的公共工具：瓦片划分、掩膜落盘为内存映射、按进程池分发任务"""
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import numpy as np
+
+def tile_windows(shape, tile: int):
+    """按 tile×tile 划分栅格，返回 (r0, r1, c0, c1) 列表（行优先）"""
+    height, width = shape
+    return [(r, min(r + tile, height), c, min(c + tile, width))
+            for r in range(0, height, tile) for c in range(0, width, tile)]
+
+def as_memmap(mask, path: Path):
+    """把掩膜（numpy / dask / xarray）落盘为 uint8 内存映射 .npy，供各进程按窗口读取"""
+    data = getattr(mask, 'data', mask)
+    if isinstance(data, np.memmap):
+        return data
+    out = np.lib.format.open_memmap(path, mode='w+', dtype=np.uint8, shape=data.shape[-2:])
+    if hasattr(data, 'store'):
+        data.astype(np.uint8).store(out, lock=False)
+    else:
+        out[:] = np.asarray(data, dtype=np.uint8)
+    out.flush()
+    return out
+
+def run_tasks(fn, tasks, init, state, max_workers: int):
+    """用 init(state) 初始化每个工作进程后，按顺序返回 fn(task) 的结果
+    参数:
+      fn/init: 模块级函数（需可被子进程导入）；init 通常把 state 写入该模块的 _W
+      max_workers: 进程数；1 时在本进程内依次计算，便于调试与小数据
+    """
+    if max_workers == 1:
+        init(state)
+        return [fn(t) for t in tasks]
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=init, initargs=(state,)) as ex:
+        return list(ex.map(fn, tasks, chunksize=max(1, len(tasks) // (max_workers * 4))))
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""分区 Parquet 工具（按 年份/空间瓦片 分区写出，读取时做分区裁剪与谓词下推）"""
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as pads
+
+# 分区字段与类型（写出和读取使用同一 schema，避免目录名被推断成其他整数类型）
+PARTITION_SCHEMA = pa.schema([('year', pa.int16()), ('tile_x', pa.int16()), ('tile_y', pa.int16())])
+
+def partitioning(schema: pa.Schema = PARTITION_SCHEMA):
+    return pads.partitioning(schema, flavor='hive')
+
+def tile_index(lon, lat, tile_deg: float = 1.0):
+    """经纬度 → 整数瓦片列/行号（floor(坐标 / 瓦片边长)）"""
+    tx = np.floor(np.asarray(lon, dtype='float64') / tile_deg).astype(np.int16)
+    ty = np.floor(np.asarray(lat, dtype='float64') / tile_deg).astype(np.int16)
+    return tx, ty
+
+def write_partitioned(df: pd.DataFrame, root: Path, basename: str, schema: pa.Schema = PARTITION_SCHEMA):
+    """把一个批次追加写入分区数据集
+    说明：同一分区内同名文件会被替换，basename 须在所有写入（包括多次调用、多次运行）间唯一，
+      如 f'{运行号}-part-{批次号:05d}'
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    pads.write_dataset(
+        table, str(root), format='parquet',
+        partitioning=partitioning(schema),
+        basename_template=f'{basename}-{{i}}.parquet',
+        existing_data_behavior='overwrite_or_ignore',
+    )
+
+def bbox_expr(bbox, lon_col: str, lat_col: str, tile_deg: float = 1.0):
+    """bbox 过滤表达式：瓦片分区裁剪 + 行级坐标过滤"""
+    minx, miny, maxx, maxy = bbox
+    (tx0, tx1), (ty0, ty1) = tile_index([minx, maxx], [miny, maxy], tile_deg)
+    return ((pc.field('tile_x') >= int(tx0)) & (pc.field('tile_x') <= int(tx1))
+            & (pc.field('tile_y') >= int(ty0)) & (pc.field('tile_y') <= int(ty1))
+            & (pc.field(lon_col) >= minx) & (pc.field(lon_col) <= maxx)
+            & (pc.field(lat_col) >= miny) & (pc.field(lat_col) <= maxy))
+
+def time_expr(date_col: str, start=None, end=None):
+    """时间窗过滤表达式：年份分区裁剪 + 行级日期过滤（闭区间）"""
+    expr = None
+    if start is not None:
+        start = pd.Timestamp(start)
+        expr = (pc.field('year') >= start.year) & (pc.field(date_col) >= pa.scalar(start.to_pydatetime(), pa.timestamp('ms')))
+    if end is not None:
+        end = pd.Timestamp(end)
+        e = (pc.field('year') <= end.year) & (pc.field(date_col) <= pa.scalar(end.to_pydatetime(), pa.timestamp('ms')))
+        expr = e if expr is None else expr & e
+    return expr
+
+def and_exprs(*exprs):
+    """合并多个（可能为 None 的）过滤表达式"""
+    out = None
+    for e in exprs:
+        if e is not None:
+            out = e if out is None else out & e
+    return out
+
+def read_partitioned(root: Path, columns=None, filter=None, schema: pa.Schema = PARTITION_SCHEMA) -> pd.DataFrame:
+    """读取分区数据集（只扫描满足过滤条件的分区与行组）"""
+    ds = pads.dataset(str(root), format='parquet', partitioning=partitioning(schema))
+    return ds.to_table(columns=columns, filter=filter).to_pandas()
@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""运行剖析：记录各加载/计算函数的 墙钟/CPU 时间、峰值内存、读写字节数、处理的像元数与记录数
+由环境变量 MOBIODIV_PROFILE=1 开启；关闭时装饰器只多一次全局布尔判断。
+每次调用追加一行 JSON 到 OUT_DIR/profile/trace-<运行号>.jsonl（子进程共用同一运行号与文件），
+进程退出时按函数汇总为 OUT_DIR/profile/summary-<运行号>.csv
+"""
+import atexit
+import contextvars
+import functools
+import json
+import os
+import resource
+import time
+from pathlib import Path
+from ..config import OUT_DIR
+
+PROFILE_DIR = OUT_DIR / 'profile'
+ENABLED = os.environ.get('MOBIODIV_PROFILE', '').lower() not in ('', '0', 'false', 'no')
+if ENABLED:
+    # 运行号写回环境变量，由子进程（进程池、流水线阶段）继承
+    RUN_ID = os.environ.setdefault('MOBIODIV_RUN_ID', time.strftime('%Y%m%dT%H%M%S') + f'-{os.getpid()}')
+else:
+    RUN_ID = None
+
+# 当前调用栈（嵌套的 span），计数器记到最内层
+_STACK = contextvars.ContextVar('mobiodiv_profile_stack', default=())
+
+def _io_bytes():
+    """进程累计读写字节数（Linux /proc/self/io 的 rchar/wchar，含页缓存命中）；不可用时为 (None, None)"""
+    try:
+        with open('/proc/self/io') as f:
+            io = dict(line.split(': ') for line in f.read().splitlines())
+        return int(io['rchar']), int(io['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+def _peak_rss_mb(who=resource.RUSAGE_SELF):
+    # Linux 上 ru_maxrss 单位为 KB
+    return round(resource.getrusage(who).ru_maxrss / 1024, 1)
+
+def _auto_counts(result):
+    """由返回值推断处理量：数组/栅格 → 像元数，表 → 记录数"""
+    if hasattr(result, 'columns') and hasattr(result, '__len__'):
+        return {'records': len(result)}
+    size = getattr(result, 'size', None)
+    if isinstance(size, int) and hasattr(result, 'shape'):
+        return {'pixels': size}
+    return {}
+
+class span:
+    """剖析区段（上下文管理器）
+    用法:
+      with span('reproject', pixels=h*w) as s:
+          ...
+          s.add(records=n)
+    说明：未开启时进入/退出不做任何计量；被装饰函数内部可用 add_counts 给当前区段计数
+    """
+    __slots__ = ('name', 'counters', '_t0', '_c0', '_io0', '_token')
+
+    def __init__(self, name: str, **counters):
+        self.name = name
+        self.counters = counters
+
+    def add(self, **counters):
+        for k, v in counters.items():
+            if v is not None:
+                self.counters[k] = self.counters.get(k, 0) + v
+
+    def __enter__(self):
+        if not ENABLED:
+            return self
+        self._token = _STACK.set(_STACK.get() + (self,))
+        self._io0 = _io_bytes()
+        self._c0 = time.process_time()
+        self._t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if not ENABLED:
+            return False
+        wall = time.perf_counter() - self._t0
+        cpu = time.process_time() - self._c0
+        r1, w1 = _io_bytes()
+        stack = _STACK.get()
+        _STACK.reset(self._token)
+        rec = {
+            'run': RUN_ID, 'pid': os.getpid(), 'name': self.name,
+            'parent': stack[-2].name if len(stack) > 1 else None, 'depth': len(stack) - 1,
+            'end': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'wall_s': round(wall, 6), 'cpu_s': round(cpu, 6),
+            'peak_rss_mb': _peak_rss_mb(), 'child_peak_rss_mb': _peak_rss_mb(resource.RUSAGE_CHILDREN),
+            'bytes_read': None if r1 is None else r1 - self._io0[0],
+            'bytes_written': None if w1 is None else w1 - self._io0[1],
+            'pixels': self.counters.get('pixels'), 'records': self.counters.get('records'),
+            'error': exc_type.__name__ if exc_type else None,
+        }
+        _emit(rec)
+        return False
+
+def add_counts(**counters):
+    """给当前（最内层）区段累加计数（pixels/records 等）；未开启或不在区段内时忽略"""
+    if ENABLED:
+        stack = _STACK.get()
+        if stack:
+            stack[-1].add(**counters)
+
+def profiled(name: str = None, pixels=None, records=None):
+    """函数剖析装饰器
+    参数:
+      name: 记录名（默认 模块名.函数名，去掉 mobiodiv. 前缀）
+      pixels/records: 由返回值计算处理量的函数；默认按返回值类型推断（数组 → 像元，表 → 记录）
+    """
+    def deco(fn):
+        label = name or f"{fn.__module__.removeprefix('mobiodiv.')}.{fn.__qualname__}"
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return fn(*args, **kwargs)
+            with span(label) as s:
+                result = fn(*args, **kwargs)
+                counts = _auto_counts(result)
+                if pixels is not None:
+                    counts['pixels'] = pixels(result)
+                if records is not None:
+                    counts['records'] = records(result)
+                for k, v in counts.items():
+                    s.counters.setdefault(k, v)
+            return result
+        return wrapper
+    return deco
+
+def trace_path(run_id: str = None) -> Path:
+    return PROFILE_DIR / f'trace-{run_id or RUN_ID}.jsonl'
+
+def _emit(rec: dict):
+    PROFILE_DIR.mkdir(parents=True, exist_ok=True)
+    # 单行追加写（O_APPEND），多进程同时写同一文件时行不交错
+    line = (json.dumps(rec, ensure_ascii=False) + '\n').encode('utf-8')
+    fd = os.open(trace_path(), os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+def summarize(run_id: str = None, out_path: Path = None):
+    """按记录名汇总一次运行的 trace
+    返回:
+      DataFrame：calls, wall_s（合计）, wall_mean_s, wall_max_s, cpu_s, peak_rss_mb（最大）,
+      bytes_read, bytes_written, pixels, records, errors；按 wall_s 降序
+    说明：嵌套区段的时间同时计入父区段，合计值不可跨层相加
+    """
+    import pandas as pd
+    path = trace_path(run_id)
+    if not path.exists():
+        return pd.DataFrame()
+    df = pd.read_json(path, lines=True)
+    if df.empty:
+        return df
+    g = df.groupby('name')
+    out = pd.DataFrame({
+        'calls': g.size(),
+        'wall_s': g['wall_s'].sum(), 'wall_mean_s': g['wall_s'].mean(), 'wall_max_s': g['wall_s'].max(),
+        'cpu_s': g['cpu_s'].sum(),
+        'peak_rss_mb': g[['peak_rss_mb', 'child_peak_rss_mb']].max().max(axis=1),
+        'bytes_read': g['bytes_read'].sum(min_count=1), 'bytes_written': g['bytes_written'].sum(min_count=1),
+        'pixels': g['pixels'].sum(min_count=1), 'records': g['records'].sum(min_count=1),
+        'errors': g['error'].count(),
+    }).sort_values('wall_s', ascending=False)
+    out_path = Path(out_path) if out_path else PROFILE_DIR / f'summary-{run_id or RUN_ID}.csv'
+    out_path.parent.mkdir(parents=True, exist_ok=True)
+    out.to_csv(out_path)
+    return out
+
+def _summarize_at_exit():
+    # 进程池工作进程以 os._exit 退出，不会触发；各脚本进程退出时按截至当时的完整 trace 重写汇总
+    if trace_path().exists():
+        summarize()
+
+if ENABLED:
+    atexit.register(_summarize_at_exit)
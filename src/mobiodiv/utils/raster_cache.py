@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+"""重投影/对齐栅格的内容寻址缓存（INTERIM_DIR 下的 COG，LRU 按容量淘汰，命中/未命中写入日志）
+缓存键 = 源文件内容哈希 + 目标 CRS/格网（transform、宽高）+ 重采样方法；
+源文件或目标格网任一变化都会得到新键，旧结果随 LRU 淘汰
+"""
+import hashlib
+import json
+import math
+import os
+import time
+from pathlib import Path
+import rasterio
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.vrt import WarpedVRT
+from rasterio.warp import calculate_default_transform
+from ..config import INTERIM_DIR, CRS_WGS84
+from .io import file_hash, write_json
+from .profiling import profiled, add_counts
+
+CACHE_DIR = INTERIM_DIR / 'reproject_cache'
+CACHE_MAX_BYTES = 50 * (1 << 30)
+# 缓存文件格式或写出参数变化时递增，使旧键全部失效
+CACHE_VERSION = 1
+
+def _log(cache_dir: Path, event: str, key: str, **extra):
+    """追加一行 JSONL（event: hit/miss/evict）"""
+    rec = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'event': event, 'key': key, **extra}
+    with open(cache_dir / 'cache_log.jsonl', 'a', encoding='utf-8') as f:
+        f.write(json.dumps(rec, ensure_ascii=False) + '\n')
+
+def source_digest(path: Path, cache_dir: Path = CACHE_DIR) -> str:
+    """源文件内容哈希（sha256）；按 路径+大小+修改时间 记忆，文件未变时不重复读全文件"""
+    path = Path(path).resolve()
+    st = path.stat()
+    memo_path = Path(cache_dir) / 'sources.json'
+    memo = json.loads(memo_path.read_text(encoding='utf-8')) if memo_path.exists() else {}
+    stamp = f'{st.st_size}:{st.st_mtime_ns}'
+    entry = memo.get(str(path))
+    if entry and entry['stamp'] == stamp:
+        return entry['sha256']
+    digest = file_hash(path)
+    memo[str(path)] = {'stamp': stamp, 'sha256': digest}
+    memo_path.parent.mkdir(parents=True, exist_ok=True)
+    write_json(memo_path, memo, indent=1)
+    return digest
+
+def target_grid(src, dst_crs=CRS_WGS84, like=None, resolution=None, bbox=None):
+    """目标格网参数（crs/transform/width/height）
+    参数:
+      like: 参考栅格（xr.DataArray），直接采用其格网
+      resolution: 目标分辨率（目标 CRS 单位）；默认由 GDAL 按源分辨率推算
+      bbox: 目标 CRS 下的范围 (minx, miny, maxx, maxy)，保持分辨率并把格网收缩到该范围
+    """
+    if like is not None:
+        return {'crs': str(like.rio.crs), 'transform': like.rio.transform(),
+                'width': like.rio.width, 'height': like.rio.height}
+    transform, width, height = calculate_default_transform(
+        src.crs, dst_crs, src.width, src.height, *src.bounds, resolution=resolution)
+    if bbox is not None:
+        res_x, res_y = transform.a, -transform.e
+        minx, miny, maxx, maxy = bbox
+        transform = from_origin(minx, maxy, res_x, res_y)
+        width = max(1, math.ceil((maxx - minx) / res_x))
+        height = max(1, math.ceil((maxy - miny) / res_y))
+    return {'crs': str(dst_crs), 'transform': transform, 'width': width, 'height': height}
+
+def cache_key(digest: str, grid: dict, resampling: Resampling) -> str:
+    spec = {
+        'version': CACHE_VERSION, 'source': digest, 'crs': grid['crs'],
+        'transform': [round(v, 12) for v in tuple(grid['transform'])[:6]],
+        'width': grid['width'], 'height': grid['height'], 'resampling': resampling.name,
+    }
+    return hashlib.sha1(json.dumps(spec, sort_keys=True).encode()).hexdigest()
+
+def evict(cache_dir: Path = CACHE_DIR, max_bytes: int = CACHE_MAX_BYTES, keep=()):
+    """按最近使用时间（命中时刷新文件 mtime）淘汰，直到总容量不超过 max_bytes"""
+    cache_dir = Path(cache_dir)
+    # 跳过其他进程正在写出的临时文件
+    files = sorted((p for p in cache_dir.glob('*.tif') if not p.name.endswith('.tmp.tif')),
+                   key=lambda p: p.stat().st_mtime)
+    total = sum(p.stat().st_size for p in files)
+    for p in files:
+        if total <= max_bytes:
+            break
+        if p.stem in keep:
+            continue
+        size = p.stat().st_size
+        p.unlink(missing_ok=True)
+        p.with_suffix('.json').unlink(missing_ok=True)
+        total -= size
+        _log(cache_dir, 'evict', p.stem, bytes=size)
+    return total
+
+@profiled()
+def cached_reproject(path: Path, dst_crs=CRS_WGS84, like=None, resolution=None, bbox=None,
+                     resampling: Resampling = Resampling.nearest, cache_dir: Path = CACHE_DIR,
+                     max_bytes: int = CACHE_MAX_BYTES) -> Path:
+    """返回重投影/对齐到目标格网后的缓存 COG 路径；未命中时由 GDAL（WarpedVRT）流式生成
+    参数见 target_grid；resampling 为重采样方法（分类栅格用 nearest，连续值用 bilinear 等）
+    """
+    cache_dir = Path(cache_dir)
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    digest = source_digest(path, cache_dir)
+    with rasterio.open(path) as src:
+        grid = target_grid(src, dst_crs, like=like, resolution=resolution, bbox=bbox)
+        key = cache_key(digest, grid, resampling)
+        out = cache_dir / f'{key}.tif'
+        if out.exists():
+            os.utime(out)
+            _log(cache_dir, 'hit', key, source=str(path))
+            return out
+        t0 = time.perf_counter()
+        add_counts(pixels=grid['width'] * grid['height'])
+        tmp = cache_dir / f'{key}.{os.getpid()}.tmp.tif'
+        try:
+            with WarpedVRT(src, resampling=resampling, **grid) as vrt:
+                rasterio.shutil.copy(vrt, tmp, driver='COG', COMPRESS='DEFLATE',
+                                     BLOCKSIZE=512, BIGTIFF='IF_SAFER')
+            os.replace(tmp, out)
+        finally:
+            # 失败时临时文件不计入缓存容量（evict 忽略 *.tmp.tif），须当场删除
+            tmp.unlink(missing_ok=True)
+    write_json(out.with_suffix('.json'), {
+        'source': str(path), 'sha256': digest, 'crs': grid['crs'],
+        'transform': list(grid['transform'])[:6], 'width': grid['width'], 'height': grid['height'],
+        'resampling': resampling.name,
+    }, indent=1)
+    _log(cache_dir, 'miss', key, source=str(path), seconds=round(time.perf_counter() - t0, 3),
+         bytes=out.stat().st_size)
+    evict(cache_dir, max_bytes, keep=(key,))
+    return out